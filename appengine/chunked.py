@@ -0,0 +1,240 @@
+#
+# scanningcabinet's AppEngine server-side code.
+#
+# Copyright 2009 Brad Fitzpatrick <brad@danga.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Resumable uploads, one chunk per request.
+
+A one-shot blobstore upload of a big scan or PDF starts over after any
+network error.  Instead, scancab can start() a ChunkedUpload and send
+the file CHUNK_SIZE bytes at a time, each with its offset and MD5.
+Chunks are appended in order to a blobstore file through the Files API.
+After an error the client asks how much was received and carries on
+from there.  A chunk sent twice is acknowledged and dropped.  finish()
+finalizes the file into a blob, which is then stored like any other
+upload.
+
+Only one request appends at a time: append() takes a lease on the
+upload, in a transaction, before writing.  A lease that expires rather
+than being released means a request died mid-write, leaving the file in
+an unknown state, so the upload fails and the client starts over.
+finish() also checks the blob's size and MD5 before storing it.
+
+Uploads untouched for ABANDON_AFTER are deleted by sweep().
+"""
+
+import datetime
+import hashlib
+import logging
+import mimetypes
+
+from google.appengine.api import files
+from google.appengine.ext import blobstore
+from google.appengine.ext import db
+
+from model import ChunkedUpload
+
+# Most bytes per chunk; each is one Files API write.
+CHUNK_SIZE = 512 * 1024
+
+# Largest file accepted.
+MAX_SIZE = 512 * 1024 * 1024
+
+# How long an append may take to write its chunk.
+WRITE_LEASE = datetime.timedelta(seconds=60)
+
+ABANDON_AFTER = datetime.timedelta(days=1)
+
+SWEEP_BATCH_SIZE = 100
+
+
+class Error(Exception):
+  """The upload can't take a request; the client should start over."""
+
+
+class OffsetError(Error):
+  """A chunk isn't at the upload's current offset."""
+
+  def __init__(self, received):
+    Error.__init__(self, 'expected offset %d' % received)
+    self.received = received
+
+
+def start(user_info, filename, size, content_type=None, md5_hash=None):
+  """Starts an upload.
+
+  Args:
+    user_info: the uploading UserInfo.
+    filename: the file's name, as /post would get it.
+    size: the file's length in bytes.
+    content_type: its MIME type, else guessed from filename.
+    md5_hash: optional hex MD5 of the whole file, checked by finish().
+
+  Returns:
+    The new ChunkedUpload.
+  """
+  if size <= 0 or size > MAX_SIZE:
+    raise Error('size must be 1 to %d bytes' % MAX_SIZE)
+  if not content_type:
+    content_type, unused_encoding = mimetypes.guess_type(filename)
+  content_type = content_type or 'application/octet-stream'
+  file_name = files.blobstore.create(mime_type=content_type,
+                                     _blobinfo_uploaded_filename=filename)
+  upload = ChunkedUpload(parent=user_info, filename=filename,
+                         content_type=content_type, size=size,
+                         md5_hash=md5_hash and md5_hash.lower(),
+                         file_name=file_name)
+  upload.put()
+  return upload
+
+
+def append(upload_key, offset, data, md5_hash):
+  """Appends one chunk.
+
+  Args:
+    upload_key: the ChunkedUpload's key.
+    offset: where in the file the chunk starts.
+    data: the chunk.
+    md5_hash: hex MD5 of data, as the client computed it.
+
+  Returns:
+    The number of bytes received so far.
+
+  Raises:
+    OffsetError: if offset isn't where the upload is, and the chunk
+      isn't one already received.
+    Error: if the chunk is corrupt, the wrong size, or the upload can't
+      go on.
+  """
+  if hashlib.md5(data).hexdigest() != (md5_hash or '').lower():
+    raise Error('chunk MD5 mismatch')
+  if not data or len(data) > CHUNK_SIZE:
+    raise Error('chunks must be 1 to %d bytes' % CHUNK_SIZE)
+
+  def lease():
+    upload = _get(upload_key)
+    if offset + len(data) <= upload.received:
+      return upload, False  # Sent again after a lost response.
+    if upload.writing_until is not None:
+      if upload.writing_until > datetime.datetime.now():
+        raise OffsetError(upload.received)  # Another request's chunk.
+      raise Error('a chunk write was interrupted')
+    if offset != upload.received:
+      raise OffsetError(upload.received)
+    if offset + len(data) > upload.size:
+      raise Error('chunk runs past the end of the file')
+    upload.writing_until = datetime.datetime.now() + WRITE_LEASE
+    upload.put()
+    return upload, True
+  upload, write = db.run_in_transaction(lease)
+  if not write:
+    return upload.received
+
+  try:
+    out = files.open(upload.file_name, 'a')
+    try:
+      out.write(data)
+    finally:
+      out.close()
+  except files.Error:
+    db.run_in_transaction(_release, upload_key, 0)
+    raise
+  return db.run_in_transaction(_release, upload_key, len(data))
+
+
+def _get(upload_key):
+  upload = db.get(upload_key)
+  if upload is None:
+    raise Error('no such upload')
+  return upload
+
+
+def _release(upload_key, written):
+  upload = _get(upload_key)
+  upload.received += written
+  upload.writing_until = None
+  upload.put()
+  return upload.received
+
+
+def finish(upload_key):
+  """Finalizes a fully received upload into a blob.
+
+  Returns:
+    The blob's BlobInfo, or None if the upload was stored already.
+
+  Raises:
+    OffsetError: if the upload isn't all received yet.
+    Error: if the finished file isn't what the client sent.
+  """
+  upload = _get(upload_key)
+  if upload.stored:
+    return None
+  blob_key = ChunkedUpload.blob.get_value_for_datastore(upload)
+  if blob_key is None:
+    if upload.received != upload.size:
+      raise OffsetError(upload.received)
+    try:
+      files.finalize(upload.file_name)
+    except files.FinalizationError:
+      pass  # By an earlier attempt.
+    blob_key = files.blobstore.get_blob_key(upload.file_name)
+
+  blob_info = blob_key and blobstore.BlobInfo.get(blob_key)
+  if (blob_info is None or blob_info.size != upload.size or
+      (upload.md5_hash and blob_info.md5_hash and
+       blob_info.md5_hash != upload.md5_hash)):
+    logging.error("Chunked upload %s finished corrupt", upload_key)
+    if blob_key is not None:
+      blobstore.delete(blob_key)
+    upload.delete()
+    raise Error('the finished file is corrupt')
+  upload.blob = blob_key
+  upload.put()
+  return blob_info
+
+
+def stored(upload_key):
+  """Records that a finished upload's blob was stored."""
+  upload = _get(upload_key)
+  upload.stored = True
+  upload.put()
+
+
+def discard(upload_key):
+  """Deletes an upload, and its blob unless it was stored."""
+  upload = db.get(upload_key)
+  if upload is None:
+    return
+  blob_key = ChunkedUpload.blob.get_value_for_datastore(upload)
+  if blob_key is not None and not upload.stored:
+    blobstore.delete(blob_key)
+  upload.delete()
+
+
+def sweep():
+  """Deletes uploads untouched for ABANDON_AFTER.  Returns how many.
+
+  Files of uploads never finished were never finalized, so there are no
+  blobs to delete for them.
+  """
+  too_old = datetime.datetime.now() - ABANDON_AFTER
+  count = 0
+  for upload in ChunkedUpload.all().filter('updated <', too_old).fetch(
+      SWEEP_BATCH_SIZE):
+    discard(upload.key())
+    count += 1
+  return count
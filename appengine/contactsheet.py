@@ -0,0 +1,148 @@
+#
+# scanningcabinet's AppEngine server-side code.
+#
+# Copyright 2009 Brad Fitzpatrick <brad@danga.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Contact sheets: a page of un-annotated scans as one tiled image.
+
+Rather than one thumbnail request per scan, the home page's raw scan
+grid loads a single composite of the whole page.  layout() gives each
+scan's cell in it, and the template shows each cell as a CSS sprite, so
+every scan keeps its own checkbox and link.
+
+Sheets are composited from the scans' pre-rendered 300px thumbnails
+(see processing.py), then scaled down to CELL_SIZE cells.  They are
+cached in memcache under the user's sheet generation and the ids on
+the sheet.  make_docs and break_docs bump the generation, since they
+change which scans are on every page.
+"""
+
+import hashlib
+import logging
+
+from google.appengine.api import images
+from google.appengine.api import memcache
+
+import imagecache
+
+COLUMNS = 8
+CELL_SIZE = 150  # displayed pixels per cell
+
+# Thumbnails are composited at this size, then the sheet is halved.
+SOURCE_SIZE = 300
+
+# The composite canvas is limited to 4000px a side.
+MAX_SCANS = COLUMNS * (4000 // SOURCE_SIZE)
+
+CACHE_SECONDS = 24 * 60 * 60
+
+# Cached sheets bigger than this don't fit in memcache.
+MAX_CACHED_BYTES = 1000 * 1000
+
+
+def _generation_key(user_key):
+  return 'contactsheet_gen:%s' % user_key
+
+
+def generation(user_key):
+  """Returns the user's current sheet generation."""
+  return memcache.get(_generation_key(user_key)) or 0
+
+
+def invalidate(user_key):
+  """Retires all of a user's cached sheets."""
+  memcache.incr(_generation_key(user_key), initial_value=0)
+
+
+def layout(count):
+  """Returns the (x, y) of each of count cells, in displayed pixels."""
+  return [((i % COLUMNS) * CELL_SIZE, (i // COLUMNS) * CELL_SIZE)
+          for i in range(count)]
+
+
+def sheet_size(count):
+  """Returns the displayed (width, height) of a sheet of count scans."""
+  rows = (count + COLUMNS - 1) // COLUMNS
+  return min(count, COLUMNS) * CELL_SIZE, rows * CELL_SIZE
+
+
+def get_sheet(user_key, media_objects):
+  """Returns JPEG data of a contact sheet of media_objects, in order.
+
+  media_objects must all be the user's, and at most MAX_SCANS.  A None
+  (deleted) entry leaves its cell blank.  Returns None if none of them
+  is an image.
+  """
+  digest = hashlib.sha1(','.join([
+      m and str(m.key().id()) or '-' for m in media_objects])).hexdigest()
+  cache_key = 'contactsheet:%s:%d:%s' % (user_key, generation(user_key),
+                                          digest)
+  data = memcache.get(cache_key)
+  if data is not None:
+    return data
+
+  data = render(media_objects)
+  if data is None:
+    return None
+  if len(data) <= MAX_CACHED_BYTES:
+    memcache.set(cache_key, data, time=CACHE_SECONDS)
+  else:
+    logging.info("Not caching %d byte contact sheet", len(data))
+  return data
+
+
+def render(media_objects):
+  """Composites media_objects' thumbnails into a sheet.
+
+  Returns:
+    JPEG data, or None if none of them is an image.
+  """
+  inputs = []
+  for i, media in enumerate(media_objects):
+    if media is None or not media.is_image:
+      continue
+    try:
+      thumb, unused_content_type = imagecache.get_resized(media, SOURCE_SIZE)
+      thumb_image = images.Image(image_data=thumb)
+      width, height = thumb_image.width, thumb_image.height
+    except images.Error:
+      logging.exception("No thumbnail of %s for contact sheet", media.key())
+      continue
+    # Centered in its cell.
+    x = (i % COLUMNS) * SOURCE_SIZE + (SOURCE_SIZE - width) // 2
+    y = (i // COLUMNS) * SOURCE_SIZE + (SOURCE_SIZE - height) // 2
+    inputs.append((thumb, x, y, 1.0, images.TOP_LEFT))
+
+  width, height = sheet_size(len(media_objects))
+  scale = SOURCE_SIZE // CELL_SIZE
+
+  # Only so many images fit in one composite call, so each later call
+  # starts with the sheet so far.
+  sheet = None
+  while inputs:
+    batch_size = images.MAX_COMPOSITES_PER_REQUEST
+    batch = []
+    if sheet is not None:
+      batch.append((sheet, 0, 0, 1.0, images.TOP_LEFT))
+      batch_size -= 1
+    batch.extend(inputs[:batch_size])
+    inputs = inputs[batch_size:]
+    sheet = images.composite(batch, width * scale, height * scale,
+                             color=0xffffffff, output_encoding=images.PNG)
+  if sheet is None:
+    return None
+  return images.resize(sheet, width=width, height=height,
+                       output_encoding=images.JPEG)
@@ -0,0 +1,159 @@
+#
+# scanningcabinet's AppEngine server-side code.
+#
+# Copyright 2009 Brad Fitzpatrick <brad@danga.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Sharded per-user counters of a library's size.
+
+Each user has NUM_SHARDS UserStatsShard entities, each holding part of
+every counter:
+
+  media: MediaObjects
+  bytes: total size of the MediaObjects
+  docs: Documents
+  untagged: Documents without tags
+
+An update adds to one shard, picked at random, in its own small
+transaction.  Shards are root entities, so updates neither contend with
+each other nor with writes to the user's entity group.  Reading the
+totals is one batch get of all the shards, cached in memcache until the
+next update.
+
+Most updates are made after the change they count has committed, so a
+request dying in between leaves a counter off by its delta; recount()
+sets them right from the datastore.  Uploads are stored by tasks that
+may die and be replayed (see journal.py), so store_uploads instead
+queues its updates with update_later(), in the transaction that stores
+the uploads.  The update is then made once the transaction commits, and
+only if it does.
+"""
+
+import logging
+import random
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+
+from model import Document
+from model import MediaObject
+from model import UserStatsShard
+
+NUM_SHARDS = 20
+
+COUNTERS = ('media', 'bytes', 'docs', 'untagged')
+
+QUEUE_NAME = 'counters'
+TASK_URL = '/tasks/count'
+
+# A read racing an update can cache totals missing it, for this long.
+CACHE_SECONDS = 10 * 60
+
+
+def _shard_keys(user_key):
+  return [db.Key.from_path('UserStatsShard', '%s:%d' % (user_key.name(), i))
+          for i in range(NUM_SHARDS)]
+
+
+def _memcache_key(user_key):
+  return 'counters:%s' % user_key
+
+
+def _nonzero(deltas):
+  """Returns deltas without the zero ones, checking their names."""
+  for name in deltas:
+    if name not in COUNTERS:
+      raise ValueError("Unknown counter %r" % name)
+  return dict((name, delta) for name, delta in deltas.items() if delta)
+
+
+def update(user_key, **deltas):
+  """Adds to a user's counters, e.g. update(key, media=1, bytes=1234)."""
+  deltas = _nonzero(deltas)
+  if not deltas:
+    return
+  shard_key = random.choice(_shard_keys(user_key))
+
+  def tx():
+    shard = db.get(shard_key)
+    if shard is None:
+      shard = UserStatsShard(key=shard_key)
+    for name, delta in deltas.items():
+      setattr(shard, name, getattr(shard, name) + delta)
+    shard.put()
+  db.run_in_transaction(tx)
+  memcache.delete(_memcache_key(user_key))
+
+
+def update_later(user_key, **deltas):
+  """Queues an update() to be made if the current transaction commits.
+
+  The task is retried until it succeeds, so the update is made at least
+  once.
+  """
+  deltas = _nonzero(deltas)
+  if not deltas:
+    return
+  params = dict((name, str(delta)) for name, delta in deltas.items())
+  params['user'] = str(user_key)
+  taskqueue.add(queue_name=QUEUE_NAME, url=TASK_URL, params=params,
+                transactional=True)
+
+
+def media_deltas(media_objects, sign=1):
+  """Returns update() arguments for adding (or, with sign=-1, removing)
+  MediaObjects."""
+  return {'media': sign * len(media_objects),
+          'bytes': sign * sum([m.size or 0 for m in media_objects])}
+
+
+def totals(user_key):
+  """Returns a dict of each of a user's counters."""
+  cache_key = _memcache_key(user_key)
+  result = memcache.get(cache_key)
+  if result is not None:
+    return result
+  result = dict((name, 0) for name in COUNTERS)
+  for shard in db.get(_shard_keys(user_key)):
+    if shard is not None:
+      for name in COUNTERS:
+        result[name] += getattr(shard, name)
+  memcache.add(cache_key, result, time=CACHE_SECONDS)
+  return result
+
+
+def recount(user_info):
+  """Recounts a user's counters from their MediaObjects and Documents.
+
+  Updates made while this runs may be lost; run it again to be sure.
+  """
+  user_key = user_info.key()
+  counts = dict((name, 0) for name in COUNTERS)
+  for media in MediaObject.all().ancestor(user_key):
+    counts['media'] += 1
+    counts['bytes'] += media.size or 0
+  for doc in Document.all().ancestor(user_key):
+    counts['docs'] += 1
+    if doc.no_tags:
+      counts['untagged'] += 1
+
+  shards = [UserStatsShard(key=key) for key in _shard_keys(user_key)]
+  for name, count in counts.items():
+    setattr(shards[0], name, count)
+  db.put(shards)
+  memcache.delete(_memcache_key(user_key))
+  logging.info("Recounted %s: %s", user_key.name(), counts)
+  return counts
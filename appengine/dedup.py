@@ -0,0 +1,296 @@
+#
+# scanningcabinet's AppEngine server-side code.
+#
+# Copyright 2009 Brad Fitzpatrick <brad@danga.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Content-addressed deduplication of uploaded scans.
+
+The blobstore computes an MD5 of every upload (BlobInfo.md5_hash), so
+nothing has to be read back to hash it.  Each user has a ContentHash per
+distinct content, pointing at the MediaObject first uploaded with it.
+ContentHashes live in the user's entity group and are written in the
+same transaction as the MediaObject.
+
+An upload whose content the user already has doesn't get a new
+MediaObject: store_uploads keeps the existing one and deletes the new
+blob.  (A stand-alone document upload does get its own MediaObject, but
+it shares the existing blob.)  Because blobs can be shared, a blob is
+only deleted once no MediaObject refers to it.
+
+A backfill run, a task chain like mediagc's, hashes the existing
+archive and merges the duplicates it finds:
+
+  - a duplicate that's not in a document is deleted;
+  - if only the original is un-annotated, the duplicate takes its place
+    in the index and the original is deleted;
+  - if both are pages of documents, the duplicate is pointed at the
+    original's blob and its own blob is deleted.
+
+A dry run still builds the index, but only counts duplicates.
+"""
+
+import datetime
+import logging
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import blobstore
+from google.appengine.ext import db
+
+import counters
+import imagecache
+from model import ContentHash
+from model import DedupRun
+from model import MediaObject
+
+QUEUE_NAME = 'gc'
+TASK_URL = '/tasks/dedup'
+
+BATCH_SIZE = 50
+
+
+def _hash_key(user_key, md5_hash):
+  return db.Key.from_path('ContentHash', 'md5:%s' % md5_hash,
+                          parent=user_key)
+
+
+def originals(user_key, md5_hashes):
+  """Returns {md5 hash: MediaObject} for content the user already has."""
+  md5_hashes = sorted(set([h for h in md5_hashes if h]))
+  if not md5_hashes:
+    return {}
+  hashes = db.get([_hash_key(user_key, h) for h in md5_hashes])
+  media_keys = [ContentHash.media.get_value_for_datastore(h)
+                for h in hashes if h is not None]
+  media = dict([(m.key(), m) for m in db.get(media_keys) if m is not None])
+  result = {}
+  for md5_hash, content_hash in zip(md5_hashes, hashes):
+    if content_hash is not None:
+      original = media.get(ContentHash.media.get_value_for_datastore(
+          content_hash))
+      if original is not None:
+        result[md5_hash] = original
+  return result
+
+
+def claim(user_key, media_objects):
+  """Returns ContentHashes making media objects the originals of their
+  content, for any content the user doesn't already have.
+
+  Must be called inside the transaction that writes the media objects.
+  One that lost a race with a concurrent upload of the same content
+  keeps its own copy; the next backfill merges the two.
+  """
+  existing = originals(user_key, [m.md5_hash for m in media_objects])
+  content_hashes = {}
+  for media in media_objects:
+    md5_hash = media.md5_hash
+    if md5_hash and md5_hash not in existing and (
+        md5_hash not in content_hashes):
+      content_hashes[md5_hash] = ContentHash(
+          key=_hash_key(user_key, md5_hash), media=media.key())
+  return content_hashes.values()
+
+
+def forget(media_objects):
+  """Drops the content hashes of media objects being deleted."""
+  media_keys = set([m.key() for m in media_objects])
+  hash_keys = [_hash_key(m.parent_key(), m.md5_hash)
+               for m in media_objects if m.md5_hash]
+  stale = [h for h in db.get(hash_keys) if h is not None and
+           ContentHash.media.get_value_for_datastore(h) in media_keys]
+  if stale:
+    db.delete(stale)
+
+
+def delete_unshared_blobs(user_key, blob_keys):
+  """Deletes those of the user's blobs none of their MediaObjects refers to.
+
+  Blobs are only ever shared by one user's MediaObjects, so this checks
+  their entity group, with ancestor queries.  Those are strongly
+  consistent, so a duplicate just pointed at the blob is always seen.
+  (mediagc.blob_referenced's global queries could miss it, and the blob
+  would be deleted from under it.)
+
+  Returns:
+    The keys of the blobs deleted.
+  """
+  shared = _shared_blobs(user_key, blob_keys)
+  unshared = [k for k in blob_keys if k not in shared]
+  if unshared:
+    blobstore.delete(unshared)
+  return unshared
+
+
+def _shared_blobs(user_key, blob_keys):
+  """Returns the set of the blobs any of the user's MediaObjects refers to.
+
+  The queries, two per blob, run concurrently.
+  """
+  runs = []
+  for blob_key in blob_keys:
+    # Pre-1.3.0 MediaObjects stored the blob key as a plain string.
+    for value in (blob_key, str(blob_key)):
+      query = MediaObject.all(keys_only=True).ancestor(user_key)
+      runs.append((blob_key, query.filter('blob', value).run(limit=1)))
+  return set([blob_key for blob_key, results in runs if list(results)])
+
+
+def start(dry_run):
+  """Starts a new backfill run.  Returns the DedupRun."""
+  run = DedupRun(dry_run=dry_run)
+  run.put()
+  _enqueue(run)
+  return run
+
+
+def resume(run):
+  """Re-queues the next batch of an interrupted run."""
+  if not run.done:
+    run.step += 1
+    run.put()
+    _enqueue(run)
+
+
+def latest_run():
+  """Returns the most recently started DedupRun, or None."""
+  return DedupRun.all().order('-started').get()
+
+
+def _enqueue(run):
+  # Named per step, so a retried task can't fork the chain in two.
+  try:
+    taskqueue.add(queue_name=QUEUE_NAME,
+                  url=TASK_URL,
+                  name='dedup-%d-%d' % (run.key().id(), run.step),
+                  params={'run': run.key().id()})
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass
+
+
+def run_step(run_id):
+  """Processes one batch of a run, checkpoints, and queues the next."""
+  run = DedupRun.get_by_id(run_id)
+  if run is None or run.done:
+    return
+
+  query = MediaObject.all()
+  if run.cursor:
+    query.with_cursor(run.cursor)
+  batch = query.fetch(BATCH_SIZE)
+  run.cursor = query.cursor()
+  run.media_scanned += len(batch)
+
+  with_blobs = [m for m in batch if m.blob is not None]
+  blob_infos = blobstore.BlobInfo.get([m.blob.key() for m in with_blobs])
+  for media, blob_info in zip(with_blobs, blob_infos):
+    if blob_info is not None and blob_info.md5_hash:
+      _dedup_one(run, media, blob_info)
+
+  if len(batch) < BATCH_SIZE:
+    run.done = True
+    run.finished = datetime.datetime.now()
+    logging.info("Dedup run %d done: %s", run_id, summary(run))
+  run.step += 1
+  run.put()
+  if not run.done:
+    _enqueue(run)
+
+
+def _in_document(media):
+  return MediaObject.document.get_value_for_datastore(media) is not None
+
+
+def _dedup_one(run, media, blob_info):
+  """Indexes one MediaObject's content, merging it if it's a duplicate."""
+  user_key = media.parent_key()
+  md5_hash = blob_info.md5_hash
+  hash_key = _hash_key(user_key, md5_hash)
+
+  def tx():
+    """Returns what happened, and the blob (or deleted MediaObject,
+    with its blob) that may be unreferenced now."""
+    current, content_hash = db.get([media.key(), hash_key])
+    if current is None:
+      return None, None
+    original = None
+    if content_hash is not None:
+      original = db.get(ContentHash.media.get_value_for_datastore(
+          content_hash))
+    if original is not None and original.key() == current.key():
+      return None, None  # Indexed already.
+    current.md5_hash = md5_hash
+    if original is None:
+      db.put([current, ContentHash(key=hash_key, media=current.key())])
+      return 'hashed', None
+    if original.blob.key() == current.blob.key():
+      return None, None  # Merged already.
+    if run.dry_run:
+      return 'duplicate', None
+
+    if _in_document(current) and _in_document(original):
+      freed = current.blob.key()
+      current.blob = original.blob.key()
+      db.put(current)
+      return 'shared', freed
+
+    if _in_document(current):
+      victim, keeper = original, current
+      db.put(ContentHash(key=hash_key, media=current.key()))
+    else:
+      victim, keeper = current, original
+    keeper.md5_hash = md5_hash
+    db.delete(victim)
+    db.put(keeper)
+    return 'deleted', victim
+
+  outcome, freed = db.run_in_transaction(tx)
+  if outcome is None:
+    return
+  if outcome == 'hashed':
+    run.media_hashed += 1
+    return
+  run.duplicates += 1
+  if outcome == 'deleted':
+    run.media_deleted += 1
+    counters.update(user_key, **counters.media_deltas([freed], -1))
+    imagecache.delete_variants([freed.key()])
+    freed = freed.blob.key()
+  if run.dry_run:
+    run.bytes_reclaimed += blob_info.size
+  elif freed is not None and delete_unshared_blobs(user_key, [freed]):
+    run.blobs_reclaimed += 1
+    run.bytes_reclaimed += blob_info.size
+
+
+def summary(run):
+  """Returns a dict of a run's progress and counts, for display.
+
+  In a dry run, bytes_reclaimed is what a real run would reclaim.
+  """
+  return {
+      'dry_run': run.dry_run,
+      'done': run.done,
+      'steps': run.step,
+      'started': run.started,
+      'updated': run.updated,
+      'finished': run.finished,
+      'media_scanned': run.media_scanned,
+      'media_hashed': run.media_hashed,
+      'duplicates': run.duplicates,
+      'media_deleted': run.media_deleted,
+      'blobs_reclaimed': run.blobs_reclaimed,
+      'bytes_reclaimed': run.bytes_reclaimed,
+      }
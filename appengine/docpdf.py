@@ -0,0 +1,282 @@
+#
+# scanningcabinet's AppEngine server-side code.
+#
+# Copyright 2009 Brad Fitzpatrick <brad@danga.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Whole Documents as PDFs, one scan per page.
+
+A PDF is written straight into a new blobstore blob with the Files API,
+one page at a time.  Each scan's JPEG data is copied into the PDF
+unchanged, as a DCTDecode image, CHUNK_BYTES at a time.  So memory use
+doesn't grow with the number of pages.  Scans that aren't JPEG are
+converted by the images API first, one page at a time.  The page size
+assumes the scans are DPI dots per inch, which is what scancab scans
+at.
+
+The finished PDF is kept as a DocumentPdf and served with send_blob
+until the document's list of pages changes.  Documents of more than
+INLINE_MAX_PAGES pages are built in a task rather than in the request.
+"""
+
+import hashlib
+import logging
+import struct
+import StringIO
+
+from google.appengine.api import files
+from google.appengine.api import images
+from google.appengine.api import taskqueue
+from google.appengine.ext import blobstore
+from google.appengine.ext import db
+
+from model import DocumentPdf
+from model import MediaObject
+
+DPI = 300
+
+# Bytes copied, and written to the Files API, at a time.
+CHUNK_BYTES = 512 * 1024
+
+# Bigger documents are built on the task queue.
+INLINE_MAX_PAGES = 10
+
+QUEUE_NAME = 'pdf'
+TASK_URL = '/tasks/build_pdf'
+
+_KEY_NAME = 'pdf'
+
+# JPEG start-of-frame markers, which hold the image dimensions.
+_SOF_MARKERS = frozenset(range(0xc0, 0xd0)) - frozenset([0xc4, 0xc8, 0xcc])
+
+_COLOR_SPACES = {1: '/DeviceGray', 3: '/DeviceRGB', 4: '/DeviceCMYK'}
+
+
+def _pdf_key(doc_key):
+  return db.Key.from_path('DocumentPdf', _KEY_NAME, parent=doc_key)
+
+
+def cached_pdf(doc):
+  """Returns the DocumentPdf for doc's current pages, or None."""
+  pdf = db.get(_pdf_key(doc.key()))
+  if pdf is None or pdf.pages != doc.pages:
+    return None
+  return pdf
+
+
+def enqueue_build(doc):
+  """Queues building doc's PDF, once per distinct list of pages."""
+  digest = hashlib.sha1(','.join([str(k) for k in doc.pages])).hexdigest()
+  try:
+    taskqueue.add(queue_name=QUEUE_NAME,
+                  url=TASK_URL,
+                  name='pdf-%d-%s' % (doc.key().id(), digest[:16]),
+                  params={'doc': str(doc.key())})
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass
+
+
+def forget(doc_keys):
+  """Deletes the PDFs of deleted documents."""
+  pdfs = [pdf for pdf in db.get([_pdf_key(k) for k in doc_keys]) if pdf]
+  if not pdfs:
+    return
+  blob_keys = [DocumentPdf.blob.get_value_for_datastore(p) for p in pdfs]
+  db.delete(pdfs)
+  blobstore.delete([k for k in blob_keys if k])
+
+
+def jpeg_info(reader):
+  """Returns (width, height, components) of a JPEG, or None.
+
+  Reads only as far as the frame header.
+  """
+  if reader.read(2) != '\xff\xd8':
+    return None
+  while True:
+    byte = reader.read(1)
+    if not byte:
+      return None
+    if byte != '\xff':
+      continue
+    marker = reader.read(1)
+    while marker == '\xff':  # Fill bytes.
+      marker = reader.read(1)
+    if not marker:
+      return None
+    marker = ord(marker)
+    if marker == 0x01 or 0xd0 <= marker <= 0xd8:
+      continue  # No length.
+    header = reader.read(2)
+    if len(header) < 2:
+      return None
+    length, = struct.unpack('>H', header)
+    if marker in _SOF_MARKERS:
+      frame = reader.read(6)
+      if len(frame) < 6:
+        return None
+      unused_precision, height, width, components = struct.unpack(
+          '>BHHB', frame)
+      return width, height, components
+    reader.seek(reader.tell() + length - 2)
+
+
+class _PdfWriter(object):
+  """Writes PDF objects to a file, remembering their offsets."""
+
+  def __init__(self, out):
+    self._out = out
+    self._buffer = []
+    self._buffered = 0
+    self.offset = 0
+    self.offsets = {}  # object number -> offset
+
+  def write(self, data):
+    # Flushed first if data would take it past CHUNK_BYTES, so no write
+    # to out is bigger than CHUNK_BYTES or the data itself.
+    if self._buffered + len(data) > CHUNK_BYTES:
+      self.flush()
+    self._buffer.append(data)
+    self._buffered += len(data)
+    self.offset += len(data)
+    if self._buffered >= CHUNK_BYTES:
+      self.flush()
+
+  def flush(self):
+    if self._buffer:
+      self._out.write(''.join(self._buffer))
+      self._buffer = []
+      self._buffered = 0
+
+  def begin(self, num):
+    self.offsets[num] = self.offset
+    self.write('%d 0 obj\n' % num)
+
+  def object(self, num, body):
+    self.begin(num)
+    self.write('%s\nendobj\n' % body)
+
+  def finish(self, root, num_objects):
+    """Writes the cross-reference table and trailer."""
+    xref = self.offset
+    self.write('xref\n0 %d\n0000000000 65535 f \n' % (num_objects + 1))
+    for num in range(1, num_objects + 1):
+      self.write('%010d 00000 n \n' % self.offsets[num])
+    self.write('trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n'
+               % (num_objects + 1, root, xref))
+    self.flush()
+
+
+def _page_image(media):
+  """Returns (reader, size, (width, height, components)) for a page.
+
+  reader is a file-like object of JPEG data.  Returns None if the page
+  can't be shown.
+  """
+  if media.guessed_type == 'image/jpeg':
+    reader = blobstore.BlobReader(media.blob.key(), buffer_size=CHUNK_BYTES)
+    size = media.blob.size
+  elif media.is_image:
+    image = images.Image(blob_key=str(media.blob.key()))
+    image.crop(0.0, 0.0, 1.0, 1.0)  # The API needs some transform.
+    data = image.execute_transforms(output_encoding=images.JPEG)
+    reader = StringIO.StringIO(data)
+    size = len(data)
+  else:
+    return None
+  info = jpeg_info(reader)
+  if info is None or info[2] not in _COLOR_SPACES:
+    return None
+  reader.seek(0)
+  return reader, size, info
+
+
+def write_pdf(out, pages):
+  """Writes a PDF of MediaObjects, one per page, to the file out."""
+  pdf = _PdfWriter(out)
+  pdf.write('%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+  # 1 is the catalog and 2 the page tree; each page is then an image, a
+  # content stream and a page object.
+  kids = []
+  num = 2
+  for media in pages:
+    page = media and _page_image(media)
+    if not page:
+      logging.info("Leaving %s out of PDF", media and media.key())
+      continue
+    reader, size, (width, height, components) = page
+    image_num, content_num, page_num = num + 1, num + 2, num + 3
+    num += 3
+
+    pdf.begin(image_num)
+    pdf.write('<< /Type /XObject /Subtype /Image /Width %d /Height %d '
+              '/ColorSpace %s /BitsPerComponent 8 /Filter /DCTDecode '
+              '/Length %d >>\nstream\n'
+              % (width, height, _COLOR_SPACES[components], size))
+    while True:
+      chunk = reader.read(CHUNK_BYTES)
+      if not chunk:
+        break
+      pdf.write(chunk)
+    pdf.write('\nendstream\nendobj\n')
+
+    points_wide = width * 72.0 / DPI
+    points_high = height * 72.0 / DPI
+    content = 'q %.2f 0 0 %.2f 0 0 cm /Im0 Do Q' % (points_wide, points_high)
+    pdf.object(content_num, '<< /Length %d >>\nstream\n%s\nendstream'
+               % (len(content), content))
+    pdf.object(page_num,
+               '<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %.2f %.2f] '
+               '/Resources << /XObject << /Im0 %d 0 R >> >> '
+               '/Contents %d 0 R >>'
+               % (points_wide, points_high, image_num, content_num))
+    kids.append(page_num)
+
+  pdf.object(2, '<< /Type /Pages /Kids [%s] /Count %d >>'
+             % (' '.join(['%d 0 R' % k for k in kids]), len(kids)))
+  pdf.object(1, '<< /Type /Catalog /Pages 2 0 R >>')
+  pdf.finish(1, num)
+  return pdf.offset
+
+
+def build(doc):
+  """Builds and stores the PDF of a document's current pages.
+
+  Returns:
+    The new DocumentPdf.
+  """
+  page_keys = list(doc.pages)
+  file_name = files.blobstore.create(
+      mime_type='application/pdf',
+      _blobinfo_uploaded_filename='doc-%d.pdf' % doc.key().id())
+  out = files.open(file_name, 'a')
+  try:
+    size = write_pdf(out, MediaObject.get(page_keys))
+  finally:
+    out.close()
+  files.finalize(file_name)
+  blob_key = files.blobstore.get_blob_key(file_name)
+
+  old = db.get(_pdf_key(doc.key()))
+  pdf = DocumentPdf(key=_pdf_key(doc.key()), blob=blob_key, pages=page_keys,
+                    size=size)
+  pdf.put()
+  if old is not None:
+    old_blob = DocumentPdf.blob.get_value_for_datastore(old)
+    if old_blob and old_blob != blob_key:
+      blobstore.delete(old_blob)
+  logging.info("Built %d byte PDF of document %d", size, doc.key().id())
+  return pdf
@@ -0,0 +1,143 @@
+#
+# scanningcabinet's AppEngine server-side code.
+#
+# Copyright 2009 Brad Fitzpatrick <brad@danga.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Export of a user's whole archive as NDJSON, one page at a time.
+
+Each /export request returns up to PAGE_SIZE records, one JSON object
+per line: first all of the user's documents ("kind": "document"), then
+all of their media ("kind": "media").  The last line is either
+{"kind": "next", "cursor": ...}, to be passed back as ?cursor= for the
+next page, or {"kind": "end"}.  A client that stops anywhere can resume
+from the last cursor it saw; tools/scancab --export does exactly that.
+"""
+
+try:
+  import json
+except ImportError:
+  from django.utils import simplejson as json
+
+from google.appengine.ext import db
+
+from model import Document
+from model import MediaObject
+
+PAGE_SIZE = 500
+
+# Phases, in order, and the model each walks.
+_PHASES = (('d', Document), ('m', MediaObject))
+
+
+def _timestamp(value):
+  if value is None:
+    return None
+  return value.isoformat()
+
+
+def document_record(doc):
+  return {
+      'kind': 'document',
+      'id': doc.key().id(),
+      'title': doc.title,
+      'description': doc.description,
+      'tags': doc.tags,
+      'doc_date': _timestamp(doc.doc_date),
+      'due_date': _timestamp(doc.due_date),
+      'physical_location': doc.physical_location,
+      'starred': doc.starred,
+      'creation': _timestamp(doc.creation),
+      'pages': [page.id() for page in doc.pages],
+      'preview': [page.id() for page in doc.preview],
+      }
+
+
+def media_record(media):
+  doc_key = MediaObject.document.get_value_for_datastore(media)
+  return {
+      'kind': 'media',
+      'id': media.key().id(),
+      'filename': media.filename,
+      'content_type': media.guessed_type,
+      'size': media.size,
+      'md5': media.md5_hash,
+      'width': media.width,
+      'height': media.height,
+      'creation': _timestamp(media.creation),
+      'document': doc_key and doc_key.id() or None,
+      'blob_url': '/export/blob/%d' % media.key().id(),
+      }
+
+
+def write_page(user_info, token, out, page_size=PAGE_SIZE):
+  """Writes one page of export records to out.
+
+  Args:
+    user_info: UserInfo whose archive to export.
+    token: cursor from the previous page's "next" line, or '' to start.
+    out: file-like object to write NDJSON lines to.
+    page_size: max records in this page.
+
+  Returns:
+    The token for the next page, or None when the export is complete.
+
+  Raises:
+    ValueError: the token is malformed.
+  """
+  phase = token and token[0] or _PHASES[0][0]
+  cursor = token and token[2:] or None
+  phase_names = [name for name, unused_model in _PHASES]
+  if phase not in phase_names:
+    raise ValueError('bad export cursor')
+
+  while True:
+    model = _PHASES[phase_names.index(phase)][1]
+    query = model.all().filter('owner', user_info)
+    if cursor:
+      try:
+        query.with_cursor(cursor)
+      except db.BadValueError:
+        raise ValueError('bad export cursor')
+    count = 0
+    for entity in query.run(batch_size=page_size, limit=page_size):
+      if model is Document:
+        record = document_record(entity)
+      else:
+        record = media_record(entity)
+      out.write(json.dumps(record))
+      out.write('\n')
+      count += 1
+
+    if count == page_size:
+      next_token = '%s:%s' % (phase, query.cursor())
+      break
+    # This phase is finished; on to the next, if any.
+    i = phase_names.index(phase) + 1
+    if i == len(phase_names):
+      next_token = None
+      break
+    phase, cursor = phase_names[i], None
+    page_size -= count
+    if page_size <= 0:
+      next_token = '%s:' % phase
+      break
+
+  if next_token:
+    out.write(json.dumps({'kind': 'next', 'cursor': next_token}))
+  else:
+    out.write(json.dumps({'kind': 'end'}))
+  out.write('\n')
+  return next_token
@@ -0,0 +1,297 @@
+#
+# scanningcabinet's AppEngine server-side code.
+#
+# Copyright 2009 Brad Fitzpatrick <brad@danga.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Cache of rendered variants (resizes, etc.) of MediaObject images.
+
+Resizing a full 300-dpi scan is slow, so each variant is rendered once,
+stored as a DerivedImage keyed by its MediaObject's key, and served
+directly from then on.  Requested sizes are snapped to a few buckets so
+we don't store one copy per distinct ?resize= value.  Total storage is
+kept under CACHE_BUDGET_BYTES by evicting the least recently used
+variants.
+
+Requests don't write the storage total, the ImageCacheUsage singleton:
+every miss would contend on it.  They add what they store and delete to
+counters in memcache, which flush_usage(), run from cron, folds into the
+singleton before evicting.  So the cache can run over budget by one
+cron interval's worth of renders, and a delta lost from memcache leaves
+the total off by that much.
+"""
+
+import datetime
+import logging
+import time
+
+from google.appengine.api import images
+from google.appengine.api import memcache
+from google.appengine.ext import db
+
+from model import DerivedImage
+from model import DerivedImageInfo
+from model import ImageCacheUsage
+
+# Sizes we actually render.  A request for any other size gets the
+# smallest bucket at least that big (or the largest bucket).
+SIZE_BUCKETS = (150, 300, 600, 800, 1200, 1600)
+
+# Total bytes of DerivedImage data to keep around.  When exceeded,
+# least recently used variants are deleted down to EVICT_TO_FRACTION of
+# the budget, so eviction doesn't run on every single miss.
+CACHE_BUDGET_BYTES = 512 * 1024 * 1024
+EVICT_TO_FRACTION = 0.9
+
+# Entities are limited to 1MB; bigger renders are served but not kept.
+MAX_VARIANT_BYTES = 1000 * 1000
+
+# last_access is only rewritten this often, since each touch is a put.
+LRU_TOUCH_INTERVAL = datetime.timedelta(hours=6)
+
+# Variants deleted per batch by evict() and delete_variants().
+DELETE_BATCH_SIZE = 100
+
+_USAGE_KEY_NAME = 'global'
+
+# Storage use changes not yet in ImageCacheUsage, as memcache counters.
+# Both directions count up, since memcache counters can't go negative.
+_PENDING_PREFIX = 'imagecache_usage:'
+_PENDING_NAMES = ('added_bytes', 'added_variants', 'freed_bytes',
+                  'freed_variants')
+
+_FORMATS = {
+    'jpeg': (images.JPEG, 'image/jpeg'),
+    'png': (images.PNG, 'image/png'),
+    }
+
+_STAT_NAMES = ('hits', 'misses', 'render_ms', 'saved_ms', 'evicted')
+
+
+def snap_size(size):
+  """Returns the size bucket to render for a requested size."""
+  for bucket in SIZE_BUCKETS:
+    if size <= bucket:
+      return bucket
+  return SIZE_BUCKETS[-1]
+
+
+def output_format(media_object):
+  """Returns the variant format ('jpeg' or 'png') for a media object.
+
+  JPEG scans stay JPEG; everything else (PNG lineart, TIFF, ...) is
+  rendered as PNG.
+  """
+  if media_object.guessed_type == 'image/jpeg':
+    return 'jpeg'
+  return 'png'
+
+
+def get_resized(media_object, size):
+  """Returns (data, content_type) of media_object resized to fit size."""
+  bucket = snap_size(size)
+  fmt = output_format(media_object)
+  blob_key = media_object.blob.key()
+
+  def render():
+    image = images.Image(blob_key=str(blob_key))
+    image.resize(width=bucket, height=bucket)
+    return image.execute_transforms(output_encoding=output_encoding(fmt))
+
+  return get_variant(media_object, 'r%d' % bucket, fmt, render)
+
+
+def output_encoding(fmt):
+  """Returns the images API encoding constant for a variant format."""
+  return _FORMATS[fmt][0]
+
+
+def get_variant(media_object, variant, fmt, render):
+  """Returns (data, content_type) for a variant, rendering it if needed.
+
+  Args:
+    media_object: MediaObject the variant is derived from.
+    variant: short name of the transform, e.g. 'r300'.
+    fmt: 'jpeg' or 'png'.
+    render: function returning the encoded image data, called on a miss.
+  """
+  key_name = variant_key_name(media_object.key(), variant, fmt)
+  content_type = _FORMATS[fmt][1]
+
+  cached, info = db.get([db.Key.from_path('DerivedImage', key_name),
+                         db.Key.from_path('DerivedImageInfo', key_name)])
+  if cached is not None:
+    _incr('hits')
+    _incr('saved_ms', cached.render_ms)
+    now = datetime.datetime.now()
+    if info is None:
+      info = DerivedImageInfo(key_name=key_name, size=len(cached.data))
+    if not info.last_access or now - info.last_access > LRU_TOUCH_INTERVAL:
+      info.last_access = now
+      info.put()
+    return cached.data, cached.content_type
+
+  start = time.time()
+  data = render()
+  render_ms = int((time.time() - start) * 1000)
+  _incr('misses')
+  _incr('render_ms', render_ms)
+
+  if len(data) > MAX_VARIANT_BYTES:
+    logging.info("Not caching %s: %d bytes", key_name, len(data))
+    return data, content_type
+
+  db.put([
+      DerivedImage(
+          key_name=key_name,
+          data=db.Blob(data),
+          content_type=content_type,
+          render_ms=render_ms),
+      DerivedImageInfo(
+          key_name=key_name,
+          size=len(data),
+          last_access=datetime.datetime.now())])
+  _note_usage('added', len(data), 1)
+  return data, content_type
+
+
+def variant_key_name(media_key, variant, fmt):
+  """Returns the key name of a MediaObject's cached variant."""
+  return '%s/%s.%s' % (media_key, variant, fmt)
+
+
+def delete_variants(media_keys):
+  """Deletes all cached variants of the given MediaObject keys."""
+  for media_key in media_keys:
+    # Every variant's key name starts with the media key, so they're a
+    # range of keys.
+    prefix = '%s/' % media_key
+    query = DerivedImageInfo.all()
+    query.filter('__key__ >=', db.Key.from_path('DerivedImageInfo', prefix))
+    query.filter('__key__ <',
+                 db.Key.from_path('DerivedImageInfo', prefix + u'\ufffd'))
+    while True:
+      infos = query.fetch(DELETE_BATCH_SIZE)
+      if infos:
+        _delete(infos)
+        _note_usage('freed', sum(info.size for info in infos), len(infos))
+      if len(infos) < DELETE_BATCH_SIZE:
+        break
+      query.with_cursor(query.cursor())
+
+
+def flush_usage():
+  """Applies the noted storage use changes, then evicts if over budget.
+
+  Run from cron.
+
+  Returns:
+    The total bytes stored, before any eviction.
+  """
+  pending = memcache.get_multi(_PENDING_NAMES, key_prefix=_PENDING_PREFIX)
+  pending = dict((name, int(pending.get(name) or 0))
+                 for name in _PENDING_NAMES)
+  total = _adjust_usage(pending['added_bytes'] - pending['freed_bytes'],
+                        pending['added_variants'] - pending['freed_variants'])
+  # Only now, so a failed flush leaves them to the next one.  Changes
+  # noted in the meantime stay pending.
+  for name, amount in pending.items():
+    if amount:
+      memcache.decr(_PENDING_PREFIX + name, amount)
+  if total > CACHE_BUDGET_BYTES:
+    evict()
+  return total
+
+
+def evict():
+  """Deletes least recently used variants until under budget."""
+  usage = ImageCacheUsage.get_by_key_name(_USAGE_KEY_NAME)
+  if usage is None:
+    return
+  to_free = usage.total_bytes - int(CACHE_BUDGET_BYTES * EVICT_TO_FRACTION)
+  freed = 0
+  evicted = 0
+  query = DerivedImageInfo.all().order('last_access')
+  while freed < to_free:
+    victims = []
+    for info in query.fetch(DELETE_BATCH_SIZE):
+      if freed >= to_free:
+        break
+      victims.append(info)
+      freed += info.size
+    if not victims:
+      break
+    query.with_cursor(query.cursor())
+    _delete(victims)
+    # Per batch, so a request that dies partway still counts what it
+    # deleted.
+    _adjust_usage(-sum(info.size for info in victims), -len(victims))
+    evicted += len(victims)
+  if not evicted:
+    return
+  _incr('evicted', evicted)
+  logging.info("Evicted %d cached variants, %d bytes", evicted, freed)
+
+
+def stats():
+  """Returns a dict of cache counters and storage usage."""
+  values = memcache.get_multi(_STAT_NAMES, key_prefix='imagecache:')
+  result = dict((name, values.get(name, 0)) for name in _STAT_NAMES)
+  pending = memcache.get_multi(_PENDING_NAMES, key_prefix=_PENDING_PREFIX)
+  for name in _PENDING_NAMES:
+    result['pending_' + name] = pending.get(name, 0)
+  usage = ImageCacheUsage.get_by_key_name(_USAGE_KEY_NAME)
+  result['total_bytes'] = usage and usage.total_bytes or 0
+  result['variants'] = usage and usage.variants or 0
+  result['budget_bytes'] = CACHE_BUDGET_BYTES
+  return result
+
+
+def _delete(infos):
+  """Deletes the given DerivedImageInfos and their DerivedImages."""
+  keys = []
+  for info in infos:
+    keys.append(info.key())
+    keys.append(db.Key.from_path('DerivedImage', info.key().name()))
+  db.delete(keys)
+
+
+def _incr(name, delta=1):
+  if delta:
+    memcache.incr('imagecache:' + name, delta, initial_value=0)
+
+
+def _note_usage(direction, size, count):
+  """Adds to the 'added' or 'freed' storage use counters in memcache."""
+  for name, amount in (('bytes', size), ('variants', count)):
+    if amount:
+      memcache.incr('%s%s_%s' % (_PENDING_PREFIX, direction, name), amount,
+                    initial_value=0)
+
+
+def _adjust_usage(delta_bytes, delta_variants):
+  """Transactionally adjusts the usage singleton.  Returns new total.
+
+  Only for flush_usage() and evict(); see the module docstring.
+  """
+  def tx():
+    usage = ImageCacheUsage.get_by_key_name(_USAGE_KEY_NAME)
+    if usage is None:
+      usage = ImageCacheUsage(key_name=_USAGE_KEY_NAME)
+    usage.total_bytes = max(0, usage.total_bytes + delta_bytes)
+    usage.variants = max(0, usage.variants + delta_variants)
+    usage.put()
+    return usage.total_bytes
+  return db.run_in_transaction(tx)
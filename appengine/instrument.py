@@ -0,0 +1,305 @@
+#
+# scanningcabinet's AppEngine server-side code.
+#
+# Copyright 2009 Brad Fitzpatrick <brad@danga.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Per-request timings and API call counts, by handler.
+
+Middleware wraps the WSGI application and records, for each request:
+its handler (found from the same routing table), wall time, time in
+each phase, and the number of API calls and time spent in them by
+service.  Phases are functions wrapped in timed(), e.g. 'auth' for
+get_user_info, 'queries' for the home page fetch, 'render' for template
+rendering and 'blob_send' for send_blob.  API calls are seen through
+apiproxy pre- and post-call hooks.
+
+Requests slower than SLOW_REQUEST_MS are logged with their breakdown
+and the datastore queries they ran.  Every request is also added to
+per-handler counters in memcache, one offset_multi call per request,
+which stats() turns into latency histograms for /admin/instrument.
+Memcache may evict these; they are only meant to show where time goes.
+
+The first request an instance serves is its cold start.  The time it
+took to load the application and that first request's time are logged
+and counted separately (startup_stats()), so that startup regressions
+don't hide among the warm requests.
+"""
+
+import logging
+import re
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+
+SLOW_REQUEST_MS = 1000
+
+# Upper bounds, in ms, of the latency histogram buckets.  Slower
+# requests go in a last, unbounded bucket.
+BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# Services whose calls are counted separately in the aggregates.
+SERVICES = ('datastore_v3', 'blobstore', 'memcache', 'images', 'taskqueue')
+
+PHASES = ('auth', 'queries', 'render', 'blob_send')
+
+_KEY_PREFIX = 'instrument:'
+
+_local = threading.local()
+
+
+class _RequestStats(object):
+  """What one request has done so far."""
+
+  def __init__(self, handler):
+    self.handler = handler
+    self.start = time.time()
+    self.phase_ms = {}
+    self.active = set()  # Phases being timed, so nesting counts once.
+    self.calls = {}  # service -> count
+    self.call_ms = {}  # service -> ms
+    self.queries = []  # (description, ms)
+    self.pending = {}  # id(response) -> start time
+
+
+def _current():
+  return getattr(_local, 'stats', None)
+
+
+def timed(phase):
+  """Decorator timing a function as one phase of the current request."""
+  def decorate(function):
+    def wrapper(*args, **kwargs):
+      stats = _current()
+      if stats is None or phase in stats.active:
+        return function(*args, **kwargs)
+      stats.active.add(phase)
+      start = time.time()
+      try:
+        return function(*args, **kwargs)
+      finally:
+        stats.active.discard(phase)
+        stats.phase_ms[phase] = (stats.phase_ms.get(phase, 0) +
+                                 (time.time() - start) * 1000)
+    wrapper.__name__ = function.__name__
+    wrapper.__doc__ = function.__doc__
+    return wrapper
+  return decorate
+
+
+def _describe_query(request):
+  """Returns a short description of a datastore_pb.Query."""
+  try:
+    parts = [request.kind()]
+    if request.has_ancestor():
+      parts.append('ancestor')
+    for f in request.filter_list():
+      parts.append('%s %d' % (f.property(0).name(), f.op()))
+    for order in request.order_list():
+      parts.append('order %s%s' % (order.direction() == 2 and '-' or '',
+                                   order.property()))
+    return ', '.join(parts)
+  except Exception:
+    return '?'
+
+
+def _pre_call(service, call, request, response, *unused_args):
+  stats = _current()
+  if stats is None:
+    return
+  stats.calls[service] = stats.calls.get(service, 0) + 1
+  stats.pending[id(response)] = time.time()
+
+
+def _post_call(service, call, request, response, *unused_args):
+  stats = _current()
+  if stats is None:
+    return
+  start = stats.pending.pop(id(response), None)
+  if start is None:
+    return
+  ms = (time.time() - start) * 1000
+  stats.call_ms[service] = stats.call_ms.get(service, 0) + ms
+  if service == 'datastore_v3' and call == 'RunQuery':
+    stats.queries.append((_describe_query(request), ms))
+
+
+def install_hooks():
+  """Installs the API call hooks, once per process."""
+  if getattr(install_hooks, 'done', False):
+    return
+  apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+      'instrument', _pre_call)
+  apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+      'instrument', _post_call)
+  install_hooks.done = True
+
+
+def _bucket(ms):
+  for i, bound in enumerate(BUCKETS_MS):
+    if ms <= bound:
+      return i
+  return len(BUCKETS_MS)
+
+
+class Middleware(object):
+  """WSGI middleware instrumenting each request to an application."""
+
+  def __init__(self, application, routes, load_start=None):
+    """Wraps application.
+
+    Args:
+      application: the WSGI application.
+      routes: the application's list of (regexp, handler class).
+      load_start: time.time() when the instance started loading the
+        application, if known.
+    """
+    self.application = application
+    self.routes = [(re.compile('^%s$' % regexp), handler.__name__)
+                   for regexp, handler in routes]
+    self.load_ms = None
+    if load_start is not None:
+      self.load_ms = (time.time() - load_start) * 1000
+    self.cold = True
+    install_hooks()
+
+  def handler_name(self, path):
+    for regexp, name in self.routes:
+      if regexp.match(path):
+        return name
+    return 'unknown'
+
+  def __call__(self, environ, start_response):
+    stats = _RequestStats(self.handler_name(environ.get('PATH_INFO', '/')))
+    statuses = []
+    def capture_status(status, headers, exc_info=None):
+      statuses.append(status)
+      return start_response(status, headers, exc_info)
+    cold, self.cold = self.cold, False
+    _local.stats = stats
+    try:
+      return self.application(environ, capture_status)
+    finally:
+      _local.stats = None
+      self.finish(stats, environ, statuses and statuses[-1] or '', cold)
+
+  def finish(self, stats, environ, status, cold):
+    ms = (time.time() - stats.start) * 1000
+    if ms > SLOW_REQUEST_MS:
+      lines = ["Slow request: %s %s (%s) %s, %.0f ms" % (
+          environ.get('REQUEST_METHOD'), environ.get('PATH_INFO'),
+          stats.handler, status, ms)]
+      for phase in sorted(stats.phase_ms):
+        lines.append("  phase %s: %.0f ms" % (phase, stats.phase_ms[phase]))
+      for service in sorted(stats.calls):
+        lines.append("  %s: %d calls, %.0f ms" % (
+            service, stats.calls[service], stats.call_ms.get(service, 0)))
+      for description, query_ms in stats.queries:
+        lines.append("  query %s: %.0f ms" % (description, query_ms))
+      logging.warning('\n'.join(lines))
+
+    prefix = stats.handler + ':'
+    offsets = {
+        prefix + 'count': 1,
+        prefix + 'ms': int(ms),
+        prefix + 'b%d' % _bucket(ms): 1,
+        }
+    for phase, phase_ms in stats.phase_ms.items():
+      offsets[prefix + 'phase:' + phase] = int(phase_ms)
+    for service, count in stats.calls.items():
+      if service in SERVICES:
+        offsets[prefix + 'calls:' + service] = count
+    if cold:
+      logging.info("Cold start: loaded in %s ms, first request (%s) %.0f ms",
+                   self.load_ms is None and '?' or '%.0f' % self.load_ms,
+                   stats.handler, ms)
+      offsets['startup:count'] = 1
+      offsets['startup:first_request_ms'] = int(ms)
+      if self.load_ms is not None:
+        offsets['startup:load_ms'] = int(self.load_ms)
+    try:
+      memcache.offset_multi(offsets, key_prefix=_KEY_PREFIX, initial_value=0)
+    except Exception:
+      logging.exception("Couldn't record request stats")
+
+
+def startup_stats():
+  """Returns a dict of instance starts and their mean load_ms and
+  first_request_ms."""
+  names = ('count', 'load_ms', 'first_request_ms')
+  values = memcache.get_multi(names, key_prefix=_KEY_PREFIX + 'startup:')
+  count = int(values.get('count', 0))
+  result = {'count': count, 'load_ms': 0.0, 'first_request_ms': 0.0}
+  if count:
+    for name in ('load_ms', 'first_request_ms'):
+      result[name] = int(values.get(name, 0)) / float(count)
+  return result
+
+
+def _percentile(buckets, count, fraction):
+  """Returns the upper bound, in ms, of the bucket holding a percentile."""
+  seen = 0
+  for i, n in enumerate(buckets):
+    seen += n
+    if seen >= fraction * count:
+      if i < len(BUCKETS_MS):
+        return '<=%d' % BUCKETS_MS[i]
+      return '>%d' % BUCKETS_MS[-1]
+  return '-'
+
+
+def stats(handlers):
+  """Returns aggregates for handler names, busiest first.
+
+  Returns:
+    List of dicts with 'handler', 'count', 'mean_ms', 'p50', 'p90' and
+    'p99' (bucket bounds), 'buckets' (counts per BUCKETS_MS bucket),
+    'phases' and 'calls' (means per request).
+  """
+  names = []
+  for handler in handlers:
+    prefix = handler + ':'
+    names.extend([prefix + 'count', prefix + 'ms'])
+    names.extend([prefix + 'b%d' % i for i in range(len(BUCKETS_MS) + 1)])
+    names.extend([prefix + 'phase:' + phase for phase in PHASES])
+    names.extend([prefix + 'calls:' + service for service in SERVICES])
+  values = memcache.get_multi(names, key_prefix=_KEY_PREFIX)
+
+  result = []
+  for handler in set(handlers):
+    prefix = handler + ':'
+    count = int(values.get(prefix + 'count', 0))
+    if not count:
+      continue
+    buckets = [int(values.get(prefix + 'b%d' % i, 0))
+               for i in range(len(BUCKETS_MS) + 1)]
+    result.append({
+        'handler': handler,
+        'count': count,
+        'mean_ms': int(values.get(prefix + 'ms', 0)) / float(count),
+        'p50': _percentile(buckets, count, 0.5),
+        'p90': _percentile(buckets, count, 0.9),
+        'p99': _percentile(buckets, count, 0.99),
+        'buckets': buckets,
+        'phases': dict((phase, int(values.get(prefix + 'phase:' + phase, 0)) /
+                        float(count)) for phase in PHASES),
+        'calls': dict((service,
+                       int(values.get(prefix + 'calls:' + service, 0)) /
+                       float(count)) for service in SERVICES),
+        })
+  result.sort(key=lambda h: -h['count'])
+  return result
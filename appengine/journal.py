@@ -0,0 +1,240 @@
+#
+# scanningcabinet's AppEngine server-side code.
+#
+# Copyright 2009 Brad Fitzpatrick <brad@danga.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Write-behind journal of uploads, stored in the background.
+
+All of a user's MediaObjects and Documents are in their UserInfo's
+entity group, so /post requests storing into it directly contend with
+each other during a burst upload.  Instead, /post appends an
+IngestEntry and returns.  The entry is a root entity, in no user's
+group, listing the uploaded blobs and the MediaObject ids allocated for
+them.
+
+A committer task per user then takes the user's pending entries, oldest
+first, and folds runs of them into store_uploads calls of up to
+FOLD_MAX_FILES files, stored UPLOAD_GROUP_SIZE per transaction.  An
+entry is deleted only once it's stored.  Its ids were fixed when it was
+appended, so storing it again after a crash or task retry finds its
+MediaObjects already there and stores nothing twice.
+
+Committer tasks are named by user and COMMIT_DELAY window, so a burst
+of uploads is committed by a few tasks rather than one per upload.
+Entries a task misses (its query is only eventually consistent) are
+picked up by the user's next task, or by the periodic sweep().
+"""
+
+import datetime
+import hashlib
+import logging
+import time
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import blobstore
+from google.appengine.ext import db
+
+from model import IngestEntry
+
+# Seconds of uploads each committer task takes in.
+COMMIT_DELAY = 2
+
+# Most files stored by one store_uploads call.
+FOLD_MAX_FILES = 200
+
+# Most entries one task commits; it queues another for the rest.
+MAX_ENTRIES_PER_TASK = 100
+
+QUEUE_NAME = 'ingest'
+TASK_URL = '/tasks/ingest'
+
+_STAT_NAMES = ('appended', 'committed', 'errors', 'lag_ms')
+
+_LAST_ERROR_KEY = 'journal:last_error'
+
+
+def append(user_email, blob_infos, doc_fields=None):
+  """Journals uploaded blobs for storing, and queues their commit.
+
+  Args:
+    user_email: email of the owning user.
+    blob_infos: BlobInfos of the uploaded files.
+    doc_fields: as for store_uploads.
+
+  Returns:
+    The new IngestEntry.
+  """
+  user_key = db.Key.from_path('UserInfo', 'user:%s' % user_email)
+  first_id, unused = db.allocate_ids(
+      db.Key.from_path('MediaObject', 1, parent=user_key), len(blob_infos))
+  entry = IngestEntry(user_email=user_email,
+                      blobs=[b.key() for b in blob_infos],
+                      media_ids=range(first_id, first_id + len(blob_infos)))
+  if doc_fields is not None:
+    entry.doc_id, unused = db.allocate_ids(
+        db.Key.from_path('Document', 1, parent=user_key), 1)
+    entry.doc_title = doc_fields.get("title")
+    entry.doc_description = doc_fields.get("description")
+    entry.doc_tags = doc_fields.get("tags")
+  entry.put()
+  _incr('appended')
+  enqueue(user_email)
+  return entry
+
+
+def enqueue(user_email):
+  """Queues a committer task for a user, unless one is already due."""
+  now = time.time()
+  window = int(now) // COMMIT_DELAY
+  digest = hashlib.sha1(user_email.encode('utf-8')).hexdigest()
+  # Run after the window closes, so the task sees all of its entries.
+  countdown = max(0, (window + 2) * COMMIT_DELAY - now)
+  try:
+    taskqueue.add(queue_name=QUEUE_NAME,
+                  url=TASK_URL,
+                  name='ingest-%s-%d' % (digest[:16], window),
+                  countdown=countdown,
+                  params={'user': user_email})
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass
+
+
+def _folds(entries):
+  """Splits entries into runs to store with one store_uploads call each.
+
+  A document entry goes alone, since store_uploads makes a document of
+  a single file only.
+  """
+  folds = []
+  files = 0
+  for entry in entries:
+    if (not folds or entry.doc_id is not None or
+        folds[-1][-1].doc_id is not None or
+        files + len(entry.blobs) > FOLD_MAX_FILES):
+      folds.append([])
+      files = 0
+    folds[-1].append(entry)
+    files += len(entry.blobs)
+  return folds
+
+
+def commit(user_email, store):
+  """Stores a user's pending uploads, oldest first.
+
+  Args:
+    user_email: the user whose entries to commit.
+    store: main.store_uploads.  (main imports this module.)
+
+  Returns:
+    The number of entries committed.
+  """
+  entries = IngestEntry.all().filter('user_email', user_email).order(
+      'created').fetch(MAX_ENTRIES_PER_TASK)
+  for fold in _folds(entries):
+    _commit_fold(user_email, fold, store)
+  if len(entries) == MAX_ENTRIES_PER_TASK:
+    enqueue(user_email)
+  return len(entries)
+
+
+def _commit_fold(user_email, fold, store):
+  blob_keys = []
+  media_ids = []
+  for entry in fold:
+    blob_keys.extend(entry.blobs)
+    media_ids.extend(entry.media_ids)
+  # A blob can be gone if a replay's earlier run stored it as a
+  # duplicate; its MediaObject, if any, is stored already.
+  present = [(blob_info, media_id) for blob_info, media_id
+             in zip(blobstore.BlobInfo.get(blob_keys), media_ids)
+             if blob_info is not None]
+
+  if present:
+    first = fold[0]
+    doc_fields = None
+    if first.doc_id is not None:
+      doc_fields = {
+          "title": first.doc_title,
+          "description": first.doc_description,
+          "tags": first.doc_tags,
+          }
+    error_messages = []
+    store(user_email, [blob_info for blob_info, unused in present],
+          error_messages, doc_fields,
+          media_ids=[media_id for unused, media_id in present],
+          doc_id=first.doc_id)
+    if error_messages:
+      # /post has long since returned, so this is the only place the
+      # error shows: the log, and stats() for /admin/journal.
+      message = "Dropping %d journaled uploads of %s: %s" % (
+          len(present), user_email, '; '.join(error_messages))
+      logging.error(message)
+      _incr('errors', len(fold))
+      memcache.set(_LAST_ERROR_KEY,
+                   '%s %s' % (datetime.datetime.now().isoformat(), message))
+      blobstore.delete([blob_info.key() for blob_info, unused in present])
+
+  db.delete(fold)
+  now = datetime.datetime.now()
+  lag = now - fold[0].created
+  _incr('committed', len(fold))
+  _incr('lag_ms', sum([_ms(now - entry.created) for entry in fold]))
+  logging.info("Committed %d journaled uploads of %s, %d files, lag %s",
+               len(fold), user_email, len(present), lag)
+
+
+def sweep():
+  """Queues a committer for every user with pending entries."""
+  emails = set()
+  for entry in IngestEntry.all().order('created').fetch(1000):
+    emails.add(entry.user_email)
+  for user_email in emails:
+    enqueue(user_email)
+  return len(emails)
+
+
+def stats():
+  """Returns a dict of journal counters and current lag.
+
+  pending is the number of uncommitted entries (counted up to 1000),
+  oldest_age_ms the age of the oldest, lag_ms the total time committed
+  entries spent in the journal, and errors the number of entries
+  dropped because they couldn't be stored.
+  """
+  values = memcache.get_multi(_STAT_NAMES, key_prefix='journal:')
+  result = dict((name, values.get(name, 0)) for name in _STAT_NAMES)
+  result['pending'] = IngestEntry.all(keys_only=True).count(1000)
+  oldest = IngestEntry.all().order('created').get()
+  result['oldest_age_ms'] = 0
+  if oldest is not None:
+    result['oldest_age_ms'] = _ms(datetime.datetime.now() - oldest.created)
+  return result
+
+
+def last_error():
+  """Returns the latest store error, with its time, or None."""
+  return memcache.get(_LAST_ERROR_KEY)
+
+
+def _ms(delta):
+  return (delta.days * 86400 + delta.seconds) * 1000 + \
+      delta.microseconds // 1000
+
+
+def _incr(name, delta=1):
+  if delta:
+    memcache.incr('journal:' + name, delta, initial_value=0)
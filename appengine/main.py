@@ -18,29 +18,74 @@
 # limitations under the License.
 #
 
+import calendar
 import cgi
 import datetime
 import logging
 import os
 import re
+import sys
 import time
 import urllib
 
-from google.appengine.api import images
+# When this instance started loading the app, for its cold start time.
+_LOAD_START = time.time()
+
+from google.appengine.api import memcache
 from google.appengine.api import users
 from google.appengine.ext import blobstore
 from google.appengine.ext import db
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp import blobstore_handlers
 from google.appengine.ext.webapp import template
-
-
-import wsgiref.handlers
-
+from google.appengine.ext.webapp.util import run_wsgi_app
+
+import chunked
+import contactsheet
+import counters
+import dedup
+import docpdf
+import export
+import imagecache
+import instrument
+import journal
+import mediagc
+import pagecheck
+import paging
+import processing
+import tagindex
+import textsearch
+import tiles
+import timeline
+import usercache
+from model import ChunkedUpload
 from model import UserInfo
 from model import Document
+from model import DocumentPdf
 from model import MediaObject
 
+# Tracebacks in error pages, and templates re-read on every render,
+# only on the dev_appserver.
+DEBUG = os.environ.get('SERVER_SOFTWARE', '').startswith('Development')
+
+TEMPLATE_DIR = os.path.dirname(__file__)
+
+# Upper bound on how long a cached home view may be served.  Writes
+# invalidate it explicitly; this just bounds staleness if one is missed.
+HOME_VIEW_CACHE_SECONDS = 10 * 60
+
+# Sections of the home page, each paged independently.
+HOME_SECTIONS = ('media', 'docs', 'untagged', 'due')
+UPCOMING_DUE_PAGE_SIZE = 30
+
+# Most upload URLs handed out by one /uploadurl?count= request.
+MAX_UPLOAD_URLS = 100
+
+# MediaObjects committed per transaction in a multi-file upload.
+UPLOAD_GROUP_SIZE = 50
+
+_SCAN_FILENAME_RE = re.compile(r'^image-(\d+)(?:\.\w+)?-unx(\d+)')
+
 def parse_timestamp(stamp):
   """Parse timestamp to datetime object.
 
@@ -59,6 +104,24 @@ def parse_timestamp(stamp):
   return datetime.datetime(*params)
 
 
+@instrument.timed('render')
+def render_template(name, values):
+  """Renders one of the templates in this directory.
+
+  Outside DEBUG, webapp's template module compiles each template once
+  per instance and keeps it.
+  """
+  return template.render(os.path.join(TEMPLATE_DIR, name), values,
+                         debug=DEBUG)
+
+
+@instrument.timed('blob_send')
+def send_blob(handler, blob_key, content_type):
+  """Has a BlobstoreDownloadHandler send a blob as its response."""
+  handler.send_blob(blob_key, content_type)
+
+
+@instrument.timed('auth')
 def get_user_info():
   """Get UserInfo for currently logged in user.
 
@@ -79,9 +142,9 @@ def get_user_info():
     effective_email = 'bradfitz@gmail.com'
 
   if auth_email == effective_email:
-    ui = UserInfo.get_or_insert(key_name='user:%s' % auth_email)
+    ui = usercache.get('user:%s' % auth_email, create=True)
   else:
-    ui = UserInfo.get_by_key_name('user:%s' % effective_email)
+    ui = usercache.get('user:%s' % effective_email)
     if not ui:
       logging.error("User %s failed to act as %s; %s doesn't exist", auth_email, effective_email, effective_email)
       return None
@@ -91,6 +154,153 @@ def get_user_info():
   return ui
 
 
+def _ordered(query, reverse, *props):
+  """Orders query by props then __key__, or by the exact reverse."""
+  for prop in props + ('__key__',):
+    if reverse:
+      prop = '-' + prop
+    query.order(prop)
+  return query
+
+
+def home_view_queries(user_info):
+  """Returns make_query(reverse) functions for the home page sections.
+
+  The queries are ancestor queries, so strongly consistent: their results
+  are cached for HOME_VIEW_CACHE_SECONDS, and a stale one would stay
+  that long.
+
+  Returns:
+    Dict from section name ('media', 'docs', 'untagged', 'due') to a
+    function suitable for paging.fetch_pages.
+  """
+  def media(reverse):
+    q = MediaObject.all().ancestor(user_info)
+    q.filter('lacks_document', True)
+    return _ordered(q, reverse, 'creation')
+
+  def docs(reverse):
+    return _ordered(Document.all().ancestor(user_info), reverse)
+
+  def untagged(reverse):
+    q = Document.all().ancestor(user_info).filter("no_tags", True)
+    return _ordered(q, reverse)
+
+  def due(reverse):
+    q = Document.all().ancestor(user_info)
+    # Not "!= None": that's a MultiQuery, which has no cursors.  None
+    # sorts before every date.
+    q.filter("due_date >=", datetime.datetime.min)
+    return _ordered(q, reverse, 'due_date')
+
+  return {'media': media, 'docs': docs, 'untagged': untagged, 'due': due}
+
+
+@instrument.timed('queries')
+def fetch_home_view(user_info, page_size, tokens, tag_query=None,
+                    text_query=None):
+  """Fetches one page of each home page section, concurrently.
+
+  Args:
+    user_info: UserInfo whose media and documents to show.
+    page_size: results per page in each section but 'due'.
+    tokens: dict from section name to page token ('' for first page).
+    tag_query: optional tagindex query restricting the 'docs' section.
+    text_query: optional textsearch query restricting and ranking the
+      'docs' section.
+
+  Returns:
+    Dict from section name to paging.Page, plus 'tag_cloud'.
+  """
+  searching = tag_query or text_query
+  queries = home_view_queries(user_info)
+  names = [name for name in HOME_SECTIONS
+           if not (searching and name == 'docs')]
+  pages = paging.fetch_pages([
+      (queries[name],
+       name == 'due' and UPCOMING_DUE_PAGE_SIZE or page_size,
+       tokens.get(name, ''))
+      for name in names])
+  view = dict(zip(names, pages))
+  if searching:
+    view['docs'] = search_page(user_info, tag_query, text_query, page_size,
+                               tokens.get('docs', ''))
+  view['tag_cloud'] = tagindex.tag_cloud(user_info.key())
+  return view
+
+
+@instrument.timed('queries')
+def search_page(user_info, tag_query, text_query, page_size, token):
+  """Returns a paging.Page of the Documents matching a search.
+
+  Args:
+    user_info: UserInfo whose documents to search.
+    tag_query: tagindex query, or empty.
+    text_query: textsearch query, or empty.  Determines result order
+      when given.
+    page_size: documents per page.
+    token: page token from a previous page, or ''.
+
+  The whole result is a list of ids from the indexes, so the page
+  token is just an offset into it.
+  """
+  if text_query:
+    ids = textsearch.search(user_info.key(), text_query)
+    if tag_query:
+      tagged = set(tagindex.search(user_info.key(), tag_query))
+      ids = [doc_id for doc_id in ids if doc_id in tagged]
+  else:
+    ids = tagindex.search(user_info.key(), tag_query)
+  try:
+    offset = max(0, int(token or 0))
+  except ValueError:
+    offset = 0
+  docs = Document.get_by_id(ids[offset:offset + page_size], parent=user_info)
+  next_token = None
+  if offset + page_size < len(ids):
+    next_token = str(offset + page_size)
+  prev_token = None
+  if offset:
+    prev_token = str(max(0, offset - page_size))
+  return paging.Page([d for d in docs if d], next_token, prev_token)
+
+
+def _home_view_generation_key(user_key):
+  return 'homeview_gen:%s' % user_key
+
+
+@instrument.timed('queries')
+def get_home_view(user_info, page_size):
+  """Returns the first page of each un-searched home page section.
+
+  The result is cached in memcache until invalidate_home_view is called
+  for the user, so an ordinary page load is one memcache read instead
+  of four datastore queries.
+
+  Returns:
+    Dict from section name to paging.Page, plus 'tag_cloud'.
+  """
+  user_key = user_info.key()
+  generation = memcache.get(_home_view_generation_key(user_key)) or 0
+  cache_key = 'homeview:%s:%d:%d' % (user_key, generation, page_size)
+  view = memcache.get(cache_key)
+  if view is not None:
+    return view
+
+  view = fetch_home_view(user_info, page_size, {})
+  memcache.set(cache_key, view, time=HOME_VIEW_CACHE_SECONDS)
+  return view
+
+
+def invalidate_home_view(user_key):
+  """Drops the cached home view after any write to a user's media/docs.
+
+  Bumps the user's generation number rather than deleting keys, since
+  there's one cached view per distinct limit.
+  """
+  memcache.incr(_home_view_generation_key(user_key), initial_value=0)
+
+
 class MainHandler(webapp.RequestHandler):
   """Handler for main page.
 
@@ -117,29 +327,21 @@ class MainHandler(webapp.RequestHandler):
     view_user = user_info  # for now
     did_search = False
 
-    # Fetch media for view user.
-    media = MediaObject.all().filter('owner', user_info)
-    media = media.filter('lacks_document', True)
-    media = media.order('creation')
-    limit = 50
-    if self.request.get("limit"):
-      limit = long(self.request.get("limit"))
-    media = media.fetch(limit)
-
-    docs = Document.all().filter('owner', user_info)
+    page_size = paging.clamp_page_size(self.request.get("limit"), 50)
+    tokens = dict((name, self.request.get(name + "_cursor"))
+                  for name in HOME_SECTIONS)
     tags = self.request.get("tags")
-    if tags:
-      did_search = True
-      for tag in re.split('\s*,\s*', tags):
-        docs = docs.filter("tags", tag)
-    docs = docs.fetch(limit)
+    text_query = self.request.get("q")
 
-    untagged_docs = Document.all().filter('owner', user_info).filter("no_tags", True).fetch(limit)
-
-    upcoming_due = Document.all().filter('owner', user_info)
-    upcoming_due = upcoming_due.filter("due_date !=", None)
-    upcoming_due = upcoming_due.order("due_date")
-    upcoming_due = upcoming_due.fetch(30)
+    if user_info is None:
+      view = dict((name, paging.Page([], None, None))
+                  for name in HOME_SECTIONS)
+      view['tag_cloud'] = []
+    elif tags or text_query or [t for t in tokens.values() if t]:
+      did_search = bool(tags or text_query)
+      view = fetch_home_view(user_info, page_size, tokens, tags, text_query)
+    else:
+      view = get_home_view(user_info, page_size)
 
     top_message = ""
     if self.request.get("saved_doc"):
@@ -147,42 +349,259 @@ class MainHandler(webapp.RequestHandler):
       top_message = "Saved <a href='/doc/%d'>doc %d</a>" % (docid, docid)
 
     # Render view.
-    self.response.out.write(template.render('main.html', {
+    media = view['media'].items
+    sheet = None
+    if user_info is not None and 0 < len(media) <= contactsheet.MAX_SCANS:
+      sheet = self.contact_sheet(user_info, media)
+    self.response.out.write(render_template('main.html', {
         "did_search": did_search,
         "media": media,
-        "docs": docs,
-        "untagged_docs": untagged_docs,
-        "upcoming_due_docs": upcoming_due,
+        "blank_count": len([item for item in media if item.blank]),
+        "sheet": sheet,
+        "docs": view['docs'].items,
+        "untagged_docs": view['untagged'].items,
+        "upcoming_due_docs": view['due'].items,
+        "nav": self.page_links(view),
+        "tags": tags,
+        "text_query": text_query,
+        "tag_cloud": view['tag_cloud'],
         "view_user": view_user,
         "login_url": login_url,
         "user_info": user_info,
         "top_message": top_message,
-        }, debug=True))
+        }))
 
+  def contact_sheet(self, user_info, media):
+    """Returns the template's contact sheet for a page of scans.
 
-class MakeDocHandler(webapp.RequestHandler):
-  def post(self):
-    user_info = get_user_info()
-    if user_info is None:
-      self.redirect('/?error_message=%s' % 'log-in required')
-    scan_ids = self.request.get_all("media_id")
-    scans = MediaObject.get(scan_ids)
+    A dict with the sheet's "url", "width" and "height", and "cells": a
+    dict per scan with its "item" and its "x" and "y" in the sheet.
+    """
+    ids = ','.join([str(item.key().id()) for item in media])
+    width, height = contactsheet.sheet_size(len(media))
+    return {
+        "url": '/contactsheet?%s' % urllib.urlencode({
+            'ids': ids,
+            'gen': contactsheet.generation(user_info.key())}),
+        "width": width,
+        "height": height,
+        "cells": [{"item": item, "x": x, "y": y} for item, (x, y) in
+                  zip(media, contactsheet.layout(len(media)))],
+        }
+
+  def page_links(self, view):
+    """Returns {section: {'next': url, 'prev': url}} for the template.
+
+    Each link keeps the other query parameters (tags, limit, other
+    sections' cursors) and replaces only that section's cursor.
+    """
+    links = {}
+    for name in HOME_SECTIONS:
+      page = view[name]
+      links[name] = {
+          'next': page.next_token and self.url_with(name, page.next_token),
+          'prev': page.prev_token and self.url_with(name, page.prev_token),
+          }
+    return links
+
+  def url_with(self, section, token):
+    params = [(k, v) for k, v in self.request.GET.items()
+              if k not in (section + '_cursor', 'saved_doc', 'error_message')]
+    params.append((section + '_cursor', token))
+    return '/?' + urllib.urlencode([(k, unicode(v).encode('utf-8'))
+                                    for k, v in params])
+
+
+def make_docs(user_info, scan_groups):
+  """Creates one Document per group of scans, in a single transaction.
+
+  Document ids are allocated up front so the documents and all their
+  pages go out in one db.put.  The scans are re-read in the transaction,
+  so a scan another request has put in a document meanwhile isn't put
+  in a second one.
+
+  Args:
+    user_info: UserInfo owning the scans.
+    scan_groups: list of lists of MediaObjects, one list per document.
+
+  Returns:
+    The new Documents.
+
+  Raises:
+    ValueError: if a scan is in more than one group, or is gone or
+      already in a document.
+  """
+  user_key = user_info.key()
+  scan_keys = [scan.key() for scans in scan_groups for scan in scans]
+  if len(set(scan_keys)) != len(scan_keys):
+    raise ValueError('a scan is in more than one document')
+  first_id, unused_last_id = db.allocate_ids(
+      db.Key.from_path('Document', 1, parent=user_key), len(scan_groups))
+  docs = []
+  doc_keys = []
+  for i, scans in enumerate(scan_groups):
     doc = Document(
-        parent=user_info,
+        key=db.Key.from_path('Document', first_id + i, parent=user_key),
         owner=user_info,
         pages=[scan.key() for scan in scans],
         title=None,
         description=None)
-    def make_doc():
-      db.put(doc)
-      for scan in scans:
-        scan.lacks_document = False
-        scan.document = doc.key()
-        db.put(scan)
-    db.run_in_transaction(make_doc)
+    docs.append(doc)
+    doc_keys.extend([doc.key()] * len(scans))
+  def tx():
+    scans = db.get(scan_keys)
+    for scan_key, scan in zip(scan_keys, scans):
+      if scan is None or not scan.lacks_document:
+        raise ValueError('scan %s is gone or already in a document'
+                         % scan_key.id_or_name())
+    for scan, doc_key in zip(scans, doc_keys):
+      scan.lacks_document = False
+      scan.document = doc_key
+    db.put(docs + scans)
+  db.run_in_transaction(tx)
+  # New documents have no tags yet.
+  counters.update(user_key, docs=len(docs), untagged=len(docs))
+  invalidate_home_view(user_key)
+  contactsheet.invalidate(user_key)
+  return docs
+
+
+def lookup_scans(user_info, media_ids):
+  """Returns the user's MediaObjects for a list of ids, in one get.
+
+  Args:
+    user_info: UserInfo owning the scans.
+    media_ids: numeric ids or string keys of MediaObjects.
+
+  Returns:
+    List of MediaObjects, or None if any is missing or not the user's.
+  """
+  keys = []
+  for media_id in media_ids:
+    if media_id.isdigit():
+      keys.append(db.Key.from_path('MediaObject', long(media_id),
+                                   parent=user_info.key()))
+    else:
+      try:
+        keys.append(db.Key(media_id))
+      except db.BadKeyError:
+        return None
+  if not keys or [k for k in keys if k.kind() != 'MediaObject']:
+    return None
+  scans = db.get(keys)
+  for scan in scans:
+    if scan is None or scan.parent_key() != user_info.key():
+      return None
+  return scans
+
+
+class MakeDocHandler(webapp.RequestHandler):
+  def post(self):
+    user_info = get_user_info()
+    if user_info is None:
+      self.redirect('/?error_message=%s' % 'log-in required')
+      return
+    scans = lookup_scans(user_info, self.request.get_all("media_id"))
+    if not scans:
+      self.redirect('/?error_message=%s' % 'Unidentified+object')
+      return
+    try:
+      doc, = make_docs(user_info, [scans])
+    except ValueError:
+      self.redirect('/?error_message=%s' % 'Already+in+a+document')
+      return
     self.redirect(doc.display_url + "?size=1200")
 
 
+class DeleteBlankHandler(webapp.RequestHandler):
+  """Deletes the user's un-annotated scans flagged as blank pages.
+
+  Deletes one batch here, and any more in tasks; see
+  pagecheck.delete_blank.
+  """
+
+  def post(self):
+    user_info = get_user_info()
+    if user_info is None:
+      self.redirect('/?error_message=%s' % 'log-in required')
+      return
+    if pagecheck.delete_blank(user_info.key()):
+      invalidate_home_view(user_info.key())
+      contactsheet.invalidate(user_info.key())
+    self.redirect('/')
+
+
+class DeleteBlankTaskHandler(webapp.RequestHandler):
+  """Task queue worker deleting the next batch of a user's blank pages."""
+
+  def post(self):
+    user_key = db.Key(self.request.get("user"))
+    if pagecheck.delete_blank(user_key):
+      invalidate_home_view(user_key)
+      contactsheet.invalidate(user_key)
+
+
+class BulkDocHandler(webapp.RequestHandler):
+  """Creates and/or breaks many documents in one request.
+
+  Parameters:
+    group: repeated; comma-separated MediaObject ids making up one new
+        document, in page order.
+    break: repeated; ids of documents to break back into raw scans.
+    user_email, password: as for /uploadurl, if not logged in.
+
+  Responds with one line per document, "created <id>" or "broke <id>".
+  Documents are broken before any are created, so a group may use the
+  scans of a document broken in the same request.  A 400 after some
+  "broke" lines means those were broken but no document was created.
+  """
+
+  def post(self):
+    user_info = get_request_user(self)
+    if user_info is None:
+      self.error(403)
+      return
+
+    scan_groups = []
+    for group in self.request.get_all("group"):
+      scans = lookup_scans(user_info, [x for x in re.split(r'\s*,\s*',
+                                                           group) if x])
+      if not scans:
+        self.error(400)
+        self.response.out.write("Bad group: %s\n" % group)
+        return
+      scan_groups.append(scans)
+
+    try:
+      break_ids = [long(x) for x in self.request.get_all("break")]
+    except ValueError:
+      self.error(400)
+      self.response.out.write("Bad document id in: %s\n" %
+                              self.request.get_all("break"))
+      return
+    docs_to_break = Document.get_by_id(break_ids, parent=user_info)
+    if None in docs_to_break:
+      self.error(400)
+      self.response.out.write("Unknown document in: %s\n" % break_ids)
+      return
+
+    self.response.headers['Content-Type'] = 'text/plain'
+    if docs_to_break:
+      break_docs(user_info, docs_to_break)
+      for doc in docs_to_break:
+        self.response.out.write("broke %d\n" % doc.key().id())
+    if scan_groups:
+      try:
+        docs = make_docs(user_info, scan_groups)
+      except ValueError:
+        # Not self.error(), which would clear the "broke" lines.
+        self.response.set_status(400)
+        self.response.out.write("Bad group: %s\n" % sys.exc_info()[1])
+        return
+      for doc in docs:
+        self.response.out.write("created %d\n" % doc.key().id())
+
+
 class UploadFormHandler(webapp.RequestHandler):
   """Handler to display the media object upload page.
 
@@ -199,15 +618,14 @@ class UploadFormHandler(webapp.RequestHandler):
     upload_url = blobstore.create_upload_url(
         '/post')
 
-    self.response.out.write(template.render('upload.html',
-                                            locals(),
-                                            debug=True))
+    self.response.out.write(render_template('upload.html', locals()))
 
 
+@instrument.timed('auth')
 def lookup_and_authenticate_user(handler, claimed_email, claimed_password):
   if not claimed_email:
     return None
-  claimed_user = UserInfo.get_by_key_name('user:%s' % claimed_email)
+  claimed_user = usercache.get('user:%s' % claimed_email)
   if not claimed_user:
     return None
   if claimed_email == 'test@example.com' and \
@@ -220,11 +638,26 @@ def lookup_and_authenticate_user(handler, claimed_email, claimed_password):
   return None
 
 
+def get_request_user(handler):
+  """Returns the UserInfo for a logged-in user or a script.
+
+  Scripts (tools/scancab) aren't logged in, and pass user_email and
+  password parameters instead.
+  """
+  user_info = get_user_info()
+  if user_info is None:
+    user_info = lookup_and_authenticate_user(
+        handler, handler.request.get("user_email"),
+        handler.request.get("password"))
+  return user_info
+
+
 class UploadUrlHandler(webapp.RequestHandler):
   """Handler to return a URL for a script to get an upload URL.
 
   This must be a dynamic page because the upload URL must be generated
-  by the Blobstore API.
+  by the Blobstore API.  With ?count=N, returns N URLs, one per line, so
+  a script can upload many batches without coming back here each time.
   """
 
   def get(self):
@@ -233,120 +666,259 @@ class UploadUrlHandler(webapp.RequestHandler):
                                                   self.request.get("password"))
 
     if effective_user:
+      count = paging.clamp_page_size(self.request.get("count"), 1)
+      count = min(count, MAX_UPLOAD_URLS)
       self.response.headers['Content-Type'] = 'text/plain'
-      upload_url = blobstore.create_upload_url('/post')
-      self.response.out.write(upload_url)
+      for unused in range(count):
+        upload_url = blobstore.create_upload_url('/post')
+        self.response.out.write(upload_url + "\n")
     else:
       self.error(403)
 
 
-class UploadPostHandler(blobstore_handlers.BlobstoreUploadHandler):
-  """Handle blobstore post, as forwarded by notification agent."""
+def scan_time(blob_info):
+  """Returns when an uploaded file was scanned.
 
-  def store_media(self, upload_files, error_messages):
-    """Store media information.
+  scancab names queued scans image-NNNN-unxTTTTTTTTTT.jpg (or, for
+  single scans, image-NNNN.jpg-unxTTTTTTTTTT.jpg).  TTTTTTTTTT is the
+  unix time and NNNN counts up within a batch, which breaks ties within
+  the same second.  Anything else falls back to the blob's creation time.
+  """
+  match = _SCAN_FILENAME_RE.match(blob_info.filename or '')
+  if not match:
+    return blob_info.creation
+  number, unixtime = match.groups()
+  return (datetime.datetime.utcfromtimestamp(int(unixtime)) +
+          datetime.timedelta(microseconds=int(number)))
 
-    Writes a MediaObject to the datastore for the uploaded file.
 
-    Args:
-      upload_files: List of BlobInfo records representing the uploads.
-      error_messages: Empty list for storing error messages to report to user.
-    """
-    if not upload_files:
-      error_messages.append('Form is missing upload file field')
+def store_uploads(user_email, blob_infos, error_messages, doc_fields=None,
+                  media_ids=None, doc_id=None):
+  """Writes MediaObjects for uploaded blobs, in scan order.
 
-    if len(upload_files) != 1:
-      error_messages.append('Form has more than one image.')
+  The files are sorted by scan_time and given strictly increasing
+  creation times, since that's how un-annotated scans are ordered.  They
+  are committed UPLOAD_GROUP_SIZE at a time, one transaction per group.
 
-    def get_param(name, error_message=None):
-      """Convenience function to get a parameter from request.
+  Files whose content the user already has are deduplicated (see
+  dedup.py): the existing MediaObject is kept and the new blob deleted.
 
-      Returns:
-        String value of field if it exists, else ''.  If the key does not exist
-        at all, it will return None.
-      """
-      try:
-        value = self.request.params[name]
-        if isinstance(value, cgi.FieldStorage):
-          value = value.value
-        return value or ''
-      except KeyError:
-        #error_messages.append(error_message)
-        return None
+  Args:
+    user_email: email of the owning user.
+    blob_infos: BlobInfos of the uploaded files.
+    error_messages: list to append errors for the user to.
+    doc_fields: for a single file only, an optional dict with "title",
+      "description" and "tags" (comma-separated) to also make a
+      one-page Document of it.
+    media_ids: optional ids, from db.allocate_ids, for each file's
+      MediaObject.  Files whose MediaObject exists already are taken as
+      stored, so storing the same journal entry (see journal.py) twice
+      stores each file once.
+    doc_id: optional allocated id for the Document, likewise.
 
-    # Check that title, description and share fields provided.  Do additional
-    # constraint check on share to make sure it is valid.
-    width = get_param('width')
-    height = get_param('height')
-
-    # title and description are only legit for single-page doc
-    is_doc = get_param('is_doc')  # is a stand-alone single-page doc?
-    title = get_param('title')
-    description = get_param('description')
-    tags = get_param('tags')  # comma-separated
-
-    # Make sure user is logged in.
-    user = users.get_current_user()
-    user_email = ''
-    if user is None:
-      claimed_email = get_param("user_email")
-      effective_user = lookup_and_authenticate_user(self, claimed_email, get_param('password'))
-      if not effective_user:
-        error_messages.append("No user or correct 'password' argument.")
-      user_email = claimed_email
-    else:
-      user_email = user.email()
+  Returns:
+    The MediaObjects, in order: new ones, and existing ones in place of
+    duplicates.
+  """
+  user_key = db.Key.from_path('UserInfo', 'user:%s' % user_email)
+  ordered = [(scan_time(b), b.filename, i, b)
+             for i, b in enumerate(blob_infos)]
+  ordered.sort()
+
+  # Keys are allocated up front so a page and its document go out in
+  # one put.
+  replay = media_ids is not None
+  if not replay:
+    first_id, unused = db.allocate_ids(
+        db.Key.from_path('MediaObject', 1, parent=user_key), len(ordered))
+    media_ids = range(first_id, first_id + len(ordered))
+  media_keys = [db.Key.from_path('MediaObject', media_id, parent=user_key)
+                for media_id in media_ids]
+  stored_already = {}
+  if replay:
+    for media in db.get(media_keys):
+      if media is not None:
+        stored_already[media.key()] = media
+  if doc_fields is not None:
+    if doc_id is None:
+      doc_id, unused = db.allocate_ids(
+          db.Key.from_path('Document', 1, parent=user_key), 1)
+    tag_list = [x for x in re.split('\s*,\s*', doc_fields.get("tags") or '')
+                if x]
+
+  originals = dedup.originals(user_key, [b.md5_hash for b in blob_infos])
+  duplicate_blobs = []
+
+  creation = None
+  media_objects = []
+  results = []
+  for when, unused_filename, i, blob_info in ordered:
+    if media_keys[i] in stored_already:
+      results.append(stored_already[media_keys[i]])
+      continue
+    md5_hash = blob_info.md5_hash
+    original = md5_hash and originals.get(md5_hash)
+    if original:
+      # The same blob twice (say, a retried /chunked finish journaled
+      # it again) is a duplicate of itself; its blob must stay.
+      if original.blob.key() != blob_info.key():
+        duplicate_blobs.append(blob_info.key())
+      if doc_fields is None:
+        results.append(original)
+        continue
+    if creation is not None and when <= creation:
+      when = creation + datetime.timedelta(microseconds=1)
+    creation = when
+    media = MediaObject(
+        key=media_keys[i],
+        owner=user_key,
+        blob=original and original.blob.key() or blob_info.key(),
+        md5_hash=md5_hash,
+        creation=creation,
+        content_type=blob_info.content_type,
+        filename=blob_info.filename,
+        size=int(blob_info.size),
+        lacks_document=True,
+        processing_state='pending')
+    if md5_hash and not original:
+      originals[md5_hash] = media  # Repeats within this upload.
+    media_objects.append(media)
+    results.append(media)
+
+  def store_group(group):
+    """Stores one group of media objects.
+
+    This function is run as a transaction.
+
+    Returns:
+      True if stored, None if already stored, False on error.
+    """
+    user_info = UserInfo.get_by_key_name('user:%s' % user_email)
+    if user_info is None:
+      error_messages.append('User record has been deleted.  '
+                            'Try uploading again')
+      return False
+    if replay and [m for m in db.get([g.key() for g in group]) if m]:
+      return None  # By a concurrent run of the same journal entry.
+    to_put = group + dedup.claim(user_key, group)
+
+    if doc_id is not None:
+      media, = group
+      doc = Document(
+          key=db.Key.from_path('Document', doc_id, parent=user_key),
+          owner=user_info,
+          pages=[media.key()],
+          title=doc_fields.get("title"),
+          description=doc_fields.get("description"),
+          no_tags=(len(tag_list)==0),
+          tags=tag_list)
+      media.document = doc.key()
+      media.lacks_document = False
+      to_put.append(doc)
+      tagindex.update_document_tags(user_key, doc_id, [], tag_list)
+      textsearch.update_document(user_key, doc_id,
+                                 {}, textsearch.document_terms(doc))
+
+    db.put(to_put)
+    processing.enqueue([m.key() for m in group], transactional=True)
+    # Counted in the same transaction, so a replay that finds the group
+    # stored already neither counts it again nor misses it.
+    deltas = counters.media_deltas(group)
+    if doc_id is not None:
+      deltas['docs'] = 1
+      deltas['untagged'] = int(not tag_list)
+    counters.update_later(user_key, **deltas)
+    return True
+
+  stored = True
+  for start in range(0, len(media_objects), UPLOAD_GROUP_SIZE):
+    group = media_objects[start:start + UPLOAD_GROUP_SIZE]
+    result = db.run_in_transaction(store_group, group)
+    if result is False:
+      stored = False
+      break
+    if result is None:
+      logging.info("Group of %d uploads for %s was already stored",
+                   len(group), user_email)
+      continue
+  invalidate_home_view(user_key)
+  if not stored:
+    return []
+  if duplicate_blobs:
+    logging.info("Dropped %d duplicate uploads for %s",
+                 len(duplicate_blobs), user_email)
+    blobstore.delete(duplicate_blobs)
+  return results
+
+
+def store_media(handler, upload_files, error_messages):
+  """Store media information.
+
+  Journals the uploaded files, to be written as MediaObjects in the
+  background (see journal.py).
 
-    if error_messages:
-      return
+  Args:
+    handler: the RequestHandler, for its request's parameters.
+    upload_files: List of BlobInfo records representing the uploads.
+    error_messages: Empty list for storing error messages to report to user.
+  """
+  if not upload_files:
+    error_messages.append('Form is missing upload file field')
+
+  def get_param(name, error_message=None):
+    """Convenience function to get a parameter from request.
 
-    blob_info, = upload_files
+    Returns:
+      String value of field if it exists, else ''.  If the key does not exist
+      at all, it will return None.
+    """
+    try:
+      value = handler.request.params[name]
+      if isinstance(value, cgi.FieldStorage):
+        value = value.value
+      return value or ''
+    except KeyError:
+      #error_messages.append(error_message)
+      return None
 
-    def store_media():
-      """Store media object info in datastore.
+  # title and description are only legit for single-page doc
+  is_doc = get_param('is_doc')  # is a stand-alone single-page doc?
+  doc_fields = None
+  if bool(is_doc) and is_doc != "0":
+    if len(upload_files) != 1:
+      error_messages.append('Only a single file can be a stand-alone doc.')
+    doc_fields = {
+        "title": get_param('title'),
+        "description": get_param('description'),
+        "tags": get_param('tags'),  # comma-separated
+        }
+
+  # Make sure user is logged in.
+  user = users.get_current_user()
+  user_email = ''
+  if user is None:
+    claimed_email = get_param("user_email")
+    effective_user = lookup_and_authenticate_user(handler, claimed_email, get_param('password'))
+    if not effective_user:
+      error_messages.append("No user or correct 'password' argument.")
+    user_email = claimed_email
+  else:
+    user_email = user.email()
 
-      Also updates the user-info record to keep count of media objects.
+  if error_messages:
+    return
 
-      This function is run as a transaction.
-      """
-      user_info = UserInfo.get_by_key_name('user:%s' % user_email)
-      if user_info is None:
-        error_messages.append('User record has been deleted.  '
-                              'Try uploading again')
-        return
+  journal.append(user_email, upload_files, doc_fields)
 
-      media = MediaObject(
-          parent=user_info,
-          owner=user_info,
-          blob=blob_info.key(),
-          creation=blob_info.creation,
-          content_type=blob_info.content_type,
-          filename=blob_info.filename,
-          size=int(blob_info.size),
-          lacks_document=True)
-
-      user_info.media_objects += 1
-      db.put(user_info)
-      db.put(media)
-
-      if bool(is_doc) and is_doc != "0":
-        tag_list = []
-        if tags is not None:
-          tag_list = [x for x in re.split('\s*,\s*', tags) if x]
-
-        doc = Document(
-            parent=user_info,
-            owner=user_info,
-            pages=[media.key()],
-            title=title,
-            description=description,
-            no_tags=(len(tag_list)==0),
-            tags=tag_list)
-        db.put(doc)
-        media.document = doc.key()
-        media.lacks_document = False
-        db.put(media)
-    db.run_in_transaction(store_media)
+
+class UploadPostHandler(blobstore_handlers.BlobstoreUploadHandler):
+  """Handle blobstore post, as forwarded by notification agent.
+
+  The uploads are journaled and stored in the background (see
+  journal.py), so the redirect only reports errors in the request
+  itself.  Errors storing the uploads later are logged and shown on
+  /admin/journal.
+  """
 
   def post(self):
     """Do upload post."""
@@ -354,7 +926,7 @@ class UploadPostHandler(blobstore_handlers.BlobstoreUploadHandler):
 
     upload_files = self.get_uploads('file')
 
-    self.store_media(upload_files, error_messages)
+    store_media(self, upload_files, error_messages)
 
     error_messages = tuple(urllib.quote(m) for m in error_messages)
     error_messages = tuple('error_message=%s' % m for m in error_messages)
@@ -365,6 +937,214 @@ class UploadPostHandler(blobstore_handlers.BlobstoreUploadHandler):
       blobstore.delete(upload_files)
 
 
+class ChunkedUploadHandler(webapp.RequestHandler):
+  """Resumable uploads for scripts; see chunked.py.
+
+  POST /chunked, with filename, size, and optionally content_type and
+  md5 (hex, of the whole file), starts an upload.  GET /chunked/<id>
+  says how much of it has been received.  PUT /chunked/<id>?offset=N
+  appends the request body, whose hex MD5 is the md5 parameter.
+
+  Every request takes user_email and password, as for /uploadurl, and
+  gets back "name value" lines: id, chunk_size and received.  After a
+  409, the client should resume from received.  Other 4xx errors mean
+  it should start the upload over.
+  """
+
+  def post(self):
+    user_info = get_request_user(self)
+    if user_info is None:
+      self.error(403)
+      return
+    try:
+      size = int(self.request.get("size"))
+    except ValueError:
+      size = 0
+    try:
+      upload = chunked.start(user_info, self.request.get("filename"), size,
+                             self.request.get("content_type"),
+                             self.request.get("md5"))
+    except chunked.Error:
+      self.fail_with_error(None)
+      return
+    self.write_status(upload.key().id(), upload.received)
+
+  def get(self, upload_id):
+    upload = self.lookup(upload_id)
+    if upload is not None:
+      self.write_status(upload.key().id(), upload.received)
+
+  def put(self, upload_id):
+    upload = self.lookup(upload_id)
+    if upload is None:
+      return
+    try:
+      received = chunked.append(upload.key(), int(self.request.get("offset")),
+                                self.request.body, self.request.get("md5"))
+    except ValueError:
+      self.error(400)
+      return
+    except chunked.Error:
+      self.fail_with_error(upload.key().id())
+      return
+    self.write_status(upload.key().id(), received)
+
+  def lookup(self, upload_id):
+    """Returns the user's ChunkedUpload, or None after an error."""
+    user_info = get_request_user(self)
+    if user_info is None:
+      self.error(403)
+      return None
+    upload = ChunkedUpload.get_by_id(long(upload_id), parent=user_info)
+    if upload is None:
+      self.error(404)
+    return upload
+
+  def fail(self, status, error):
+    self.error(status)
+    self.response.headers['Content-Type'] = 'text/plain'
+    self.response.out.write("error %s\n" % error)
+
+  def fail_with_error(self, upload_id):
+    """Responds with the chunked.Error being handled."""
+    error = sys.exc_info()[1]
+    if isinstance(error, chunked.OffsetError):
+      self.fail(409, error)
+      self.write_status(upload_id, error.received)
+    else:
+      self.fail(400, error)
+
+  def write_status(self, upload_id, received):
+    self.response.headers['Content-Type'] = 'text/plain'
+    self.response.out.write("id %d\nchunk_size %d\nreceived %d\n" % (
+        upload_id, chunked.CHUNK_SIZE, received))
+
+
+class ChunkedFinishHandler(ChunkedUploadHandler):
+  """Finishes a resumable upload and stores it like /post would.
+
+  Takes the same parameters as /post (is_doc, title, ...), and responds
+  "ok", or with an error after which the upload is gone.  Finishing an
+  upload again is harmless.
+  """
+
+  def post(self, upload_id):
+    upload = self.lookup(upload_id)
+    if upload is None:
+      return
+    try:
+      blob_info = chunked.finish(upload.key())
+    except chunked.Error:
+      self.fail_with_error(upload.key().id())
+      return
+    if blob_info is not None:
+      error_messages = []
+      store_media(self, [blob_info], error_messages)
+      if error_messages:
+        chunked.discard(upload.key())
+        self.fail(400, '; '.join(error_messages))
+        return
+      chunked.stored(upload.key())
+    self.response.headers['Content-Type'] = 'text/plain'
+    self.response.out.write("ok\n")
+
+
+class ChunkedSweepHandler(webapp.RequestHandler):
+  """Cron job deleting abandoned resumable uploads."""
+
+  def get(self):
+    count = chunked.sweep()
+    if count:
+      logging.info("Deleted %d abandoned chunked uploads", count)
+
+
+class ProcessMediaHandler(webapp.RequestHandler):
+  """Task queue worker for post-upload processing; see processing.py."""
+
+  def post(self):
+    media_keys = [db.Key(k) for k in self.request.get_all('key')]
+    attempt = int(self.request.headers.get('X-AppEngine-TaskRetryCount', 0))
+    done = processing.process_task(media_keys, attempt)
+    # Show any blank page and duplicate flags on the home page.
+    for user_key in set([k.parent() for k in media_keys]):
+      invalidate_home_view(user_key)
+    if not done:
+      # Non-2xx makes the task queue retry with backoff.
+      self.error(500)
+
+
+class IngestTaskHandler(webapp.RequestHandler):
+  """Task queue worker storing a user's journaled uploads."""
+
+  def post(self):
+    journal.commit(self.request.get("user"), store_uploads)
+
+
+class CountTaskHandler(webapp.RequestHandler):
+  """Task queue worker making a counter update queued by update_later."""
+
+  def post(self):
+    deltas = dict((name, int(self.request.get(name)))
+                  for name in counters.COUNTERS if self.request.get(name))
+    counters.update(db.Key(self.request.get("user")), **deltas)
+
+
+class IngestSweepHandler(webapp.RequestHandler):
+  """Cron job queueing commits of journaled uploads a task missed."""
+
+  def get(self):
+    journal.sweep()
+
+
+class JournalStatsHandler(webapp.RequestHandler):
+  """Shows upload journal counters, lag and the latest store error."""
+
+  def get(self):
+    if not users.is_current_user_admin():
+      self.redirect('/?error_message=%s' % 'admin required')
+      return
+
+    stats = journal.stats()
+    self.response.headers['Content-Type'] = "text/plain"
+    for name in sorted(stats):
+      self.response.out.write("%s: %d\n" % (name, stats[name]))
+    error = journal.last_error()
+    if error:
+      self.response.out.write("last_error: %s\n" % error)
+
+
+class ContactSheetHandler(webapp.RequestHandler):
+  """Serves a contact sheet of scans; see contactsheet.py.
+
+  Parameters:
+    ids: comma-separated MediaObject ids, in sheet order.
+    gen: the user's sheet generation, only so the URL changes with it.
+  """
+
+  def get(self):
+    user_info = get_user_info()
+    if user_info is None:
+      self.error(403)
+      return
+    try:
+      ids = [long(x) for x in self.request.get("ids").split(',')]
+    except ValueError:
+      self.error(400)
+      return
+    if len(ids) > contactsheet.MAX_SCANS:
+      self.error(400)
+      return
+
+    scans = MediaObject.get_by_id(ids, parent=user_info)
+    data = contactsheet.get_sheet(user_info.key(), scans)
+    if data is None:
+      self.error(404)
+      return
+    self.response.headers['Cache-Control'] = "private, max-age=86400"
+    self.response.headers['Content-Type'] = "image/jpeg"
+    self.response.out.write(data)
+
+
 class ShowDocHandler(webapp.RequestHandler):
   def get(self, docid):
     user_info = get_user_info()
@@ -380,41 +1160,160 @@ class ShowDocHandler(webapp.RequestHandler):
     if not size:
       size = 1200
     show_single_list = long(size) > 600
-    self.response.out.write(template.render('doc.html',
+    # Full-size pages get a zoomable tile view (static/zoom.js), where
+    # their dimensions are known.
+    page_views = []
+    for page in pages:
+      view = {"page": page, "zoom": None}
+      pyramid = show_single_list and page and tiles.pyramid(page)
+      if pyramid:
+        width, height, max_zoom = pyramid
+        view["zoom"] = {"width": width, "height": height,
+                        "max_zoom": max_zoom, "tile_size": tiles.TILE_SIZE}
+      page_views.append(view)
+    self.response.out.write(render_template('doc.html',
                                             {"doc": doc,
                                              "pages": pages,
+                                             "page_views": page_views,
                                              "user_info": user_info,
                                              "size": size,
-                                             "show_single_list": show_single_list},
-                                            debug=True))
+                                             "show_single_list": show_single_list}))
+
+
+class TileHandler(webapp.RequestHandler):
+  """Serves one tile of a scan's pyramid: /tile/<id>/<zoom>/<col>/<row>.
+
+  See tiles.py.
+  """
+
+  def get(self, media_id, zoom, col, row):
+    user_info = get_user_info()
+    if user_info is None:
+      self.error(403)
+      return
+    media_object = MediaObject.get_by_id(long(media_id), parent=user_info)
+    if media_object is None:
+      self.error(404)
+      return
+    tile = tiles.get_tile(media_object, int(zoom), int(col), int(row))
+    if tile is None:
+      self.error(404)
+      return
+    data, content_type = tile
+    # A scan never changes, so neither do its tiles.
+    self.response.headers['Cache-Control'] = "private, max-age=2592000"
+    self.response.headers['Content-Type'] = content_type
+    self.response.out.write(data)
+
+
+class DocPdfHandler(blobstore_handlers.BlobstoreDownloadHandler):
+  """Serves a whole document as a PDF: /doc/<id>.pdf
+
+  See docpdf.py.  Small documents are built on the first request; big
+  ones are built by a task, and the page refreshes until it's done.
+  """
+
+  def get(self, docid):
+    user_info = get_user_info()
+    if user_info is None:
+      self.redirect('/?error_message=%s' % 'login required to view docs')
+      return
+    doc = Document.get_by_id(long(docid), parent=user_info)
+    if doc is None:
+      self.error(404)
+      return
+    pdf = docpdf.cached_pdf(doc)
+    if pdf is None:
+      if len(doc.pages) > docpdf.INLINE_MAX_PAGES:
+        docpdf.enqueue_build(doc)
+        self.response.set_status(202)
+        self.response.headers['Refresh'] = '10'
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.out.write(
+            "Building a PDF of %d pages; this page will reload when "
+            "it's ready.\n" % len(doc.pages))
+        return
+      pdf = docpdf.build(doc)
+    self.response.headers['Cache-Control'] = "private"
+    self.response.headers['Content-Disposition'] = (
+        'inline; filename="doc-%d.pdf"' % doc.key().id())
+    send_blob(self, DocumentPdf.blob.get_value_for_datastore(pdf),
+              'application/pdf')
+
+
+class PdfBuildTaskHandler(webapp.RequestHandler):
+  """Task queue worker building one document's PDF."""
+
+  def post(self):
+    doc = db.get(db.Key(self.request.get("doc")))
+    if doc is None or docpdf.cached_pdf(doc) is not None:
+      return
+    docpdf.build(doc)
 
 
 def break_and_delete_doc(user, doc):
   """Deletes the document, marking all the images in it as un-annotated."""
-  def tx():
-    db.delete(doc)
-    scans = MediaObject.get(doc.pages)
-    for scan in scans:
-      scan.lacks_document = True
-      scan.document = None
-      db.put(scan)
-  db.run_in_transaction(tx)
+  break_docs(user, [doc])
   return True
 
 
+def break_docs(user, docs):
+  """Deletes documents, marking all their images as un-annotated.
+
+  Each document is broken in its own transaction, with one batch get of
+  its pages and one put.  Documents share index entities (a tag's
+  posting, the timeline), and a transaction doesn't see its own writes,
+  so breaking two in one transaction would lose one's index updates.
+  """
+  broken = []
+  for doc in docs:
+    doc = db.run_in_transaction(_break_doc, user.key(), doc.key())
+    if doc is not None:
+      broken.append(doc)
+  counters.update(user.key(), docs=-len(broken),
+                  untagged=-len([d for d in broken if d.no_tags]))
+  docpdf.forget([d.key() for d in docs])
+  invalidate_home_view(user.key())
+  contactsheet.invalidate(user.key())
+
+
+def _break_doc(user_key, doc_key):
+  """Transaction breaking one document.  Returns it, or None if gone."""
+  doc = db.get(doc_key)
+  if doc is None:
+    return None
+  tagindex.update_document_tags(user_key, doc_key.id(), doc.tags, [])
+  textsearch.update_document(user_key, doc_key.id(),
+                             textsearch.document_terms(doc), {})
+  timeline.update_document_dates(user_key, [(doc.doc_date, None)])
+  scans = [scan for scan in db.get(doc.pages) if scan]
+  for scan in scans:
+    scan.lacks_document = True
+    scan.document = None
+  db.delete(doc)
+  db.put(scans)
+  return doc
+
+
 def delete_doc_and_images(user, doc):
   """Deletes the document and its images."""
-  scans = MediaObject.get(doc.pages)
-  for scan in scans:
-    blobstore.delete(scan.blob.key())
+  scans = [scan for scan in MediaObject.get(doc.pages) if scan]
   def tx():
-    db.delete(doc)
-    scans = MediaObject.get(doc.pages)
-    for scan in scans:
-      user.media_objects -= 1
-      db.delete(scan)
-    db.put(user)
+    tagindex.update_document_tags(user.key(), doc.key().id(), doc.tags, [])
+    textsearch.update_document(user.key(), doc.key().id(),
+                               textsearch.document_terms(doc), {})
+    timeline.update_document_dates(user.key(), [(doc.doc_date, None)])
+    dedup.forget(scans)
+    db.delete([doc] + scans)
   db.run_in_transaction(tx)
+  deltas = counters.media_deltas(scans, -1)
+  counters.update(user.key(), docs=-1, untagged=-int(doc.no_tags), **deltas)
+  docpdf.forget([doc.key()])
+  # Only once nothing references them any more:
+  dedup.delete_unshared_blobs(user.key(),
+                              [scan.blob.key() for scan in scans])
+  imagecache.delete_variants(doc.pages)
+  invalidate_home_view(user.key())
   return True
 
 
@@ -439,15 +1338,20 @@ class ChangeDocHandler(webapp.RequestHandler):
       self.response.out.write("[&lt;&lt; <a href='/'>Back</a>] Docid %d and its images deleted." % docid)
       return
 
+    old_terms = textsearch.document_terms(doc)
+
     # Simple properties:
     doc.physical_location = self.request.get("physical_location")
     doc.title = self.request.get("title")
 
     # Tags
+    old_tags = list(doc.tags)
+    was_untagged = doc.no_tags
     doc.tags = [x for x in re.split('\s*,\s*', self.request.get("tags")) if x]
     doc.no_tags = (len(doc.tags) == 0)
 
     # Document Date
+    old_date = doc.doc_date
     date = self.request.get("date")
     if date:
       doc.doc_date = datetime.datetime.strptime(date, "%Y-%m-%d")
@@ -464,10 +1368,143 @@ class ChangeDocHandler(webapp.RequestHandler):
 
     def store():
       db.put(doc)
+      tagindex.update_document_tags(user_info.key(), docid, old_tags, doc.tags)
+      textsearch.update_document(user_info.key(), docid, old_terms,
+                                 textsearch.document_terms(doc))
+      timeline.update_document_dates(user_info.key(),
+                                     [(old_date, doc.doc_date)])
     db.run_in_transaction(store)
+    counters.update(user_info.key(),
+                    untagged=int(doc.no_tags) - int(was_untagged))
+    invalidate_home_view(user_info.key())
     self.redirect("/?saved_doc=" + str(docid))
 
 
+class ReindexHandler(webapp.RequestHandler):
+  """Rebuilds the current user's indexes, in tasks."""
+
+  def post(self):
+    user_info = get_user_info()
+    if user_info is None:
+      self.redirect('/?error_message=%s' % 'log-in required')
+      return
+    tagindex.rebuild(user_info)
+    textsearch.rebuild(user_info)
+    timeline.rebuild(user_info)
+    invalidate_home_view(user_info.key())
+    self.redirect('/')
+
+
+class ReindexTagsTaskHandler(webapp.RequestHandler):
+  """Task queue worker running one step of a tag index rebuild."""
+
+  def post(self):
+    tagindex.rebuild_step(db.Key(self.request.get("user")),
+                          self.request.get("run"),
+                          self.request.get("phase"),
+                          self.request.get("cursor"),
+                          int(self.request.get("step")))
+
+
+class ReindexTextTaskHandler(webapp.RequestHandler):
+  """Task queue worker running one step of a full-text index rebuild."""
+
+  def post(self):
+    textsearch.rebuild_step(db.Key(self.request.get("user")),
+                            self.request.get("run"),
+                            self.request.get("phase"),
+                            self.request.get("cursor"),
+                            int(self.request.get("step")))
+
+
+class ReindexTimelineTaskHandler(webapp.RequestHandler):
+  """Task queue worker recounting a user's timeline histogram."""
+
+  def post(self):
+    timeline.recount(db.Key(self.request.get("user")))
+
+
+class TimelineHandler(webapp.RequestHandler):
+  """Browses documents by doc_date: /timeline?year=2009&month=3
+
+  The histogram comes from timeline.py; a chosen year or month lists
+  its documents, oldest first, a page at a time.
+  """
+
+  def get(self):
+    user_info = get_user_info()
+    if user_info is None:
+      self.redirect('/?error_message=%s' % 'log-in required')
+      return
+    try:
+      year = int(self.request.get("year") or 0) or None
+      month = int(self.request.get("month") or 0) or None
+    except ValueError:
+      year = month = None
+    if year is None or not datetime.MINYEAR <= year < datetime.MAXYEAR or \
+          (month is not None and not 1 <= month <= 12):
+      year = month = None
+
+    page = None
+    nav = {}
+    if year is not None:
+      start, end = timeline.bucket_range(year, month)
+      def make_query(reverse):
+        q = Document.all().filter('owner', user_info)
+        q.filter('doc_date >=', start).filter('doc_date <', end)
+        return _ordered(q, reverse, 'doc_date')
+      page_size = paging.clamp_page_size(self.request.get("limit"), 50)
+      page = paging.fetch_page(make_query, page_size,
+                               self.request.get("cursor"))
+      params = [('year', year)]
+      if month is not None:
+        params.append(('month', month))
+      for name in ('prev', 'next'):
+        token = getattr(page, name + '_token')
+        if token:
+          nav[name] = '/timeline?' + urllib.urlencode(
+              params + [('cursor', token)])
+
+    self.response.out.write(render_template('timeline.html', {
+        "years": timeline.histogram(user_info.key()),
+        "year": year,
+        "month": month,
+        "month_name": month and calendar.month_name[month] or "",
+        "docs": page and page.items or [],
+        "nav": nav,
+        "user_info": user_info,
+        "login_url": users.create_logout_url('/'),
+        }))
+
+
+class StatsHandler(webapp.RequestHandler):
+  """Shows the user's library counters (counters.py); POST recounts."""
+
+  def get(self):
+    user_info = get_user_info()
+    if user_info is None:
+      self.redirect('/?error_message=%s' % 'log-in required')
+      return
+    totals = counters.totals(user_info.key())
+    average_bytes = 0
+    if totals['media'] > 0:
+      average_bytes = totals['bytes'] // totals['media']
+    self.response.out.write(render_template('stats.html', {
+        "totals": totals,
+        "average_bytes": average_bytes,
+        "user_info": user_info,
+        "login_url": users.create_logout_url('/'),
+        }))
+
+  def post(self):
+    user_info = get_user_info()
+    if user_info is None:
+      self.redirect('/?error_message=%s' % 'log-in required')
+      return
+    counters.recount(user_info)
+    self.redirect('/stats')
+
+
 class ResourceHandler(blobstore_handlers.BlobstoreDownloadHandler):
   """For when user requests media object.  Actually serves blob."""
 
@@ -520,88 +1557,267 @@ class ResourceHandler(blobstore_handlers.BlobstoreDownloadHandler):
 
     resize = self.request.get('resize')
     if resize:
-      image = images.Image(blob_key=str(blob_key))
-      image.resize(width=int(resize), height=int(resize))
-      self.response.out.write(image.execute_transforms())
+      data, content_type = imagecache.get_resized(media_object, int(resize))
+      self.response.headers['Content-Type'] = content_type
+      self.response.out.write(data)
       return
 
     if 'Range' in self.request.headers:
       self.response.headers['Range'] = self.request.headers['Range']
 
-    self.send_blob(blob_key, str(media_object.guessed_type))
+    send_blob(self, blob_key, str(media_object.guessed_type))
 
 
-class GarbageCollectMediaHandler1(webapp.RequestHandler):
+class GarbageCollectHandler(webapp.RequestHandler):
+  """Shows, starts and resumes media/blob garbage collection runs.
+
+  GET shows the latest run.  POST with action=start (and dry_run=1 to
+  only count) starts a run; action=resume continues the latest one.
+  """
+
   def get(self):
     if not users.is_current_user_admin():
-      self.redirect('/?error_message=%s' % 'log-in required')
+      self.redirect('/?error_message=%s' % 'admin required')
+      return
+
+    out = self.response.out
+    run = mediagc.latest_run()
+    if run is None:
+      out.write("<p>No GC runs.</p>")
+    else:
+      summary = mediagc.summary(run)
+      out.write("<pre>run: %d\n" % run.key().id())
+      for name in sorted(summary):
+        out.write("%s: %s\n" % (name, summary[name]))
+      out.write("</pre>")
+    out.write("""<form method='POST'>
+<input type='hidden' name='action' value='start' />
+<label><input type='checkbox' name='dry_run' value='1' checked /> dry run</label>
+<input type='submit' value='Start new run' />
+</form>
+<form method='POST'>
+<input type='hidden' name='action' value='resume' />
+<input type='submit' value='Resume latest run' />
+</form>""")
+
+  def post(self):
+    if not users.is_current_user_admin():
+      self.redirect('/?error_message=%s' % 'admin required')
+      return
 
-    used = set()
-    for d in Document.all():
-      used |= set(d.pages)
+    action = self.request.get("action")
+    if action == "start":
+      mediagc.start(dry_run=self.request.get("dry_run") == "1")
+    elif action == "resume":
+      run = mediagc.latest_run()
+      if run is not None:
+        mediagc.resume(run)
+    self.redirect('/admin/gc')
 
-    dead = dict()
-    for i in MediaObject.all():
-      if i.key() not in used:
-        dead[i.key()] = i
 
-    for k in dead:
-      dead[k].delete()
+class GarbageCollectTaskHandler(webapp.RequestHandler):
+  """Task queue worker running one batch of a GC run."""
 
-    self.redirect('/')
+  def post(self):
+    mediagc.run_step(long(self.request.get("run")))
+
+
+class DedupHandler(webapp.RequestHandler):
+  """Shows, starts and resumes content-hash deduplication backfills.
+
+  GET shows the latest run.  POST with action=start (and dry_run=1 to
+  only count) starts a run; action=resume continues the latest one.
+  """
 
-class GarbageCollectMediaHandler2(webapp.RequestHandler):
   def get(self):
     if not users.is_current_user_admin():
-      self.redirect('/?error_message=%s' % 'log-in required')
+      self.redirect('/?error_message=%s' % 'admin required')
+      return
 
-    used = set()
-    for i in MediaObject.all():
-      used.add(i.blob.key())
+    out = self.response.out
+    run = dedup.latest_run()
+    if run is None:
+      out.write("<p>No dedup runs.</p>")
+    else:
+      summary = dedup.summary(run)
+      out.write("<pre>run: %d\n" % run.key().id())
+      for name in sorted(summary):
+        out.write("%s: %s\n" % (name, summary[name]))
+      out.write("</pre>")
+    out.write("""<form method='POST'>
+<input type='hidden' name='action' value='start' />
+<label><input type='checkbox' name='dry_run' value='1' checked /> dry run</label>
+<input type='submit' value='Start new run' />
+</form>
+<form method='POST'>
+<input type='hidden' name='action' value='resume' />
+<input type='submit' value='Resume latest run' />
+</form>""")
 
-    for b in blobstore.BlobInfo.all():
-      if b.key() not in used:
-        b.delete()
+  def post(self):
+    if not users.is_current_user_admin():
+      self.redirect('/?error_message=%s' % 'admin required')
+      return
 
-    self.redirect('/')
+    action = self.request.get("action")
+    if action == "start":
+      dedup.start(dry_run=self.request.get("dry_run") == "1")
+    elif action == "resume":
+      run = dedup.latest_run()
+      if run is not None:
+        dedup.resume(run)
+    self.redirect('/admin/dedup')
+
+
+class DedupTaskHandler(webapp.RequestHandler):
+  """Task queue worker running one batch of a dedup backfill."""
+
+  def post(self):
+    dedup.run_step(long(self.request.get("run")))
+
+
+class ImageCacheStatsHandler(webapp.RequestHandler):
+  """Shows derived-image cache hit/miss counters and storage use."""
 
-class DumpHandler(webapp.RequestHandler):
   def get(self):
+    if not users.is_current_user_admin():
+      self.redirect('/?error_message=%s' % 'admin required')
+      return
+
+    stats = imagecache.stats()
+    self.response.headers['Content-Type'] = "text/plain"
+    for name in sorted(stats):
+      self.response.out.write("%s: %d\n" % (name, stats[name]))
+
+
+class ImageCacheFlushHandler(webapp.RequestHandler):
+  """Cron job applying derived-image storage use and evicting."""
+
+  def get(self):
+    imagecache.flush_usage()
+
+
+class InstrumentStatsHandler(webapp.RequestHandler):
+  """Shows per-handler latency histograms and call counts (instrument.py)."""
+
+  def get(self):
+    if not users.is_current_user_admin():
+      self.redirect('/?error_message=%s' % 'admin required')
+      return
+
+    out = self.response.out
+    self.response.headers['Content-Type'] = "text/plain"
+    startup = instrument.startup_stats()
+    out.write("instance starts: %d, mean load %.1f ms, mean first request "
+              "%.1f ms\n" % (startup['count'], startup['load_ms'],
+                              startup['first_request_ms']))
+    out.write("buckets (ms): %s, more\n" %
+              ', '.join([str(b) for b in instrument.BUCKETS_MS]))
+    for h in instrument.stats([handler.__name__ for unused, handler in ROUTES]):
+      out.write("\n%s: %d requests, mean %.1f ms, p50 %s, p90 %s, p99 %s\n"
+                % (h['handler'], h['count'], h['mean_ms'], h['p50'], h['p90'],
+                   h['p99']))
+      out.write("  histogram: %s\n" % ' '.join([str(n) for n in h['buckets']]))
+      for phase in instrument.PHASES:
+        if h['phases'][phase]:
+          out.write("  %s: %.1f ms\n" % (phase, h['phases'][phase]))
+      for service in instrument.SERVICES:
+        if h['calls'][service]:
+          out.write("  %s calls: %.2f\n" % (service, h['calls'][service]))
+
+
+class ExportHandler(webapp.RequestHandler):
+  """Writes one page of the user's archive as NDJSON; see export.py."""
+
+  def get(self):
+    user_info = get_request_user(self)
+    if user_info is None:
+      self.error(403)
+      return
+
     self.response.headers['Cache-Control'] = "private"
-    self.response.headers['Content-Type'] = "text/plain; charset=utf-8"
+    self.response.headers['Content-Type'] = "application/x-ndjson"
+    try:
+      next_token = export.write_page(user_info, self.request.get("cursor"),
+                                     self.response.out)
+    except ValueError:
+      self.error(400)
+      return
+    if next_token:
+      self.response.headers['X-Export-Next'] = next_token
+
 
-    user = UserInfo.get_by_key_name('user:bradfitz@gmail.com')
+class ExportBlobHandler(blobstore_handlers.BlobstoreDownloadHandler):
+  """Serves a media object's original blob to an export client."""
 
-    docs = Document.all().filter('owner', user)
-    docs = docs.fetch(10000)
-    self.response.out.write("# got %d docs\n" % len(docs))
-    for doc in docs:
-      self.response.out.write("%s tags[%s] date[%s] title[%s] \n" % (doc.display_url, doc.tag_comma_separated, doc.date_yyyy_mm_dd, doc.title_or_empty_string))
-      for page in doc.pages:
-        self.response.out.write(" has_page: %d\n" % (page.id_or_name()))
-    meds = MediaObject.all().filter('owner', user)
-    meds = meds.fetch(10000)
-    self.response.out.write("# got %d mediaobjects\n" % len(meds))
-    for mo in meds:
-      self.response.out.write("%s creation[%s] size[%d]\n" % (mo.url_path, str(mo.creation), mo.size))
+  def get(self, media_id):
+    user_info = get_request_user(self)
+    if user_info is None:
+      self.error(403)
+      return
+    media_object = MediaObject.get_by_id(long(media_id), parent=user_info)
+    if media_object is None:
+      self.error(404)
+      return
+    send_blob(self, media_object.blob.key(), str(media_object.guessed_type))
+
+
+ROUTES = [
+    ('/', MainHandler),
+    ('/uploadurl', UploadUrlHandler),  # returns a new upload URL
+    #('/upload', UploadFormHandler),    # for humans
+    ('/post', UploadPostHandler),      # for machine or humans to upload
+    ('/chunked', ChunkedUploadHandler),  # resumable uploads, for scripts
+    ('/chunked/(\d+)', ChunkedUploadHandler),
+    ('/chunked/(\d+)/finish', ChunkedFinishHandler),
+    ('/tasks/chunked_sweep', ChunkedSweepHandler),
+    ('/tasks/process_media', ProcessMediaHandler),
+    ('/tasks/ingest', IngestTaskHandler),
+    ('/tasks/ingest_sweep', IngestSweepHandler),
+    ('/tasks/count', CountTaskHandler),
+    ('/makedoc', MakeDocHandler),
+    ('/bulkdoc', BulkDocHandler),      # for scripts splitting stacks
+    ('/delete_blank', DeleteBlankHandler),
+    ('/doc/(\d+)\.pdf', DocPdfHandler),
+    ('/doc/(\d+)', ShowDocHandler),
+    ('/changedoc', ChangeDocHandler),
+    ('/reindex', ReindexHandler),
+    ('/tasks/reindex_tags', ReindexTagsTaskHandler),
+    ('/tasks/reindex_text', ReindexTextTaskHandler),
+    ('/tasks/reindex_timeline', ReindexTimelineTaskHandler),
+    ('/stats', StatsHandler),
+    ('/timeline', TimelineHandler),
+    ('/resource/(\d+)(/.*)?', ResourceHandler),
+    ('/tile/(\d+)/(\d+)/(\d+)/(\d+)', TileHandler),
+    ('/admin/imagecache', ImageCacheStatsHandler),
+    ('/tasks/imagecache_flush', ImageCacheFlushHandler),
+    ('/admin/journal', JournalStatsHandler),
+    ('/admin/instrument', InstrumentStatsHandler),
+    ('/export', ExportHandler),
+    ('/export/blob/(\d+)', ExportBlobHandler),
+    ('/admin/gc', GarbageCollectHandler),
+    ('/tasks/gc', GarbageCollectTaskHandler),
+    ('/contactsheet', ContactSheetHandler),
+    ('/admin/dedup', DedupHandler),
+    ('/tasks/dedup', DedupTaskHandler),
+    ('/tasks/delete_blank', DeleteBlankTaskHandler),
+    ('/tasks/build_pdf', PdfBuildTaskHandler),
+    ]
+
+
+def make_application(debug=DEBUG, load_start=None):
+  """Returns the instrumented WSGI application."""
+  return instrument.Middleware(webapp.WSGIApplication(ROUTES, debug=debug),
+                               ROUTES, load_start=load_start)
+
+
+# Built once per instance.  App Engine keeps this module loaded between
+# requests, since it defines main(), and only calls main() again.
+application = make_application(load_start=_LOAD_START)
 
 
 def main():
-  application = webapp.WSGIApplication(
-      [('/', MainHandler),
-       ('/uploadurl', UploadUrlHandler),  # returns a new upload URL
-       #('/upload', UploadFormHandler),    # for humans
-       ('/post', UploadPostHandler),      # for machine or humans to upload
-       ('/makedoc', MakeDocHandler),
-       ('/doc/(\d+)', ShowDocHandler),
-       ('/changedoc', ChangeDocHandler),
-       ('/resource/(\d+)(/.*)?', ResourceHandler),
-       #('/dumpxx', DumpHandler),
-       #('/gc_media1', GarbageCollectMediaHandler1),
-       #('/gc_media2', GarbageCollectMediaHandler2),
-       ],
-                                       debug=True)
-  wsgiref.handlers.CGIHandler().run(application)
+  run_wsgi_app(application)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,198 @@
+#
+# scanningcabinet's AppEngine server-side code.
+#
+# Copyright 2009 Brad Fitzpatrick <brad@danga.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Incremental garbage collection of orphaned MediaObjects and blobs.
+
+A run is a chain of tasks, each handling one bounded batch and then
+checkpointing its cursor and counts in a GcRun before queueing the next.
+Nothing is ever held in memory beyond one batch, and a run interrupted
+at any point can be resumed from its checkpoint.
+
+Two phases:
+
+  media: a MediaObject claiming to be in a document (lacks_document is
+         False) whose document is gone or doesn't list it as a page.
+         Un-annotated scans are never garbage.
+  blobs: a blob no MediaObject refers to.  Blobs younger than
+         BLOB_GRACE_PERIOD are skipped; their upload may not have
+         committed its MediaObject yet.
+
+In a dry run, orphans are only counted.
+"""
+
+import datetime
+import logging
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import blobstore
+from google.appengine.ext import db
+
+from model import ChunkedUpload
+from model import DocumentPdf
+from model import GcRun
+from model import IngestEntry
+from model import MediaObject
+
+QUEUE_NAME = 'gc'
+TASK_URL = '/tasks/gc'
+
+MEDIA_BATCH_SIZE = 100
+BLOB_BATCH_SIZE = 200
+
+BLOB_GRACE_PERIOD = datetime.timedelta(days=1)
+
+
+def start(dry_run):
+  """Starts a new GC run.  Returns the GcRun."""
+  run = GcRun(dry_run=dry_run)
+  run.put()
+  _enqueue(run)
+  return run
+
+
+def resume(run):
+  """Re-queues the next batch of an interrupted run."""
+  if run.phase != 'done':
+    run.step += 1
+    run.put()
+    _enqueue(run)
+
+
+def latest_run():
+  """Returns the most recently started GcRun, or None."""
+  return GcRun.all().order('-started').get()
+
+
+def _enqueue(run):
+  # Named per step, so a retried task can't fork the chain in two.
+  try:
+    taskqueue.add(queue_name=QUEUE_NAME,
+                  url=TASK_URL,
+                  name='gc-%d-%d' % (run.key().id(), run.step),
+                  params={'run': run.key().id()})
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass
+
+
+def run_step(run_id):
+  """Processes one batch of a run, checkpoints, and queues the next."""
+  run = GcRun.get_by_id(run_id)
+  if run is None or run.phase == 'done':
+    return
+
+  if run.phase == 'media':
+    more = _sweep_media(run)
+    if not more:
+      run.phase = 'blobs'
+      run.cursor = None
+  else:
+    more = _sweep_blobs(run)
+    if not more:
+      run.phase = 'done'
+      run.cursor = None
+      run.finished = datetime.datetime.now()
+      logging.info("GC run %d done: %s", run_id, summary(run))
+
+  run.step += 1
+  run.put()
+  if run.phase != 'done':
+    _enqueue(run)
+
+
+def _sweep_media(run):
+  """Returns whether there may be more media to scan."""
+  query = MediaObject.all().filter('lacks_document', False)
+  if run.cursor:
+    query.with_cursor(run.cursor)
+  batch = query.fetch(MEDIA_BATCH_SIZE)
+  run.cursor = query.cursor()
+  run.media_scanned += len(batch)
+
+  doc_keys = [MediaObject.document.get_value_for_datastore(m) for m in batch]
+  docs = dict(zip([k for k in doc_keys if k],
+                  db.get([k for k in doc_keys if k])))
+  for media, doc_key in zip(batch, doc_keys):
+    doc = doc_key and docs.get(doc_key)
+    if doc is not None and media.key() in doc.pages:
+      continue
+    run.media_orphaned += 1
+    run.bytes_reclaimed += media.size or 0
+    if not run.dry_run:
+      logging.info("GC: deleting orphaned media %s", media.key())
+      media.delete()
+  return len(batch) == MEDIA_BATCH_SIZE
+
+
+def _sweep_blobs(run):
+  """Returns whether there may be more blobs to scan."""
+  query = db.Query(blobstore.BlobInfo, keys_only=True)
+  if run.cursor:
+    query.with_cursor(run.cursor)
+  batch = query.fetch(BLOB_BATCH_SIZE)
+  run.cursor = query.cursor()
+  run.blobs_scanned += len(batch)
+
+  unreferenced = [blobstore.BlobKey(k.name()) for k in batch
+                  if not blob_referenced(blobstore.BlobKey(k.name()))]
+  too_new = datetime.datetime.now() - BLOB_GRACE_PERIOD
+  orphans = [b for b in blobstore.BlobInfo.get(unreferenced)
+             if b is not None and b.creation < too_new]
+  for blob_info in orphans:
+    run.blobs_orphaned += 1
+    run.bytes_reclaimed += blob_info.size
+  if orphans and not run.dry_run:
+    logging.info("GC: deleting %d orphaned blobs", len(orphans))
+    blobstore.delete([b.key() for b in orphans])
+  return len(batch) == BLOB_BATCH_SIZE
+
+
+def blob_referenced(blob_key):
+  """Returns whether anything still refers to a blob.
+
+  The queries are global, so eventually consistent: a reference written
+  moments ago can be missed.  Only for the collector's sweep; deleting a
+  blob as its MediaObject goes needs dedup.delete_unshared_blobs.
+  """
+  # Pre-1.3.0 MediaObjects stored the blob key as a plain string.
+  for value in (blob_key, str(blob_key)):
+    if MediaObject.all(keys_only=True).filter('blob', value).get():
+      return True
+  if DocumentPdf.all(keys_only=True).filter('blob', blob_key).get():
+    return True
+  if ChunkedUpload.all(keys_only=True).filter('blob', blob_key).get():
+    return True
+  if IngestEntry.all(keys_only=True).filter('blobs', blob_key).get():
+    return True
+  return False
+
+
+def summary(run):
+  """Returns a dict of a run's progress and counts, for display."""
+  return {
+      'dry_run': run.dry_run,
+      'phase': run.phase,
+      'steps': run.step,
+      'started': run.started,
+      'updated': run.updated,
+      'finished': run.finished,
+      'media_scanned': run.media_scanned,
+      'media_orphaned': run.media_orphaned,
+      'blobs_scanned': run.blobs_scanned,
+      'blobs_orphaned': run.blobs_orphaned,
+      'bytes_reclaimed': run.bytes_reclaimed,
+      }
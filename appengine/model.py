@@ -61,6 +61,7 @@ class MigratingBlobReferenceProperty(db.Property):
 class UserInfo(db.Model):
   """Information about a particular user and their media library."""
   user = db.UserProperty(auto_current_user_add=True)
+  # No longer maintained; see counters.py.
   media_objects = db.IntegerProperty(default=0)
   upload_password = db.StringProperty()
 
@@ -150,6 +151,10 @@ class MediaObject(db.Model):
   original_path = db.StringProperty()  # scan/tax/2009/foo.jpg
   size = db.IntegerProperty()
 
+  # The blob's BlobInfo.md5_hash, once recorded in the user's content
+  # hash index (see dedup.py).
+  md5_hash = db.StringProperty()
+
   # If known:
   width = db.IntegerProperty()
   height = db.IntegerProperty()
@@ -158,6 +163,19 @@ class MediaObject(db.Model):
   document = db.ReferenceProperty(Document, required=False)
   lacks_document = db.BooleanProperty()
 
+  # Post-upload processing (see processing.py): 'pending', 'done' or
+  # 'failed'.  None for media uploaded before processing existed.
+  processing_state = db.StringProperty()
+  processed = db.DateTimeProperty()
+
+  # Set by processing an image (see pagecheck.py): the fraction of the
+  # page that's ink, whether that little makes it blank, its perceptual
+  # hash, and the id of a recent scan it looks the same as.
+  ink_coverage = db.FloatProperty()
+  blank = db.BooleanProperty()
+  phash = db.StringProperty()
+  duplicate_of_id = db.IntegerProperty()
+
   @property
   def thumb_url(self):
     return '/resource/%d/%s?resize=300' % (self.key().id(), self.filename)
@@ -193,8 +211,235 @@ class MediaObject(db.Model):
     return self.guessed_type in image_types
 
   def delete(self):
-    """Also delete associated media blob and decrement users media count."""
+    """Also delete associated media blob and decrement users media count.
+
+    The blob is kept if a deduplicated MediaObject still shares it.
+    """
+    # These modules import this one.
+    import counters
+    import dedup
+    import imagecache
+    imagecache.delete_variants([self.key()])
+    dedup.forget([self])
     super(MediaObject, self).delete()
-    self.owner.media_objects -= 1
-    self.owner.put()
-    self.blob.delete()
+    counters.update(self.parent_key(), **counters.media_deltas([self], -1))
+    dedup.delete_unshared_blobs(self.parent_key(), [self.blob.key()])
+
+
+class DerivedImage(db.Model):
+  """A cached rendition (resize, tile, ...) of a MediaObject's image.
+
+  A root entity, so cache fills don't write to the user's entity group.
+  The key name is the MediaObject's key and the variant, e.g.
+  "<media key>/r300.jpeg" for a 300px resize.  Its size and last access
+  time are kept in a DerivedImageInfo of the same key name, so eviction
+  never has to load the data.
+  """
+  data = db.BlobProperty()
+  content_type = db.StringProperty()
+
+  # How long the transform took, to know what each cache hit saves.
+  render_ms = db.IntegerProperty(default=0)
+
+  creation = db.DateTimeProperty(auto_now_add=True)
+
+
+class DerivedImageInfo(db.Model):
+  """Size and last access time of the DerivedImage of the same key name."""
+  size = db.IntegerProperty(default=0)  # len(data)
+  last_access = db.DateTimeProperty()
+
+
+class ImageCacheUsage(db.Model):
+  """Singleton tracking total storage used by all DerivedImages."""
+  total_bytes = db.IntegerProperty(default=0)
+  variants = db.IntegerProperty(default=0)
+
+
+class TagPosting(db.Model):
+  """Sorted ids of a user's Documents having one tag.
+
+  Child of the UserInfo, with key name "tag:<tag>".  Kept up to date by
+  tagindex.update_document_tags.  While tagindex.rebuild runs, there are
+  also staging copies named "rebuild:<run>:<tag>".  Only fetched by key
+  or key range, so nothing in it is indexed.
+  """
+  doc_ids = db.ListProperty(long, indexed=False)
+
+
+class TagCloud(db.Model):
+  """All of a user's tags with their document counts (parallel lists).
+
+  Child of the UserInfo, with key name "tagcloud".
+  """
+  tags = db.StringListProperty(indexed=False)
+  counts = db.ListProperty(long, indexed=False)
+
+
+class SearchPosting(db.Model):
+  """One shard of a full-text term's posting list.
+
+  Child of the UserInfo, with key name "ft:<term>:<shard>"; a document
+  is in shard doc_id % textsearch.NUM_SHARDS.  weights[i] is how
+  strongly doc_ids[i] matches the term (see textsearch.FIELD_WEIGHTS).
+  """
+  doc_ids = db.ListProperty(long, indexed=False)
+  weights = db.ListProperty(long, indexed=False)
+
+
+class SearchLexicon(db.Model):
+  """Sorted single-word terms starting with one character, with their
+  document frequencies.  Used to expand prefix queries and for ranking.
+
+  Child of the UserInfo, with key name "lex:<first character>".
+  """
+  terms = db.StringListProperty(indexed=False)
+  dfs = db.ListProperty(long, indexed=False)
+
+
+class SearchIndexInfo(db.Model):
+  """Number of documents in a user's full-text index.
+
+  Child of the UserInfo, with key name "ftinfo".
+  """
+  doc_count = db.IntegerProperty(default=0)
+
+
+class GcRun(db.Model):
+  """Progress of one mark-and-sweep garbage collection (see mediagc.py).
+
+  Checkpointed after every batch, so an interrupted run can resume.
+  """
+  dry_run = db.BooleanProperty(default=True)
+  phase = db.StringProperty(default='media')  # 'media', 'blobs', 'done'
+  cursor = db.TextProperty()  # position within the current phase
+  step = db.IntegerProperty(default=0)
+
+  started = db.DateTimeProperty(auto_now_add=True)
+  updated = db.DateTimeProperty(auto_now=True)
+  finished = db.DateTimeProperty()
+
+  media_scanned = db.IntegerProperty(default=0)
+  media_orphaned = db.IntegerProperty(default=0)
+  blobs_scanned = db.IntegerProperty(default=0)
+  blobs_orphaned = db.IntegerProperty(default=0)
+  bytes_reclaimed = db.IntegerProperty(default=0)
+
+
+class ContentHash(db.Model):
+  """The MediaObject a user first uploaded with some content.
+
+  Child of the UserInfo, with key name "md5:<hex digest>" (the blob's
+  BlobInfo.md5_hash).  See dedup.py.
+  """
+  media = db.ReferenceProperty(MediaObject, collection_name='content_hashes')
+
+
+class DedupRun(db.Model):
+  """Progress of one deduplication backfill (see dedup.py).
+
+  Checkpointed after every batch, so an interrupted run can resume.
+  """
+  dry_run = db.BooleanProperty(default=True)
+  cursor = db.TextProperty()
+  step = db.IntegerProperty(default=0)
+  done = db.BooleanProperty(default=False)
+
+  started = db.DateTimeProperty(auto_now_add=True)
+  updated = db.DateTimeProperty(auto_now=True)
+  finished = db.DateTimeProperty()
+
+  media_scanned = db.IntegerProperty(default=0)
+  media_hashed = db.IntegerProperty(default=0)
+  duplicates = db.IntegerProperty(default=0)
+  media_deleted = db.IntegerProperty(default=0)
+  blobs_reclaimed = db.IntegerProperty(default=0)
+  bytes_reclaimed = db.IntegerProperty(default=0)
+
+
+class DocumentPdf(db.Model):
+  """A Document's pages as one PDF, in the blobstore (see docpdf.py).
+
+  Child of the Document, with key name "pdf".  Only current while the
+  document's pages are still the same list as pages here.
+  """
+  blob = blobstore.BlobReferenceProperty()
+  pages = db.ListProperty(db.Key)
+  size = db.IntegerProperty()
+  creation = db.DateTimeProperty(auto_now_add=True)
+
+
+class ChunkedUpload(db.Model):
+  """A resumable upload (see chunked.py).
+
+  Child of the uploading UserInfo.  Chunks are appended to file_name, a
+  Files API blobstore file, which is finalized into blob once all size
+  bytes are received.
+  """
+  filename = db.StringProperty()
+  content_type = db.StringProperty()
+  size = db.IntegerProperty()
+  md5_hash = db.StringProperty()  # of the whole file, if the client said
+  file_name = db.StringProperty()
+  received = db.IntegerProperty(default=0)
+
+  # While a request is appending a chunk.
+  writing_until = db.DateTimeProperty()
+
+  blob = blobstore.BlobReferenceProperty()
+  stored = db.BooleanProperty(default=False)  # as a MediaObject
+
+  created = db.DateTimeProperty(auto_now_add=True)
+  updated = db.DateTimeProperty(auto_now=True)
+
+
+class UserStatsShard(db.Model):
+  """One shard of a user's library counters (see counters.py).
+
+  A root entity, not in the user's entity group, with key name
+  "<UserInfo key name>:<shard>", so updating the counters never
+  contends with the user's other writes.
+  """
+  media = db.IntegerProperty(default=0)
+  docs = db.IntegerProperty(default=0)
+  bytes = db.IntegerProperty(default=0)
+  untagged = db.IntegerProperty(default=0)
+
+
+class IngestEntry(db.Model):
+  """Uploads not yet stored as MediaObjects (see journal.py).
+
+  A root entity, so appending one doesn't write to the user's entity
+  group.  media_ids are allocated when the entry is appended, one per
+  blob, in the same order.
+  """
+  user_email = db.StringProperty(required=True)
+  blobs = db.ListProperty(blobstore.BlobKey)
+  media_ids = db.ListProperty(long, indexed=False)
+  created = db.DateTimeProperty(auto_now_add=True)
+
+  # For a stand-alone single-page document upload:
+  doc_id = db.IntegerProperty()
+  doc_title = db.StringProperty()
+  doc_description = db.TextProperty()
+  doc_tags = db.StringProperty()  # comma-separated
+
+
+class PageHashes(db.Model):
+  """Perceptual hashes of a user's most recently processed scans
+  (parallel lists, oldest first).
+
+  Child of the UserInfo, with key name "recent" (see pagecheck.py).
+  """
+  media_ids = db.ListProperty(long, indexed=False)
+  hashes = db.StringListProperty(indexed=False)
+
+
+class DateHistogram(db.Model):
+  """A user's dated Documents counted by month of doc_date (parallel
+  lists, months sorted, as "YYYY-MM").
+
+  Child of the UserInfo, with key name "timeline" (see timeline.py).
+  """
+  months = db.StringListProperty(indexed=False)
+  counts = db.ListProperty(long, indexed=False)
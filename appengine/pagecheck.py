@@ -0,0 +1,350 @@
+#
+# scanningcabinet's AppEngine server-side code.
+#
+# Copyright 2009 Brad Fitzpatrick <brad@danga.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Blank page and near-duplicate detection for newly processed scans.
+
+`scancab --duplex` uploads the backs of one-sided sheets too.  While a
+scan is processed (processing.py), check() looks at the page's image
+cache rendering with its margins cropped off:
+
+  ink:  the images API histogram of the page.  Paper is the most
+        common light level of each channel; ink is anything more than
+        INK_CONTRAST darker.  Less than BLANK_INK_FRACTION ink and the
+        page is flagged blank.
+  hash: a 64-bit difference hash of the page shrunk to HASH_SIZE
+        pixels, decoded here from PNG.  Scans of the same sheet differ
+        in only a few bits.
+
+record() compares a hash with the user's last RECENT_PAGES (their
+PageHashes, updated in the processing transaction), and marks a scan
+within DUPLICATE_DISTANCE bits of one of them as its duplicate.  Blank
+pages aren't compared; they all look alike.
+
+All the pixel work is done by the images service, on at most
+HASH_SIZE pixels per side here, so a check costs three images calls
+and a millisecond or so of Python on top of the page's pre-render.
+
+delete_blank() deletes a user's flagged blank pages, DELETE_BATCH_SIZE
+at a time, and queues a task to carry on if there are more.
+"""
+
+import struct
+import zlib
+
+from google.appengine.api import images
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+
+import counters
+import dedup
+import imagecache
+from model import MediaObject
+from model import PageHashes
+
+# Fraction of each side cropped off before looking at a page, to skip
+# scanner lid shadows and the sheet's edges.
+MARGIN = 0.05
+
+# How much darker than the paper, out of 255, a pixel must be to count
+# as ink.  Lower catches fainter pencil, and more bleed-through.
+INK_CONTRAST = 80
+
+# A page with less than this fraction of ink is blank.
+BLANK_INK_FRACTION = 0.0005
+
+# Whether processing deletes blank pages rather than only flagging
+# them.  They're only deleted while not yet part of a document.
+DROP_BLANK_PAGES = False
+
+# Size the page is shrunk to for hashing; hashes are computed from a
+# 9x8 grid of it.
+HASH_SIZE = 32
+
+# Most differing hash bits for two scans to be near-duplicates.
+DUPLICATE_DISTANCE = 6
+
+# How many of the user's latest hashes new scans are compared with.
+RECENT_PAGES = 200
+
+# Blank pages deleted per transaction by delete_blank().
+DELETE_BATCH_SIZE = 50
+
+QUEUE_NAME = 'gc'
+TASK_URL = '/tasks/delete_blank'
+
+_KEY_NAME = 'recent'
+
+_PNG_SIGNATURE = '\x89PNG\r\n\x1a\n'
+
+# Channels per pixel of the PNG color types we can read.
+_PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+
+class Result(object):
+  """What check() found out about a page."""
+
+  def __init__(self, ink_coverage, phash):
+    self.ink_coverage = ink_coverage
+    self.phash = phash
+
+  @property
+  def blank(self):
+    return self.ink_coverage < BLANK_INK_FRACTION
+
+
+def check(image_data):
+  """Checks a rendering of a page.
+
+  Args:
+    image_data: the encoded image, e.g. from imagecache.get_resized.
+
+  Returns:
+    A Result, or None if the image couldn't be read.
+  """
+  try:
+    image = images.Image(image_data=image_data)
+    image.crop(MARGIN, MARGIN, 1 - MARGIN, 1 - MARGIN)
+    page = image.execute_transforms(output_encoding=images.PNG)
+    ink = ink_coverage(images.Image(image_data=page).histogram())
+
+    small = images.Image(image_data=page)
+    small.resize(width=HASH_SIZE, height=HASH_SIZE)
+    width, height, rows = decode_png(
+        small.execute_transforms(output_encoding=images.PNG))
+    phash = difference_hash(width, height, rows)
+  except (images.BadImageError, images.NotImageError, ValueError):
+    return None
+  return Result(ink, phash)
+
+
+def ink_coverage(histogram):
+  """Returns the fraction of a page that's ink.
+
+  Args:
+    histogram: images.Image.histogram()'s [red, green, blue] lists of
+      256 pixel counts each.
+  """
+  fractions = []
+  for counts in histogram:
+    total = sum(counts)
+    if not total:
+      continue
+    # Paper is light, even when scanned gray or colored.
+    paper = max(range(128, 256), key=lambda level: counts[level])
+    fractions.append(sum(counts[:max(0, paper - INK_CONTRAST)]) /
+                     float(total))
+  if not fractions:
+    return 0.0
+  return sum(fractions) / len(fractions)
+
+
+def decode_png(data):
+  """Decodes an 8-bit, non-interlaced PNG to gray levels.
+
+  Returns:
+    (width, height, rows), rows being lists of width levels 0-255.
+
+  Raises:
+    ValueError: if data isn't a PNG of that kind.
+  """
+  if data[:8] != _PNG_SIGNATURE:
+    raise ValueError('not a PNG')
+  header = None
+  palette = None
+  compressed = []
+  pos = 8
+  while pos + 8 <= len(data):
+    length, kind = struct.unpack('>I4s', data[pos:pos + 8])
+    chunk = data[pos + 8:pos + 8 + length]
+    pos += 12 + length
+    if kind == 'IHDR':
+      header = struct.unpack('>IIBBBBB', chunk)
+    elif kind == 'PLTE':
+      palette = [ord(c) for c in chunk]
+    elif kind == 'IDAT':
+      compressed.append(chunk)
+    elif kind == 'IEND':
+      break
+  if header is None:
+    raise ValueError('PNG has no header')
+  width, height, depth, color_type, unused, unused, interlace = header
+  if (depth != 8 or interlace or color_type not in _PNG_CHANNELS or
+      (color_type == 3 and palette is None)):
+    raise ValueError('unsupported PNG type %d/%d' % (color_type, depth))
+  try:
+    raw = zlib.decompress(''.join(compressed))
+  except zlib.error:
+    raise ValueError('bad PNG data')
+
+  channels = _PNG_CHANNELS[color_type]
+  stride = width * channels
+  if len(raw) < (stride + 1) * height:
+    raise ValueError('truncated PNG')
+  rows = []
+  previous = [0] * stride
+  pos = 0
+  for unused in range(height):
+    line = [ord(c) for c in raw[pos + 1:pos + 1 + stride]]
+    _unfilter(ord(raw[pos]), line, previous, channels)
+    pos += stride + 1
+    previous = line
+    if color_type == 3:
+      rows.append([_gray(*palette[3 * i:3 * i + 3]) for i in line])
+    elif channels >= 3:
+      rows.append([_gray(*line[x:x + 3]) for x in range(0, stride, channels)])
+    else:
+      rows.append(line[::channels])
+  return width, height, rows
+
+
+def _gray(red, green, blue):
+  return (299 * red + 587 * green + 114 * blue) // 1000
+
+
+def _unfilter(filter_type, line, previous, bpp):
+  """Undoes a PNG scanline filter, in place.  Returns line."""
+  if filter_type == 1:
+    for i in range(bpp, len(line)):
+      line[i] = (line[i] + line[i - bpp]) & 0xff
+  elif filter_type == 2:
+    for i in range(len(line)):
+      line[i] = (line[i] + previous[i]) & 0xff
+  elif filter_type == 3:
+    for i in range(len(line)):
+      left = i >= bpp and line[i - bpp] or 0
+      line[i] = (line[i] + (left + previous[i]) // 2) & 0xff
+  elif filter_type == 4:
+    for i in range(len(line)):
+      left = i >= bpp and line[i - bpp] or 0
+      up_left = i >= bpp and previous[i - bpp] or 0
+      up = previous[i]
+      estimate = left + up - up_left
+      a, b, c = abs(estimate - left), abs(estimate - up), \
+          abs(estimate - up_left)
+      if a <= b and a <= c:
+        predicted = left
+      elif b <= c:
+        predicted = up
+      else:
+        predicted = up_left
+      line[i] = (line[i] + predicted) & 0xff
+  elif filter_type != 0:
+    raise ValueError('bad PNG filter %d' % filter_type)
+  return line
+
+
+def difference_hash(width, height, rows):
+  """Returns the 64-bit difference hash of gray rows, as 16 hex digits.
+
+  The image is averaged down to a 9x8 grid; each bit says whether a
+  cell is brighter than the cell to its right.
+  """
+  if width < 9 or height < 8:
+    raise ValueError('image too small to hash')
+  bits = 0
+  for j in range(8):
+    top, bottom = j * height // 8, (j + 1) * height // 8
+    cells = []
+    for i in range(9):
+      left, right = i * width // 9, (i + 1) * width // 9
+      total = 0
+      for row in rows[top:bottom]:
+        total += sum(row[left:right])
+      cells.append(total / float((right - left) * (bottom - top)))
+    for i in range(8):
+      bits = (bits << 1) | (cells[i] > cells[i + 1] and 1 or 0)
+  return '%016x' % bits
+
+
+def distance(hash1, hash2):
+  """Returns the number of bits two hashes differ in."""
+  x = int(hash1, 16) ^ int(hash2, 16)
+  count = 0
+  while x:
+    x &= x - 1
+    count += 1
+  return count
+
+
+def record(user_key, media_id, result):
+  """Remembers a scan's hash, and finds a recent scan it duplicates.
+
+  Must be called inside the processing transaction, which is in the
+  user's entity group.
+
+  Args:
+    user_key: key of the owning UserInfo.
+    media_id: id of the MediaObject checked.
+    result: its Result.
+
+  Returns:
+    The id of the closest recent MediaObject within DUPLICATE_DISTANCE,
+    or None.
+  """
+  if result.blank:
+    return None
+  recent = PageHashes.get_by_key_name(_KEY_NAME, parent=user_key)
+  if recent is None:
+    recent = PageHashes(parent=user_key, key_name=_KEY_NAME)
+  if media_id in recent.media_ids:
+    return None  # Checked by an earlier attempt.
+
+  duplicate_of = None
+  best = DUPLICATE_DISTANCE + 1
+  for other_id, other_hash in zip(recent.media_ids, recent.hashes):
+    bits = distance(result.phash, other_hash)
+    if bits < best:
+      duplicate_of, best = other_id, bits
+
+  recent.media_ids = (recent.media_ids + [media_id])[-RECENT_PAGES:]
+  recent.hashes = (recent.hashes + [result.phash])[-RECENT_PAGES:]
+  recent.put()
+  return duplicate_of
+
+
+def delete_blank(user_key):
+  """Deletes a batch of the user's blank pages not in a document.
+
+  The batch is deleted in one transaction, then its counters, blobs and
+  cached renders are updated all at once.  If there may be more, a task
+  deletes the next batch.
+
+  Returns:
+    The number of pages deleted.
+  """
+  query = MediaObject.all(keys_only=True).ancestor(user_key)
+  query.filter('lacks_document', True).filter('blank', True)
+  keys = query.fetch(DELETE_BATCH_SIZE)
+  if not keys:
+    return 0
+
+  def tx():
+    # One may have been put in a document since the query.
+    pages = [m for m in db.get(keys)
+             if m is not None and m.lacks_document and m.blank]
+    dedup.forget(pages)
+    db.delete(pages)
+    return pages
+  pages = db.run_in_transaction(tx)
+  counters.update(user_key, **counters.media_deltas(pages, -1))
+  dedup.delete_unshared_blobs(user_key, [m.blob.key() for m in pages])
+  imagecache.delete_variants([m.key() for m in pages])
+  if len(keys) == DELETE_BATCH_SIZE:
+    taskqueue.add(queue_name=QUEUE_NAME, url=TASK_URL,
+                  params={'user': str(user_key)})
+  return len(pages)
@@ -0,0 +1,155 @@
+#
+# scanningcabinet's AppEngine server-side code.
+#
+# Copyright 2009 Brad Fitzpatrick <brad@danga.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Cursor-based paging of datastore queries, forwards and backwards.
+
+A page token is opaque to callers: a direction letter followed by a
+websafe datastore cursor, always expressed in the forward query's
+order.  'f' means "the page starting at the cursor", 'b' means "the
+page ending at the cursor".  Backward pages run the reverse-ordered
+query from the reversed cursor, so every page costs one query of
+page_size results no matter how deep it is.
+
+For reversing to work, forward and reverse queries must have exactly
+opposite sort orders, ending in __key__ as a tie-breaker.
+
+Tokens come from URLs, so a garbled one, or one from another query,
+gets the first page rather than an error.
+"""
+
+import logging
+
+from google.appengine.api import datastore_errors
+from google.appengine.datastore import datastore_query
+
+# Hard cap on results per page, whatever the URL asks for.
+MAX_PAGE_SIZE = 200
+
+
+class Page(object):
+  """One page of query results."""
+
+  def __init__(self, items, next_token, prev_token):
+    self.items = items
+    self.next_token = next_token  # None if (probably) no next page.
+    self.prev_token = prev_token  # None if no previous page.
+
+
+def clamp_page_size(value, default):
+  """Parses a user-supplied page size, bounded to [1, MAX_PAGE_SIZE]."""
+  try:
+    size = int(value)
+  except (TypeError, ValueError):
+    return default
+  return max(1, min(size, MAX_PAGE_SIZE))
+
+
+def _reverse_cursor(websafe_cursor):
+  cursor = datastore_query.Cursor.from_websafe_string(websafe_cursor)
+  return cursor.reversed().to_websafe_string()
+
+
+def _parse_token(token):
+  """Returns (backward, websafe cursor) for a page token.
+
+  Returns (False, None), the first page, for an empty or invalid token.
+  """
+  if not token:
+    return False, None
+  if token[0] not in 'fb' or len(token) < 2:
+    logging.info("Ignoring bad page token %r", token)
+    return False, None
+  try:
+    datastore_query.Cursor.from_websafe_string(token[1:])
+  except (datastore_errors.BadValueError, TypeError, ValueError):
+    logging.info("Ignoring bad page token %r", token)
+    return False, None
+  return token[0] == 'b', token[1:]
+
+
+class _PageFetch(object):
+  """An in-flight page fetch; see fetch_pages."""
+
+  def __init__(self, make_query, page_size, token):
+    self.make_query = make_query
+    self.page_size = page_size
+    self.backward, self.cursor = _parse_token(token)
+    self.query = make_query(self.backward)
+    try:
+      if self.cursor and self.backward:
+        self.query.with_cursor(_reverse_cursor(self.cursor))
+      elif self.cursor:
+        self.query.with_cursor(self.cursor)
+      self.results = self.query.run(limit=page_size, batch_size=page_size)
+    except (datastore_errors.BadValueError,
+            datastore_errors.BadRequestError):
+      if not self.cursor:
+        raise
+      self._restart()
+
+  def _restart(self):
+    """Runs the first page instead, for a cursor the query rejected."""
+    logging.info("Ignoring page cursor %r", self.cursor)
+    self.backward, self.cursor = False, None
+    self.query = self.make_query(False)
+    self.results = self.query.run(limit=self.page_size,
+                                  batch_size=self.page_size)
+
+  def page(self):
+    try:
+      items = list(self.results)
+    except (datastore_errors.BadValueError,
+            datastore_errors.BadRequestError):
+      if not self.cursor:
+        raise
+      self._restart()
+      items = list(self.results)
+    full = len(items) == self.page_size
+    end_cursor = items and self.query.cursor() or None
+    if not self.backward:
+      next_token = full and 'f' + end_cursor or None
+      prev_token = self.cursor and 'b' + self.cursor or None
+      return Page(items, next_token, prev_token)
+
+    items.reverse()
+    next_token = 'f' + self.cursor
+    prev_token = None
+    if full:
+      prev_token = 'b' + _reverse_cursor(end_cursor)
+    return Page(items, next_token, prev_token)
+
+
+def fetch_pages(requests):
+  """Fetches several pages concurrently.
+
+  Args:
+    requests: list of (make_query, page_size, token).  make_query is
+      called with reverse=True/False and must return a db.Query in
+      forward or reverse order.  token is '' for the first page.
+
+  Returns:
+    List of Page objects, in request order.
+  """
+  fetches = [_PageFetch(make_query, page_size, token)
+             for make_query, page_size, token in requests]
+  return [f.page() for f in fetches]
+
+
+def fetch_page(make_query, page_size, token):
+  """Fetches a single page.  See fetch_pages."""
+  return fetch_pages([(make_query, page_size, token)])[0]
@@ -0,0 +1,174 @@
+#
+# scanningcabinet's AppEngine server-side code.
+#
+# Copyright 2009 Brad Fitzpatrick <brad@danga.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Background processing of newly uploaded MediaObjects.
+
+Uploads enqueue a task (in the same transaction that creates the
+MediaObject) on the media-processing queue, which queue.yaml limits to
+a few concurrent workers with exponential backoff on retries.  The task
+fills in width, height and content type, and renders the thumbnail and
+document-view sizes into the image cache so the first home page load
+after a big batch doesn't have to.  The document-view rendering is then
+checked for being a blank page or a near-duplicate (pagecheck.py).
+"""
+
+import datetime
+import logging
+import mimetypes
+
+from google.appengine.api import images
+from google.appengine.api import taskqueue
+from google.appengine.ext import blobstore
+from google.appengine.ext import db
+
+import imagecache
+import pagecheck
+
+QUEUE_NAME = 'media-processing'
+TASK_URL = '/tasks/process_media'
+
+# Sizes pre-rendered into the image cache: MediaObject.thumb_url and
+# ShowDocHandler's default.
+PRERENDER_SIZES = (300, 1200)
+
+# How much of a blob to read to find the image dimensions in its
+# header, and the most we'll read if the header alone isn't enough.
+HEADER_BYTES = 64 * 1024
+MAX_FULL_READ_BYTES = 16 * 1024 * 1024
+
+# After this many failed attempts a media object is marked 'failed'
+# instead of retried again.
+MAX_ATTEMPTS = 5
+
+
+def enqueue(media_keys, transactional=False):
+  """Queues post-upload processing of some MediaObjects.
+
+  Args:
+    media_keys: keys of the MediaObjects to process, in one task.
+    transactional: enqueue only if the current transaction commits.
+  """
+  taskqueue.add(queue_name=QUEUE_NAME,
+                url=TASK_URL,
+                params={'key': [str(k) for k in media_keys]},
+                transactional=transactional)
+
+
+def image_dimensions(blob_key):
+  """Returns (width, height) of an image blob, or (None, None)."""
+  data = blobstore.fetch_data(blob_key, 0, HEADER_BYTES - 1)
+  try:
+    image = images.Image(image_data=data)
+    return image.width, image.height
+  except (images.BadImageError, images.NotImageError):
+    pass
+
+  blob_info = blobstore.BlobInfo.get(blob_key)
+  if blob_info is None or blob_info.size > MAX_FULL_READ_BYTES:
+    return None, None
+  try:
+    image = images.Image(image_data=blobstore.BlobReader(blob_key).read())
+    return image.width, image.height
+  except (images.BadImageError, images.NotImageError):
+    return None, None
+
+
+def process(media):
+  """Fills in a MediaObject's derived metadata and pre-renders sizes."""
+  content_type = media.content_type
+  if content_type in (None, 'application/octet-stream'):
+    guessed, unused_encoding = mimetypes.guess_type(media.filename or '')
+    if guessed:
+      content_type = guessed
+
+  width, height = media.width, media.height
+  check = None
+  if media.is_image:
+    width, height = image_dimensions(media.blob.key())
+    renders = [imagecache.get_resized(media, size)[0]
+               for size in PRERENDER_SIZES]
+    check = pagecheck.check(renders[-1])  # The document-view size.
+
+  # Re-read in a transaction: the user may have put this scan into a
+  # document while we were rendering.
+  def tx():
+    current = db.get(media.key())
+    if current is None:
+      return None
+    current.content_type = content_type
+    current.width = width
+    current.height = height
+    if check is not None:
+      current.ink_coverage = check.ink_coverage
+      current.blank = check.blank
+      current.phash = check.phash
+      current.duplicate_of_id = pagecheck.record(
+          media.parent_key(), media.key().id(), check)
+    current.processing_state = 'done'
+    current.processed = datetime.datetime.now()
+    current.put()
+    return current
+  current = db.run_in_transaction(tx)
+
+  if current is not None and current.blank:
+    if pagecheck.DROP_BLANK_PAGES and current.lacks_document:
+      logging.info("Dropping blank page %s", current.key())
+      current.delete()
+    else:
+      logging.info("Blank page %s (ink %.5f)", current.key(),
+                   current.ink_coverage)
+
+
+def mark_failed(media_keys):
+  """Gives up on processing; views fall back to rendering lazily."""
+  for media_key in media_keys:
+    def tx():
+      media = db.get(media_key)
+      if media is not None and media.processing_state != 'done':
+        media.processing_state = 'failed'
+        media.put()
+    db.run_in_transaction(tx)
+
+
+def process_task(media_keys, attempt):
+  """Runs one processing task.
+
+  Args:
+    media_keys: keys of the MediaObjects to process.
+    attempt: how many times this task has been tried before.
+
+  Returns:
+    True if done (successfully or not), False to have the task retried.
+  """
+  if attempt >= MAX_ATTEMPTS:
+    logging.error("Giving up processing %s after %d attempts",
+                  media_keys, attempt)
+    mark_failed(media_keys)
+    return True
+
+  ok = True
+  for media in db.get(media_keys):
+    if media is None or media.processing_state == 'done':
+      continue  # Deleted, or done by an earlier attempt.
+    try:
+      process(media)
+    except (images.Error, blobstore.Error, db.Error):
+      logging.exception("Processing %s failed (attempt %d)",
+                        media.key(), attempt)
+      ok = False
+  return ok
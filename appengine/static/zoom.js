@@ -0,0 +1,223 @@
+// Zoomable views of scanned pages, built from tile pyramids (tiles.py).
+//
+// Each <div class="zoom"> on the page, with data-tiles (tile URL
+// prefix), data-width, data-height, data-max-zoom, data-tile-size and
+// data-view-width attributes, becomes a viewport showing its page at
+// the view width.  Click or scroll to zoom in on a point, shift-click
+// to zoom out, drag to pan.
+//
+// A stretched single-tile overview shows at once.  Over it, only the
+// tiles in view are fetched, from the coarsest level that is still
+// sharp at the current zoom.
+
+(function() {
+
+  // Screen pixels per scan pixel when fully zoomed in.
+  var MAX_SCALE = 2;
+
+  // Mouse movement, in pixels, beyond which a click is a drag.
+  var DRAG_THRESHOLD = 3;
+
+  function listen(el, type, fn) {
+    if (el.addEventListener) {
+      el.addEventListener(type, fn, false);
+    } else {
+      el.attachEvent('on' + type, function() { return fn(window.event); });
+    }
+  }
+
+  function stop(e) {
+    if (e.preventDefault) {
+      e.preventDefault();
+    }
+    e.returnValue = false;
+    return false;
+  }
+
+  function intAttr(el, name) {
+    return parseInt(el.getAttribute('data-' + name), 10);
+  }
+
+  function place(img, x, y, w, h) {
+    var left = Math.floor(x), top = Math.floor(y);
+    img.style.left = left + 'px';
+    img.style.top = top + 'px';
+    img.style.width = (Math.ceil(x + w) - left) + 'px';
+    img.style.height = (Math.ceil(y + h) - top) + 'px';
+  }
+
+  function Viewer(el) {
+    this.base = el.getAttribute('data-tiles');
+    this.width = intAttr(el, 'width');
+    this.height = intAttr(el, 'height');
+    this.maxZoom = intAttr(el, 'max-zoom');
+    this.tileSize = intAttr(el, 'tile-size');
+    this.viewWidth = Math.min(intAttr(el, 'view-width') || this.width,
+                              this.width);
+    this.minScale = this.viewWidth / this.width;
+    this.viewHeight = Math.round(this.height * this.minScale);
+
+    // Screen pixels per scan pixel, and where the page's top left is
+    // in the viewport.
+    this.scale = this.minScale;
+    this.x = 0;
+    this.y = 0;
+
+    el.innerHTML = '';
+    this.viewport = document.createElement('div');
+    this.viewport.className = 'zoom-viewport';
+    this.viewport.style.width = this.viewWidth + 'px';
+    this.viewport.style.height = this.viewHeight + 'px';
+    el.appendChild(this.viewport);
+    var help = document.createElement('div');
+    help.className = 'zoom-help';
+    help.innerHTML = 'Click or scroll to zoom in, shift-click to zoom ' +
+        'out, drag to move.';
+    el.appendChild(help);
+
+    this.overview = this.addImage(this.tileUrl(0, 0, 0));
+    this.tiles = {};  // "zoom/col/row" -> img
+    this.listen();
+    this.draw();
+  }
+
+  Viewer.prototype.tileUrl = function(zoom, col, row) {
+    return this.base + '/' + zoom + '/' + col + '/' + row;
+  };
+
+  Viewer.prototype.addImage = function(src) {
+    var img = document.createElement('img');
+    img.src = src;
+    img.ondragstart = function() { return false; };
+    this.viewport.appendChild(img);
+    return img;
+  };
+
+  Viewer.prototype.draw = function() {
+    var scale = this.scale, size = this.tileSize;
+    place(this.overview, this.x, this.y, this.width * scale,
+          this.height * scale);
+
+    // The coarsest level with at least one pixel per screen pixel.
+    var zoom = this.maxZoom +
+        Math.ceil(Math.log(scale) / Math.LN2 - 1e-9);
+    zoom = Math.max(0, Math.min(this.maxZoom, zoom));
+    var factor = Math.pow(2, this.maxZoom - zoom);  // scan px per level px
+    var levelWidth = Math.ceil(this.width / factor);
+    var levelHeight = Math.ceil(this.height / factor);
+    var step = size * factor * scale;  // screen px per tile
+
+    var col0 = Math.max(0, Math.floor(-this.x / step));
+    var col1 = Math.min(Math.ceil(levelWidth / size) - 1,
+                        Math.floor((this.viewWidth - this.x) / step));
+    var row0 = Math.max(0, Math.floor(-this.y / step));
+    var row1 = Math.min(Math.ceil(levelHeight / size) - 1,
+                        Math.floor((this.viewHeight - this.y) / step));
+
+    var wanted = {};
+    for (var row = row0; row <= row1; row++) {
+      for (var col = col0; col <= col1; col++) {
+        var key = zoom + '/' + col + '/' + row;
+        wanted[key] = true;
+        var img = this.tiles[key];
+        if (!img) {
+          img = this.tiles[key] = this.addImage(this.tileUrl(zoom, col, row));
+        }
+        var w = Math.min(size, levelWidth - col * size);
+        var h = Math.min(size, levelHeight - row * size);
+        place(img, this.x + col * step, this.y + row * step,
+              w * factor * scale, h * factor * scale);
+        img.style.display = '';
+      }
+    }
+    for (var k in this.tiles) {
+      if (!wanted[k]) {
+        this.tiles[k].style.display = 'none';
+      }
+    }
+  };
+
+  // Keeps the page covering the viewport, or centered if it's smaller.
+  Viewer.prototype.clamp = function() {
+    var w = this.width * this.scale, h = this.height * this.scale;
+    if (w <= this.viewWidth) {
+      this.x = (this.viewWidth - w) / 2;
+    } else {
+      this.x = Math.min(0, Math.max(this.viewWidth - w, this.x));
+    }
+    if (h <= this.viewHeight) {
+      this.y = (this.viewHeight - h) / 2;
+    } else {
+      this.y = Math.min(0, Math.max(this.viewHeight - h, this.y));
+    }
+  };
+
+  // Zooms by factor, keeping the viewport point (px, py) still.
+  Viewer.prototype.zoomAt = function(px, py, factor) {
+    var scale = Math.max(this.minScale,
+                         Math.min(MAX_SCALE, this.scale * factor));
+    this.x = px - (px - this.x) * scale / this.scale;
+    this.y = py - (py - this.y) * scale / this.scale;
+    this.scale = scale;
+    this.clamp();
+    this.draw();
+  };
+
+  Viewer.prototype.point = function(e) {
+    var rect = this.viewport.getBoundingClientRect();
+    return [e.clientX - rect.left, e.clientY - rect.top];
+  };
+
+  Viewer.prototype.listen = function() {
+    var self = this;
+    var drag = null;
+
+    listen(this.viewport, 'mousedown', function(e) {
+      drag = {x: e.clientX, y: e.clientY, startX: self.x, startY: self.y,
+              moved: false};
+      return stop(e);
+    });
+    listen(document, 'mousemove', function(e) {
+      if (!drag) {
+        return;
+      }
+      var dx = e.clientX - drag.x, dy = e.clientY - drag.y;
+      if (Math.abs(dx) > DRAG_THRESHOLD || Math.abs(dy) > DRAG_THRESHOLD) {
+        drag.moved = true;
+      }
+      if (drag.moved) {
+        self.x = drag.startX + dx;
+        self.y = drag.startY + dy;
+        self.clamp();
+        self.draw();
+      }
+    });
+    listen(document, 'mouseup', function(e) {
+      if (drag && !drag.moved) {
+        var p = self.point(e);
+        self.zoomAt(p[0], p[1], e.shiftKey ? 0.5 : 2);
+      }
+      drag = null;
+    });
+
+    function wheel(e) {
+      var delta = e.wheelDelta ? e.wheelDelta : -(e.detail || e.deltaY);
+      var p = self.point(e);
+      self.zoomAt(p[0], p[1], delta > 0 ? 1.25 : 0.8);
+      return stop(e);
+    }
+    listen(this.viewport, 'mousewheel', wheel);
+    listen(this.viewport, 'DOMMouseScroll', wheel);
+  };
+
+  var divs = document.getElementsByTagName('div');
+  var zoomable = [];
+  for (var i = 0; i < divs.length; i++) {
+    if (/(^|\s)zoom(\s|$)/.test(divs[i].className)) {
+      zoomable.push(divs[i]);
+    }
+  }
+  for (var j = 0; j < zoomable.length; j++) {
+    new Viewer(zoomable[j]);
+  }
+})();
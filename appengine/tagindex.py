@@ -0,0 +1,375 @@
+#
+# scanningcabinet's AppEngine server-side code.
+#
+# Copyright 2009 Brad Fitzpatrick <brad@danga.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Inverted index from tags to documents, plus per-tag counts.
+
+Each tag has a TagPosting holding the sorted ids of the documents that
+have it, and the user's TagCloud holds every tag's document count.  Both
+live in the user's entity group, so they are updated in the same
+transaction as the Document itself.
+
+Queries are comma-separated tags:
+
+  insurance, car         documents with either tag (union)
+  insurance, +audi       ... and which also have "audi"
+  insurance, -2008       ... but not "2008"
+
+rebuild() rebuilds a user's postings and cloud in a chain of tasks.
+Live postings are overwritten in place, never cleared first, so tag
+search keeps working while it runs.
+"""
+
+import bisect
+import hashlib
+import re
+import time
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+
+from model import Document
+from model import TagCloud
+from model import TagPosting
+
+_CLOUD_KEY_NAME = 'tagcloud'
+
+QUEUE_NAME = 'reindex'
+TASK_URL = '/tasks/reindex_tags'
+
+# Documents read per rebuild task, and postings reconciled per task,
+# each in its own transaction.
+REBUILD_BATCH_SIZE = 50
+RECONCILE_BATCH_SIZE = 20
+
+# Font sizes (in ems) for the tag cloud, least to most used.
+CLOUD_SIZES = (0.8, 1.0, 1.2, 1.5, 1.9)
+
+
+def split_tags(text):
+  """Splits a comma-separated tag string into a list of tags."""
+  return [x for x in re.split(r'\s*,\s*', text.strip()) if x]
+
+
+def _posting_key(user_key, tag):
+  return db.Key.from_path('TagPosting', 'tag:%s' % tag, parent=user_key)
+
+
+def update_document_tags(user_key, doc_id, old_tags, new_tags):
+  """Moves a document from its old tags' postings to its new tags'.
+
+  Must be called inside the transaction that writes the Document (all
+  the entities involved are in the user's entity group).
+
+  Args:
+    user_key: key of the owning UserInfo.
+    doc_id: numeric id of the Document.
+    old_tags: tags the document had before (empty for a new document).
+    new_tags: tags it has now (empty if it's being deleted).
+  """
+  removed = set(old_tags) - set(new_tags)
+  added = set(new_tags) - set(old_tags)
+  changed = sorted(removed | added)
+  if not changed:
+    return
+
+  postings = db.get([_posting_key(user_key, tag) for tag in changed])
+  cloud = TagCloud.get_by_key_name(_CLOUD_KEY_NAME, parent=user_key)
+  if cloud is None:
+    cloud = TagCloud(parent=user_key, key_name=_CLOUD_KEY_NAME)
+  counts = dict(zip(cloud.tags, cloud.counts))
+
+  to_put = [cloud]
+  to_delete = []
+  for tag, posting in zip(changed, postings):
+    if posting is None:
+      posting = TagPosting(parent=user_key, key_name='tag:%s' % tag)
+    ids = posting.doc_ids
+    i = bisect.bisect_left(ids, doc_id)
+    present = i < len(ids) and ids[i] == doc_id
+    if tag in added and not present:
+      ids.insert(i, doc_id)
+    elif tag in removed and present:
+      del ids[i]
+
+    if ids:
+      to_put.append(posting)
+      counts[tag] = len(ids)
+    else:
+      if posting.is_saved():
+        to_delete.append(posting)
+      counts.pop(tag, None)
+
+  cloud.tags = sorted(counts)
+  cloud.counts = [long(counts[tag]) for tag in cloud.tags]
+  db.put(to_put)
+  if to_delete:
+    db.delete(to_delete)
+
+
+def parse_query(text):
+  """Parses a tag query.
+
+  Returns:
+    (any_tags, all_tags, none_tags) lists.
+  """
+  any_tags, all_tags, none_tags = [], [], []
+  for term in split_tags(text):
+    if term.startswith('+') and term[1:].strip():
+      all_tags.append(term[1:].strip())
+    elif term.startswith('-') and term[1:].strip():
+      none_tags.append(term[1:].strip())
+    else:
+      any_tags.append(term)
+  return any_tags, all_tags, none_tags
+
+
+def search(user_key, text):
+  """Returns sorted ids of the documents matching a tag query.
+
+  A query with only excluded (-tag) terms matches nothing.
+  """
+  any_tags, all_tags, none_tags = parse_query(text)
+  if not any_tags and not all_tags:
+    return []
+
+  tags = any_tags + all_tags + none_tags
+  postings = db.get([_posting_key(user_key, tag) for tag in tags])
+  ids_for = {}
+  for tag, posting in zip(tags, postings):
+    ids_for[tag] = posting and posting.doc_ids or []
+
+  # Intersect smallest first, so the running result shrinks fastest.
+  required = sorted([ids_for[tag] for tag in all_tags], key=len)
+  if any_tags:
+    result = []
+    for tag in any_tags:
+      result = union(result, ids_for[tag])
+  else:
+    result = required.pop(0)
+  for ids in required:
+    if not result:
+      break
+    result = intersect(result, ids)
+  for tag in none_tags:
+    result = difference(result, ids_for[tag])
+  return result
+
+
+def union(a, b):
+  """Merges two sorted id lists into their sorted union."""
+  result = []
+  i = j = 0
+  while i < len(a) and j < len(b):
+    if a[i] < b[j]:
+      result.append(a[i])
+      i += 1
+    elif b[j] < a[i]:
+      result.append(b[j])
+      j += 1
+    else:
+      result.append(a[i])
+      i += 1
+      j += 1
+  result.extend(a[i:])
+  result.extend(b[j:])
+  return result
+
+
+def intersect(a, b):
+  """Returns the sorted ids present in both sorted lists."""
+  result = []
+  i = j = 0
+  while i < len(a) and j < len(b):
+    if a[i] < b[j]:
+      i += 1
+    elif b[j] < a[i]:
+      j += 1
+    else:
+      result.append(a[i])
+      i += 1
+      j += 1
+  return result
+
+
+def difference(a, b):
+  """Returns the sorted ids in a but not in b."""
+  result = []
+  j = 0
+  for x in a:
+    while j < len(b) and b[j] < x:
+      j += 1
+    if j >= len(b) or b[j] != x:
+      result.append(x)
+  return result
+
+
+def tag_cloud(user_key):
+  """Returns the user's tags as a list of dicts for the template.
+
+  Each dict has "tag", "count" and "size" (font size in ems).  Reads
+  one entity; never scans documents.
+  """
+  cloud = TagCloud.get_by_key_name(_CLOUD_KEY_NAME, parent=user_key)
+  if cloud is None or not cloud.tags:
+    return []
+  top = max(cloud.counts)
+  result = []
+  for tag, count in zip(cloud.tags, cloud.counts):
+    bucket = (len(CLOUD_SIZES) - 1) * count // top
+    result.append({"tag": tag, "count": count,
+                   "size": CLOUD_SIZES[bucket]})
+  return result
+
+
+def rebuild(user_info):
+  """Starts rebuilding a user's tag postings and cloud from their Documents.
+
+  A chain of tasks (see rebuild_step) collects each tag's document ids
+  into a staging posting, then sets each live posting from its staging
+  copy, and last recounts the cloud.
+  """
+  run = '%d' % (time.time() * 1000)
+  _enqueue_rebuild(user_info.key(), run, 'docs', '', 0)
+
+
+def _enqueue_rebuild(user_key, run, phase, cursor, step):
+  # Named per step, so a retried task can't fork the chain in two.
+  digest = hashlib.md5(str(user_key)).hexdigest()
+  try:
+    taskqueue.add(queue_name=QUEUE_NAME,
+                  url=TASK_URL,
+                  name='retag-%s-%s-%d' % (digest[:16], run, step),
+                  params={'user': str(user_key), 'run': run, 'phase': phase,
+                          'cursor': cursor, 'step': step})
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass
+
+
+def _staging_key(user_key, run, tag):
+  return db.Key.from_path('TagPosting', 'rebuild:%s:%s' % (run, tag),
+                          parent=user_key)
+
+
+def _postings_query(user_key, prefix, keys_only=False):
+  """Returns a query for the user's TagPostings named prefix + anything."""
+  query = TagPosting.all(keys_only=keys_only).ancestor(user_key)
+  query.filter('__key__ >=',
+               db.Key.from_path('TagPosting', prefix, parent=user_key))
+  return query.filter('__key__ <', db.Key.from_path(
+      'TagPosting', prefix + u'\ufffd', parent=user_key))
+
+
+def rebuild_step(user_key, run, phase, cursor, step):
+  """Runs one task of a rebuild, and queues the next.
+
+  Args:
+    user_key: key of the UserInfo whose index is rebuilt.
+    run: identifies the rebuild, for task and staging posting names.
+    phase: 'docs' while staging the user's Documents' tags, 'live'
+      while setting the existing postings, 'new' for tags that had no
+      posting, then 'cloud'.
+    cursor: where in the phase's query this task starts.
+    step: number of this task in the chain.
+  """
+  if phase == 'docs':
+    query = Document.all().ancestor(user_key)
+    if cursor:
+      query.with_cursor(cursor)
+    docs = query.fetch(REBUILD_BATCH_SIZE)
+    if docs:
+      db.run_in_transaction(_stage, user_key, run, docs)
+    if len(docs) == REBUILD_BATCH_SIZE:
+      _enqueue_rebuild(user_key, run, 'docs', query.cursor(), step + 1)
+    else:
+      _enqueue_rebuild(user_key, run, 'live', '', step + 1)
+  elif phase in ('live', 'new'):
+    if phase == 'live':
+      prefix = _posting_key(user_key, '').name()
+    else:
+      prefix = _staging_key(user_key, run, '').name()
+    query = _postings_query(user_key, prefix, keys_only=True)
+    if cursor:
+      query.with_cursor(cursor)
+    keys = query.fetch(RECONCILE_BATCH_SIZE)
+    for key in keys:
+      db.run_in_transaction(_reconcile, user_key, run,
+                            key.name()[len(prefix):])
+    if len(keys) == RECONCILE_BATCH_SIZE:
+      _enqueue_rebuild(user_key, run, phase, query.cursor(), step + 1)
+    elif phase == 'live':
+      _enqueue_rebuild(user_key, run, 'new', '', step + 1)
+    else:
+      _enqueue_rebuild(user_key, run, 'cloud', '', step + 1)
+  else:
+    db.run_in_transaction(_recount_cloud, user_key)
+
+
+def _stage(user_key, run, docs):
+  """Adds documents' ids to their tags' staging postings."""
+  ids_for = {}
+  for doc in docs:
+    for tag in set(doc.tags):
+      ids_for.setdefault(tag, []).append(doc.key().id())
+  tags = sorted(ids_for)
+  keys = [_staging_key(user_key, run, tag) for tag in tags]
+  postings = db.get(keys)
+  for i, (tag, key) in enumerate(zip(tags, keys)):
+    if postings[i] is None:
+      postings[i] = TagPosting(key=key)
+    postings[i].doc_ids = union(postings[i].doc_ids, sorted(ids_for[tag]))
+  db.put(postings)
+
+
+def _reconcile(user_key, run, tag):
+  """Sets a tag's live posting from its staging copy, then deletes that.
+
+  Documents edited since they were staged may be in one posting but not
+  the other, so those are looked up to see whether they have the tag.
+  """
+  live_key = _posting_key(user_key, tag)
+  staging_key = _staging_key(user_key, run, tag)
+  live, staged = db.get([live_key, staging_key])
+  live_ids = set(live and live.doc_ids or [])
+  staged_ids = set(staged and staged.doc_ids or [])
+  ids = live_ids & staged_ids
+  disputed = sorted(live_ids ^ staged_ids)
+  for i in range(0, len(disputed), 500):
+    batch = disputed[i:i + 500]
+    docs = db.get([db.Key.from_path('Document', doc_id, parent=user_key)
+                   for doc_id in batch])
+    for doc_id, doc in zip(batch, docs):
+      if doc is not None and tag in doc.tags:
+        ids.add(doc_id)
+
+  if staged is not None:
+    db.delete(staged)
+  if ids:
+    TagPosting(key=live_key, doc_ids=sorted(ids)).put()
+  elif live is not None:
+    db.delete(live)
+
+
+def _recount_cloud(user_key):
+  """Sets the tag cloud's counts from the live postings."""
+  prefix = _posting_key(user_key, '').name()
+  counts = {}
+  for posting in _postings_query(user_key, prefix):
+    counts[posting.key().name()[len(prefix):]] = len(posting.doc_ids)
+  tags = sorted(counts)
+  TagCloud(parent=user_key, key_name=_CLOUD_KEY_NAME, tags=tags,
+           counts=[long(counts[tag]) for tag in tags]).put()
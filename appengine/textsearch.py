@@ -0,0 +1,416 @@
+#
+# scanningcabinet's AppEngine server-side code.
+#
+# Copyright 2009 Brad Fitzpatrick <brad@danga.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Full-text index over Document title, description, tags and location.
+
+Like tagindex, postings live in the user's entity group and are updated
+in the same transaction as the Document.  Every word is a term, and so
+is every pair of adjacent words in a field ("state farm"), which is how
+phrase queries are answered without storing positions.  Postings are
+split into NUM_SHARDS entities by document id to keep each one well
+under the 1MB entity limit.
+
+Query syntax, all clauses must match:
+
+  farm                 a word
+  insur*               any word starting with "insur"
+  "state farm"         a phrase
+
+Results are ranked by the sum over query words of the field weights
+the word appears in, times its inverse document frequency.
+
+A query is a few batch gets (lexicons, postings, index info), however
+big the archive is.
+
+A document is indexed under at most MAX_TERMS_PER_DOC terms, so that
+re-indexing it inside its transaction writes well under the 500
+entities a transaction may put.  Single words are kept before pairs,
+and heavier ones before lighter ones, so a long description loses its
+pairs of words first.
+
+rebuild() re-indexes a library in a chain of tasks, REBUILD_BATCH_SIZE
+documents each, rather than in one request.
+"""
+
+import bisect
+import hashlib
+import math
+import re
+import time
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+
+from model import Document
+from model import SearchIndexInfo
+from model import SearchLexicon
+from model import SearchPosting
+
+NUM_SHARDS = 4
+
+MAX_TERMS_PER_DOC = 100
+
+# How much a word counts, depending on which field it's in.
+FIELD_WEIGHTS = (
+    ('title', 4),
+    ('tags', 3),
+    ('physical_location', 2),
+    ('description', 1),
+    )
+
+# A prefix query matches at most this many distinct words (the most
+# common ones).
+MAX_PREFIX_EXPANSION = 50
+
+QUEUE_NAME = 'reindex'
+TASK_URL = '/tasks/reindex_text'
+
+# Documents re-indexed per rebuild task, each in its own transaction,
+# and stale index entities deleted per task before that.
+REBUILD_BATCH_SIZE = 20
+CLEAR_BATCH_SIZE = 500
+
+_INFO_KEY_NAME = 'ftinfo'
+
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+_QUERY_RE = re.compile(r'"([^"]*)"|(\S+)', re.UNICODE)
+
+
+def tokenize(text):
+  """Returns the lowercased words of text."""
+  if not text:
+    return []
+  return _WORD_RE.findall(text.lower())
+
+
+def document_terms(doc):
+  """Returns {term: weight} for everything a Document is indexed under.
+
+  At most MAX_TERMS_PER_DOC of them; see the module docstring.
+  """
+  terms = {}
+  for field, weight in FIELD_WEIGHTS:
+    if field == 'tags':
+      texts = doc.tags or []
+    else:
+      texts = [getattr(doc, field)]
+    for text in texts:
+      words = tokenize(text)
+      for i, word in enumerate(words):
+        terms[word] = terms.get(word, 0) + weight
+        if i:
+          bigram = words[i - 1] + ' ' + word
+          terms[bigram] = terms.get(bigram, 0) + weight
+  if len(terms) > MAX_TERMS_PER_DOC:
+    ranked = sorted(terms, key=lambda t: (' ' in t, -terms[t], t))
+    terms = dict([(t, terms[t]) for t in ranked[:MAX_TERMS_PER_DOC]])
+  return terms
+
+
+def _posting_key(user_key, term, shard):
+  return db.Key.from_path('SearchPosting', 'ft:%s:%d' % (term, shard),
+                          parent=user_key)
+
+
+def _lexicon_key(user_key, first_char):
+  return db.Key.from_path('SearchLexicon', 'lex:%s' % first_char,
+                          parent=user_key)
+
+
+def update_document(user_key, doc_id, old_terms, new_terms):
+  """Re-indexes one document.
+
+  Must be called inside the transaction that writes the Document.
+
+  Args:
+    user_key: key of the owning UserInfo.
+    doc_id: numeric id of the Document.
+    old_terms: document_terms() of the document as it was before ({} if
+      it's new).
+    new_terms: document_terms() of it now ({} if it's being deleted).
+  """
+  changed = sorted([t for t in set(old_terms) | set(new_terms)
+                    if old_terms.get(t) != new_terms.get(t)])
+  if not changed:
+    return
+
+  shard = doc_id % NUM_SHARDS
+  to_put = []
+  to_delete = []
+
+  postings = db.get([_posting_key(user_key, t, shard) for t in changed])
+  for term, posting in zip(changed, postings):
+    if posting is None:
+      posting = SearchPosting(parent=user_key,
+                              key_name='ft:%s:%d' % (term, shard))
+    i = bisect.bisect_left(posting.doc_ids, doc_id)
+    present = i < len(posting.doc_ids) and posting.doc_ids[i] == doc_id
+    weight = new_terms.get(term)
+    if weight and present:
+      posting.weights[i] = long(weight)
+    elif weight:
+      posting.doc_ids.insert(i, doc_id)
+      posting.weights.insert(i, long(weight))
+    elif present:
+      del posting.doc_ids[i]
+      del posting.weights[i]
+    if posting.doc_ids:
+      to_put.append(posting)
+    elif posting.is_saved():
+      to_delete.append(posting)
+
+  # Document frequencies of single words that appeared or disappeared.
+  df_deltas = {}
+  for term in changed:
+    if ' ' in term:
+      continue
+    if term in new_terms and term not in old_terms:
+      df_deltas[term] = 1
+    elif term in old_terms and term not in new_terms:
+      df_deltas[term] = -1
+  first_chars = sorted(set([term[0] for term in df_deltas]))
+  lexicons = db.get([_lexicon_key(user_key, c) for c in first_chars])
+  for first_char, lexicon in zip(first_chars, lexicons):
+    if lexicon is None:
+      lexicon = SearchLexicon(parent=user_key, key_name='lex:%s' % first_char)
+    for term in [t for t in df_deltas if t[0] == first_char]:
+      i = bisect.bisect_left(lexicon.terms, term)
+      if i < len(lexicon.terms) and lexicon.terms[i] == term:
+        lexicon.dfs[i] += df_deltas[term]
+        if lexicon.dfs[i] <= 0:
+          del lexicon.terms[i]
+          del lexicon.dfs[i]
+      elif df_deltas[term] > 0:
+        lexicon.terms.insert(i, term)
+        lexicon.dfs.insert(i, long(1))
+    if lexicon.terms:
+      to_put.append(lexicon)
+    elif lexicon.is_saved():
+      to_delete.append(lexicon)
+
+  if bool(old_terms) != bool(new_terms):
+    info = SearchIndexInfo.get_by_key_name(_INFO_KEY_NAME, parent=user_key)
+    if info is None:
+      info = SearchIndexInfo(parent=user_key, key_name=_INFO_KEY_NAME)
+    info.doc_count = max(0, info.doc_count + (new_terms and 1 or -1))
+    to_put.append(info)
+
+  db.put(to_put)
+  if to_delete:
+    db.delete(to_delete)
+
+
+def parse_query(text):
+  """Parses a search query into clauses.
+
+  Returns:
+    List of (kind, value) with kind 'word', 'prefix' or 'phrase'.  A
+    phrase's value is its list of words.
+  """
+  clauses = []
+  for phrase, word in _QUERY_RE.findall(text or ''):
+    if phrase:
+      words = tokenize(phrase)
+      if len(words) == 1:
+        clauses.append(('word', words[0]))
+      elif words:
+        clauses.append(('phrase', words))
+      continue
+    is_prefix = word.endswith('*')
+    words = tokenize(word)
+    if is_prefix and len(words) == 1:
+      clauses.append(('prefix', words[0]))
+    elif len(words) == 1:
+      clauses.append(('word', words[0]))
+    elif words:
+      # "e-mail" or "w2/1099" tokenizes to several words; treat as a
+      # phrase.
+      clauses.append(('phrase', words))
+  return clauses
+
+
+def search(user_key, text):
+  """Returns ids of documents matching a query, best match first."""
+  clauses = parse_query(text)
+  if not clauses:
+    return []
+
+  # Look up document frequencies, and expand prefixes into words.
+  words = set()
+  for kind, value in clauses:
+    if kind == 'phrase':
+      words.update(value)
+    else:
+      words.add(value)
+  first_chars = sorted(set([w[0] for w in words]))
+  lexicons = dict(zip(first_chars,
+                      db.get([_lexicon_key(user_key, c)
+                              for c in first_chars])))
+
+  def df(word):
+    lexicon = lexicons.get(word[0])
+    if lexicon is None:
+      return 0
+    i = bisect.bisect_left(lexicon.terms, word)
+    if i < len(lexicon.terms) and lexicon.terms[i] == word:
+      return lexicon.dfs[i]
+    return 0
+
+  expansions = {}
+  for kind, value in clauses:
+    if kind != 'prefix':
+      continue
+    lexicon = lexicons.get(value[0])
+    matches = []
+    if lexicon is not None:
+      i = bisect.bisect_left(lexicon.terms, value)
+      while i < len(lexicon.terms) and lexicon.terms[i].startswith(value):
+        matches.append((lexicon.dfs[i], lexicon.terms[i]))
+        i += 1
+    matches.sort(reverse=True)
+    expansions[value] = [term for unused_df, term in
+                         matches[:MAX_PREFIX_EXPANSION]]
+
+  # Fetch every shard of every posting list we need in one batch.
+  terms = set()
+  for kind, value in clauses:
+    if kind == 'word':
+      terms.add(value)
+    elif kind == 'prefix':
+      terms.update(expansions[value])
+    else:
+      terms.update(value)
+      terms.update([value[i - 1] + ' ' + value[i]
+                    for i in range(1, len(value))])
+  terms = sorted(terms)
+  keys = [_posting_key(user_key, t, s)
+          for t in terms for s in range(NUM_SHARDS)]
+  weights = dict((t, {}) for t in terms)
+  for key, posting in zip(keys, db.get(keys)):
+    if posting is not None:
+      term = key.name()[3:key.name().rindex(':')]
+      weights[term].update(zip(posting.doc_ids, posting.weights))
+
+  info = SearchIndexInfo.get_by_key_name(_INFO_KEY_NAME, parent=user_key)
+  num_docs = info and info.doc_count or 1
+
+  def idf(word):
+    return math.log(1.0 + float(num_docs) / (1 + df(word)))
+
+  # Each clause gives {doc_id: score}; a document must match them all.
+  scores = None
+  for kind, value in clauses:
+    if kind == 'word':
+      matched = _scored(weights[value], idf(value))
+    elif kind == 'prefix':
+      matched = {}
+      for term in expansions[value]:
+        for doc_id, score in _scored(weights[term], idf(term)).items():
+          matched[doc_id] = max(matched.get(doc_id, 0), score)
+    else:
+      matched = {}
+      for word in value:
+        for doc_id, score in _scored(weights[word], idf(word)).items():
+          matched[doc_id] = matched.get(doc_id, 0) + score
+      for i in range(1, len(value)):
+        bigram = weights[value[i - 1] + ' ' + value[i]]
+        matched = dict([(d, s) for d, s in matched.items() if d in bigram])
+    if scores is None:
+      scores = matched
+    else:
+      scores = dict([(d, s + matched[d]) for d, s in scores.items()
+                     if d in matched])
+    if not scores:
+      return []
+
+  ranked = [(-score, doc_id) for doc_id, score in scores.items()]
+  ranked.sort()
+  return [doc_id for unused_score, doc_id in ranked]
+
+
+def _scored(doc_weights, idf):
+  """Returns {doc_id: weight * idf}."""
+  return dict([(d, w * idf) for d, w in doc_weights.items()])
+
+
+def rebuild(user_info):
+  """Starts rebuilding a user's full-text index from their Documents.
+
+  The index is deleted and then refilled by a chain of tasks (see
+  rebuild_step); searches find fewer documents until it's done.
+  """
+  run = '%d' % (time.time() * 1000)
+  _enqueue_rebuild(user_info.key(), run, 'clear', '', 0)
+
+
+def _enqueue_rebuild(user_key, run, phase, cursor, step):
+  # Named per step, so a retried task can't fork the chain in two.
+  digest = hashlib.md5(str(user_key)).hexdigest()
+  try:
+    taskqueue.add(queue_name=QUEUE_NAME,
+                  url=TASK_URL,
+                  name='reindex-%s-%s-%d' % (digest[:16], run, step),
+                  params={'user': str(user_key), 'run': run, 'phase': phase,
+                          'cursor': cursor, 'step': step})
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass
+
+
+def rebuild_step(user_key, run, phase, cursor, step):
+  """Runs one task of a rebuild, and queues the next.
+
+  Args:
+    user_key: key of the UserInfo whose index is rebuilt.
+    run: identifies the rebuild, for task names.
+    phase: 'clear' while deleting the old index, then 'docs'.
+    cursor: where in the user's Documents the 'docs' phase is.
+    step: number of this task in the chain.
+  """
+  if phase == 'clear':
+    for kind in (SearchPosting, SearchLexicon, SearchIndexInfo):
+      stale = kind.all(keys_only=True).ancestor(user_key).fetch(
+          CLEAR_BATCH_SIZE)
+      if stale:
+        db.delete(stale)
+        _enqueue_rebuild(user_key, run, 'clear', '', step + 1)
+        return
+    phase, cursor = 'docs', ''
+
+  query = Document.all(keys_only=True).ancestor(user_key)
+  if cursor:
+    query.with_cursor(cursor)
+  doc_keys = query.fetch(REBUILD_BATCH_SIZE)
+  for doc_key in doc_keys:
+    db.run_in_transaction(_reindex, user_key, doc_key)
+  if len(doc_keys) == REBUILD_BATCH_SIZE:
+    _enqueue_rebuild(user_key, run, 'docs', query.cursor(), step + 1)
+
+
+def _reindex(user_key, doc_key):
+  """Adds one document to a cleared index, unless a retry did already."""
+  doc = db.get(doc_key)
+  terms = doc and document_terms(doc)
+  if not terms:
+    return
+  doc_id = doc_key.id()
+  posting = db.get(_posting_key(user_key, min(terms), doc_id % NUM_SHARDS))
+  if posting is not None:
+    i = bisect.bisect_left(posting.doc_ids, doc_id)
+    if i < len(posting.doc_ids) and posting.doc_ids[i] == doc_id:
+      return
+  update_document(user_key, doc_id, {}, terms)
@@ -0,0 +1,91 @@
+#
+# scanningcabinet's AppEngine server-side code.
+#
+# Copyright 2009 Brad Fitzpatrick <brad@danga.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tile pyramids of MediaObject images, for zooming into scans.
+
+Zoom level max_zoom is the scan at full resolution, and each level below
+it is half the size of the one above, down to level 0, which fits in a
+single tile.  Every level is cut into TILE_SIZE x TILE_SIZE tiles
+(smaller at the right and bottom edges), numbered by column and row from
+the top left.
+
+Tiles are rendered on first request and kept in the image cache
+(imagecache.get_variant), so they are evicted along with the scan's
+other variants.  static/zoom.js shows them.
+"""
+
+from google.appengine.api import images
+
+import imagecache
+
+TILE_SIZE = 256
+
+
+def pyramid(media):
+  """Returns (width, height, max_zoom) of an image's pyramid.
+
+  Returns None if it isn't an image, or its dimensions aren't known
+  (processing.py hasn't seen it).
+  """
+  width, height = media.width, media.height
+  if not media.is_image or not width or not height:
+    return None
+  max_zoom = 0
+  while max(width, height) > TILE_SIZE << max_zoom:
+    max_zoom += 1
+  return width, height, max_zoom
+
+
+def level_size(width, height, max_zoom, zoom):
+  """Returns the (width, height) of the image at a zoom level."""
+  scale = 1 << (max_zoom - zoom)
+  return (width + scale - 1) // scale, (height + scale - 1) // scale
+
+
+def get_tile(media, zoom, col, row):
+  """Returns (data, content_type) of one tile.
+
+  Returns None if the image has no such tile.
+  """
+  info = pyramid(media)
+  if info is None:
+    return None
+  width, height, max_zoom = info
+  if not 0 <= zoom <= max_zoom or col < 0 or row < 0:
+    return None
+  level_width, level_height = level_size(width, height, max_zoom, zoom)
+  left, top = col * TILE_SIZE, row * TILE_SIZE
+  if left >= level_width or top >= level_height:
+    return None
+  right = min(level_width, left + TILE_SIZE)
+  bottom = min(level_height, top + TILE_SIZE)
+
+  fmt = imagecache.output_format(media)
+  blob_key = media.blob.key()
+
+  def render():
+    image = images.Image(blob_key=str(blob_key))
+    image.crop(float(left) / level_width, float(top) / level_height,
+               float(right) / level_width, float(bottom) / level_height)
+    if zoom < max_zoom:
+      image.resize(width=right - left, height=bottom - top)
+    return image.execute_transforms(
+        output_encoding=imagecache.output_encoding(fmt))
+
+  return imagecache.get_variant(media, 't%d-%d-%d' % (zoom, col, row), fmt,
+                                render)
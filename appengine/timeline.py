@@ -0,0 +1,152 @@
+#
+# scanningcabinet's AppEngine server-side code.
+#
+# Copyright 2009 Brad Fitzpatrick <brad@danga.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Per-user histogram of Documents by year and month of doc_date.
+
+The user's DateHistogram holds the count of documents dated in each
+month.  Like the tag cloud, it lives in the user's entity group and is
+updated in the same transaction as the Documents, so the timeline page
+draws it from one entity.  Opening a year or month runs a doc_date
+range query bounded by bucket_range().
+"""
+
+import calendar
+import datetime
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+
+from model import DateHistogram
+from model import Document
+
+_KEY_NAME = 'timeline'
+
+QUEUE_NAME = 'reindex'
+TASK_URL = '/tasks/reindex_timeline'
+
+# Width in pixels of the longest bar on the timeline page.
+BAR_WIDTH = 300
+
+
+def _month(date):
+  """Returns a datetime's "YYYY-MM" bucket, or None."""
+  if date is None:
+    return None
+  return '%04d-%02d' % (date.year, date.month)
+
+
+def update_document_dates(user_key, changes):
+  """Moves documents between month buckets.
+
+  Must be called inside the transaction that writes the Documents.
+
+  Args:
+    user_key: key of the owning UserInfo.
+    changes: list of (old_date, new_date) doc_date pairs, None for a new
+      or deleted document, or one without a date.
+  """
+  deltas = {}
+  for old_date, new_date in changes:
+    old_month, new_month = _month(old_date), _month(new_date)
+    if old_month == new_month:
+      continue
+    if old_month:
+      deltas[old_month] = deltas.get(old_month, 0) - 1
+    if new_month:
+      deltas[new_month] = deltas.get(new_month, 0) + 1
+  deltas = dict((m, d) for m, d in deltas.items() if d)
+  if not deltas:
+    return
+
+  hist = DateHistogram.get_by_key_name(_KEY_NAME, parent=user_key)
+  if hist is None:
+    hist = DateHistogram(parent=user_key, key_name=_KEY_NAME)
+  counts = dict(zip(hist.months, hist.counts))
+  for month, delta in deltas.items():
+    count = counts.get(month, 0) + delta
+    if count > 0:
+      counts[month] = count
+    else:
+      counts.pop(month, None)
+  _store(hist, counts)
+
+
+def _store(hist, counts):
+  hist.months = sorted(counts)
+  hist.counts = [long(counts[month]) for month in hist.months]
+  hist.put()
+
+
+def histogram(user_key):
+  """Returns the user's timeline for display, newest year first.
+
+  Returns:
+    List of dicts with 'year', 'count' and 'months', a list of dicts
+    with 'month' (1-12), 'name', 'count' and 'width' (of its bar, in
+    pixels), oldest month first.
+  """
+  hist = DateHistogram.get_by_key_name(_KEY_NAME, parent=user_key)
+  if hist is None or not hist.counts:
+    return []
+  widest = max(hist.counts)
+  years = []
+  for month_name, count in zip(hist.months, hist.counts):
+    year, month = [int(x) for x in month_name.split('-')]
+    if not years or years[-1]['year'] != year:
+      years.append({'year': year, 'count': 0, 'months': []})
+    years[-1]['count'] += count
+    years[-1]['months'].append({
+        'month': month,
+        'name': calendar.month_abbr[month],
+        'count': count,
+        'width': max(1, count * BAR_WIDTH // widest),
+        })
+  years.reverse()
+  return years
+
+
+def bucket_range(year, month=None):
+  """Returns the [start, end) doc_dates of a year, or of one month."""
+  if month is None:
+    return datetime.datetime(year, 1, 1), datetime.datetime(year + 1, 1, 1)
+  start = datetime.datetime(year, month, 1)
+  if month == 12:
+    return start, datetime.datetime(year + 1, 1, 1)
+  return start, datetime.datetime(year, month + 1, 1)
+
+
+def rebuild(user_info):
+  """Queues a recount of a user's histogram; see recount."""
+  taskqueue.add(queue_name=QUEUE_NAME, url=TASK_URL,
+                params={'user': str(user_info.key())})
+
+
+def recount(user_key):
+  """Recounts a user's histogram from their Documents.
+
+  The count is an ancestor query in the same transaction as the put, so
+  an update_document_dates can't land between the two and be lost.
+  """
+  def tx():
+    counts = {}
+    for doc in Document.all().ancestor(user_key):
+      month = _month(doc.doc_date)
+      if month:
+        counts[month] = counts.get(month, 0) + 1
+    _store(DateHistogram(parent=user_key, key_name=_KEY_NAME), counts)
+  db.run_in_transaction(tx)
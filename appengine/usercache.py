@@ -0,0 +1,104 @@
+#
+# scanningcabinet's AppEngine server-side code.
+#
+# Copyright 2009 Brad Fitzpatrick <brad@danga.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Two-level cache of UserInfo entities, by key name.
+
+Every request resolves its user, and a home page render makes one
+ResourceHandler request per thumbnail, so the lookups are served from a
+per-instance dict first, then from memcache, and only then from the
+datastore.
+
+Entries are cached as encoded protocol buffers and decoded on every
+hit, so callers each get their own UserInfo and can set non_owner and
+the like on it.
+
+Writes to a UserInfo must call invalidate() once they've committed.
+That clears memcache and this instance's copy.  Other instances may
+serve their copy for up to LOCAL_CACHE_SECONDS more.  Nothing that
+writes a UserInfo works from the cached copy; it re-reads the entity
+inside its transaction.
+"""
+
+import time
+
+from google.appengine.api import memcache
+from google.appengine.datastore import entity_pb
+from google.appengine.ext import db
+
+from model import UserInfo
+
+LOCAL_CACHE_SECONDS = 60
+MEMCACHE_SECONDS = 10 * 60
+
+# The local cache is simply emptied when it gets this big.
+MAX_LOCAL_ENTRIES = 1000
+
+_local = {}  # key name -> (expiry time, encoded entity)
+
+
+def _memcache_key(key_name):
+  return 'userinfo:%s' % key_name
+
+
+def _encode(user_info):
+  return db.model_to_protobuf(user_info).Encode()
+
+
+def _decode(data):
+  return db.model_from_protobuf(entity_pb.EntityProto(data))
+
+
+def _remember(key_name, data):
+  if len(_local) >= MAX_LOCAL_ENTRIES:
+    _local.clear()
+  _local[key_name] = (time.time() + LOCAL_CACHE_SECONDS, data)
+
+
+def get(key_name, create=False):
+  """Returns the UserInfo with a key name, or None if there isn't one.
+
+  Args:
+    key_name: e.g. 'user:foo@example.com'.
+    create: insert the UserInfo if it doesn't exist yet.
+  """
+  entry = _local.get(key_name)
+  if entry is not None and entry[0] > time.time():
+    return _decode(entry[1])
+
+  data = memcache.get(_memcache_key(key_name))
+  if data is None:
+    if create:
+      user_info = UserInfo.get_or_insert(key_name=key_name)
+    else:
+      user_info = UserInfo.get_by_key_name(key_name)
+    if user_info is None:
+      return None
+    data = _encode(user_info)
+    memcache.set(_memcache_key(key_name), data, time=MEMCACHE_SECONDS)
+  _remember(key_name, data)
+  return _decode(data)
+
+
+def invalidate(user_key):
+  """Drops a UserInfo from the caches, after it has been written.
+
+  Args:
+    user_key: the UserInfo's db.Key.
+  """
+  _local.pop(user_key.name(), None)
+  memcache.delete(_memcache_key(user_key.name()))
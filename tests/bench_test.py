@@ -0,0 +1,57 @@
+#
+# Tests of scanningcabinet's AppEngine server-side code.
+#
+# Copyright 2009 Brad Fitzpatrick <brad@danga.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Runs tools/bench.py's scenarios on a tiny corpus."""
+
+import optparse
+import unittest
+
+from testutil import bench  # Once testutil has set up the SDK.
+
+
+class BenchTest(unittest.TestCase):
+
+  def test_scenarios_succeed(self):
+    options = optparse.Values({'seed': 1, 'requests': 2, 'max_gc_steps': 50})
+    run = bench.Bench(options)
+    run.activate()
+    try:
+      corpus = run.build_corpus(40, 10)
+      results = run.scenarios()
+    finally:
+      run.deactivate()
+
+    self.assertEqual(40, corpus['media'])
+    self.assertEqual(corpus['unannotated'], len(run.loose_ids))
+    for name in ('main_warm', 'main_cold', 'main_search', 'show_doc',
+                 'resource', 'upload_post', 'ingest_task', 'makedoc'):
+      self.assertTrue(name in results, name)
+    for name, result in results.items():
+      self.assertTrue(result['requests'] > 0, name)
+      for status in result['status']:
+        self.assertTrue(int(status) < 500, '%s: %s' % (name, status))
+
+  def test_percentile(self):
+    values = [1.0, 2.0, 3.0, 4.0]
+    self.assertEqual(2.0, bench.percentile(values, 0.5))
+    self.assertEqual(4.0, bench.percentile(values, 0.99))
+    self.assertEqual(0.0, bench.percentile([], 0.5))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,147 @@
+#
+# Tests of scanningcabinet's AppEngine server-side code.
+#
+# Copyright 2009 Brad Fitzpatrick <brad@danga.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests of making and breaking documents in bulk (main.py)."""
+
+import unittest
+
+import testutil
+
+
+class BulkDocTest(testutil.TestCase):
+
+  def setUp(self):
+    testutil.TestCase.setUp(self)
+    import main
+    self.main = main
+    self.user = self.user_info()
+
+  def scans(self, count):
+    return [self.make_media(self.user) for unused in range(count)]
+
+  def reload(self, entities):
+    from google.appengine.ext import db
+    return db.get([entity.key() for entity in entities])
+
+  def tag_doc(self, doc, tags, title, doc_date):
+    """Edits a document through /changedoc, as a user would."""
+    response = self.request('/changedoc', post={
+        'docid': str(doc.key().id()), 'tags': ', '.join(tags),
+        'title': title, 'date': doc_date})
+    self.assertEqual(302, response.status_int)
+
+  def test_make_docs(self):
+    import counters
+    first, second = self.scans(3), self.scans(1)
+    docs = self.main.make_docs(self.user, [first, second])
+    self.assertEqual(2, len(docs))
+    self.assertEqual([s.key() for s in first], self.reload(docs)[0].pages)
+    for scan in self.reload(first):
+      self.assertFalse(scan.lacks_document)
+      self.assertEqual(docs[0].key(), scan.document.key())
+    totals = counters.totals(self.user.key())
+    self.assertEqual(2, totals['docs'])
+    self.assertEqual(2, totals['untagged'])
+
+  def test_make_docs_rejects_scan_in_two_groups(self):
+    from model import Document
+    scans = self.scans(2)
+    self.assertRaises(ValueError, self.main.make_docs, self.user,
+                      [scans, scans[1:]])
+    self.assertEqual(0, Document.all().count())
+
+  def test_make_docs_rejects_scan_already_in_document(self):
+    from model import Document
+    scans = self.scans(2)
+    self.main.make_docs(self.user, [scans[:1]])
+    # scans[0] is stale here: it still lacks a document.
+    self.assertRaises(ValueError, self.main.make_docs, self.user, [scans])
+    self.assertEqual(1, Document.all().count())
+    self.assertTrue(self.reload(scans)[1].lacks_document)
+
+  def test_break_docs_updates_every_index(self):
+    # Documents sharing a tag, a word and a month all come out of them.
+    import tagindex
+    import textsearch
+    import timeline
+    docs = self.main.make_docs(self.user, [self.scans(1), self.scans(2)])
+    for doc in docs:
+      self.tag_doc(doc, ['tax'], 'Tax return', '2009-04-15')
+    self.assertEqual(2, len(tagindex.search(self.user.key(), 'tax')))
+    self.assertEqual(2, timeline.histogram(self.user.key())[0]['count'])
+
+    self.main.break_docs(self.user, self.reload(docs))
+    self.assertEqual([None, None], self.reload(docs))
+    self.assertEqual([], tagindex.search(self.user.key(), 'tax'))
+    self.assertEqual([], tagindex.tag_cloud(self.user.key()))
+    self.assertEqual([], textsearch.search(self.user.key(), 'tax'))
+    self.assertEqual([], timeline.histogram(self.user.key()))
+    from model import MediaObject
+    for scan in MediaObject.all():
+      self.assertTrue(scan.lacks_document)
+      self.assertEqual(None, scan.document)
+
+  def test_break_docs_counts_each_once(self):
+    import counters
+    doc, = self.main.make_docs(self.user, [self.scans(1)])
+    self.main.break_docs(self.user, [doc, doc])
+    self.assertEqual(0, counters.totals(self.user.key())['docs'])
+
+  def test_bulkdoc_request(self):
+    old, = self.main.make_docs(self.user, [self.scans(2)])
+    loose = self.scans(3)
+    old_scans = [str(key.id()) for key in old.pages]
+    response = self.request('/bulkdoc', post=[
+        ('break', str(old.key().id())),
+        ('group', ','.join(old_scans + [str(loose[0].key().id())])),
+        ('group', ', '.join([str(s.key().id()) for s in loose[1:]]))])
+    self.assertEqual(200, response.status_int)
+    lines = response.body.splitlines()
+    self.assertEqual('broke %d' % old.key().id(), lines[0])
+    self.assertEqual(['created'] * 2, [line.split()[0] for line in lines[1:]])
+
+  def test_bulkdoc_bad_break_id(self):
+    response = self.request('/bulkdoc', post={'break': 'abc'})
+    self.assertEqual(400, response.status_int)
+    response = self.request('/bulkdoc', post={'break': '12345'})
+    self.assertEqual(400, response.status_int)
+
+  def test_bulkdoc_bad_group(self):
+    from model import Document
+    scans = self.scans(2)
+    for group in ('zzz', str(self.user.key()), '999999'):
+      response = self.request('/bulkdoc', post={'group': group})
+      self.assertEqual(400, response.status_int, group)
+
+    ids = [str(s.key().id()) for s in scans]
+    response = self.request('/bulkdoc', post=[('group', ids[0]),
+                                              ('group', ','.join(ids))])
+    self.assertEqual(400, response.status_int)
+    self.assertEqual(0, Document.all().count())
+
+  def test_makedoc_twice(self):
+    scan, = self.scans(1)
+    post = {'media_id': str(scan.key().id())}
+    first = self.request('/makedoc', post=post)
+    self.assertTrue('/doc/' in first.headers['Location'])
+    second = self.request('/makedoc', post=post)
+    self.assertTrue('error_message' in second.headers['Location'])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,235 @@
+#
+# Tests of scanningcabinet's AppEngine server-side code.
+#
+# Copyright 2009 Brad Fitzpatrick <brad@danga.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests of chunked.py and the /chunked handlers."""
+
+import datetime
+import hashlib
+import unittest
+import urllib
+
+import testutil
+
+DATA = 'abcdefghij'
+FILENAME = 'image-0001-unx1262304000.pdf'
+
+
+def md5(data):
+  return hashlib.md5(data).hexdigest()
+
+
+class ChunkedTest(testutil.TestCase):
+
+  def setUp(self):
+    testutil.TestCase.setUp(self)
+    import chunked
+    self.chunked = chunked
+    self.saved = (chunked.CHUNK_SIZE, chunked.ABANDON_AFTER)
+    chunked.CHUNK_SIZE = 4
+    self.user = self.user_info()
+
+  def tearDown(self):
+    self.chunked.CHUNK_SIZE, self.chunked.ABANDON_AFTER = self.saved
+    testutil.TestCase.tearDown(self)
+
+  def start(self, data=DATA, **kwargs):
+    return self.chunked.start(self.user, FILENAME, len(data), **kwargs).key()
+
+  def append(self, upload_key, offset, data=DATA):
+    chunk = data[offset:offset + self.chunked.CHUNK_SIZE]
+    return self.chunked.append(upload_key, offset, chunk, md5(chunk))
+
+  def send_all(self, upload_key, data=DATA):
+    for offset in range(0, len(data), self.chunked.CHUNK_SIZE):
+      self.append(upload_key, offset, data)
+
+  def blob_data(self, blob_info):
+    from google.appengine.ext import blobstore
+    return blobstore.BlobReader(blob_info.key()).read()
+
+  def test_start(self):
+    from model import ChunkedUpload
+    upload = ChunkedUpload.get(self.start(md5_hash='ABC'))
+    self.assertEqual((FILENAME, 'application/pdf', len(DATA), 'abc', 0),
+                     (upload.filename, upload.content_type, upload.size,
+                      upload.md5_hash, upload.received))
+    for size in (0, self.chunked.MAX_SIZE + 1):
+      self.assertRaises(self.chunked.Error, self.chunked.start, self.user,
+                        FILENAME, size)
+
+  def test_append_and_finish(self):
+    upload_key = self.start(md5_hash=md5(DATA))
+    self.assertEqual(4, self.append(upload_key, 0))
+    self.assertEqual(8, self.append(upload_key, 4))
+    self.assertEqual(10, self.append(upload_key, 8))
+    blob_info = self.chunked.finish(upload_key)
+    self.assertEqual(DATA, self.blob_data(blob_info))
+    self.assertEqual(FILENAME, blob_info.filename)
+    self.chunked.stored(upload_key)
+    self.assertEqual(None, self.chunked.finish(upload_key))
+
+  def test_duplicate_chunk_dropped(self):
+    upload_key = self.start()
+    self.append(upload_key, 0)
+    self.append(upload_key, 4)
+    # The response to the first chunk was lost, say.
+    self.assertEqual(8, self.append(upload_key, 0))
+    self.append(upload_key, 8)
+    self.assertEqual(DATA, self.blob_data(self.chunked.finish(upload_key)))
+
+  def test_offsets(self):
+    upload_key = self.start()
+    self.append(upload_key, 0)
+    with self.assertRaises(self.chunked.OffsetError) as raised:
+      self.append(upload_key, 8)
+    self.assertEqual(4, raised.exception.received)
+    self.assertRaises(self.chunked.OffsetError, self.chunked.finish,
+                      upload_key)
+    # A chunk overlapping the end of what's received isn't a repeat.
+    self.assertRaises(self.chunked.OffsetError, self.chunked.append,
+                      upload_key, 2, 'cdef', md5('cdef'))
+
+  def test_bad_chunks(self):
+    upload_key = self.start()
+    Error = self.chunked.Error
+    self.assertRaises(Error, self.chunked.append, upload_key, 0, 'abcd',
+                      md5('abce'))
+    self.assertRaises(Error, self.chunked.append, upload_key, 0, 'abcde',
+                      md5('abcde'))
+    self.assertRaises(Error, self.chunked.append, upload_key, 0, '', md5(''))
+    self.send_all(upload_key, DATA[:8])
+    self.assertRaises(Error, self.chunked.append, upload_key, 8, 'ijkl',
+                      md5('ijkl'))  # Past the end.
+
+  def test_lease(self):
+    from model import ChunkedUpload
+    upload_key = self.start()
+    self.append(upload_key, 0)
+    upload = ChunkedUpload.get(upload_key)
+    # Another request is writing the next chunk.
+    upload.writing_until = datetime.datetime.now() + datetime.timedelta(
+        seconds=30)
+    upload.put()
+    self.assertRaises(self.chunked.OffsetError, self.append, upload_key, 4)
+    # A repeat of a received chunk doesn't need the lease.
+    self.assertEqual(4, self.append(upload_key, 0))
+    # It died mid-write.
+    upload.writing_until = datetime.datetime.now() - datetime.timedelta(
+        seconds=1)
+    upload.put()
+    with self.assertRaises(self.chunked.Error) as raised:
+      self.append(upload_key, 4)
+    self.assertFalse(isinstance(raised.exception, self.chunked.OffsetError))
+    # A completed append releases the lease.
+    other_key = self.start()
+    self.append(other_key, 0)
+    self.assertEqual(None, ChunkedUpload.get(other_key).writing_until)
+
+  def test_corrupt_finish(self):
+    from model import ChunkedUpload
+    upload_key = self.start()
+    self.send_all(upload_key, DATA[:8])
+    upload = ChunkedUpload.get(upload_key)
+    upload.received = upload.size  # But the file is short.
+    upload.put()
+    self.assertRaises(self.chunked.Error, self.chunked.finish, upload_key)
+    self.assertEqual(None, ChunkedUpload.get(upload_key))
+
+  def test_discard(self):
+    from model import ChunkedUpload
+    upload_key = self.start()
+    self.send_all(upload_key)
+    blob_info = self.chunked.finish(upload_key)
+    self.chunked.discard(upload_key)
+    self.assertEqual(None, ChunkedUpload.get(upload_key))
+    self.assertFalse(self.blob_exists(blob_info.key()))
+
+    upload_key = self.start()
+    self.send_all(upload_key)
+    blob_info = self.chunked.finish(upload_key)
+    self.chunked.stored(upload_key)
+    self.chunked.discard(upload_key)
+    self.assertTrue(self.blob_exists(blob_info.key()))
+
+  def test_sweep(self):
+    from model import ChunkedUpload
+    upload_key = self.start()
+    self.append(upload_key, 0)
+    self.assertEqual(0, self.chunked.sweep())
+    self.chunked.ABANDON_AFTER = datetime.timedelta(seconds=-1)
+    self.assertEqual(1, self.chunked.sweep())
+    self.assertEqual(None, ChunkedUpload.get(upload_key))
+
+  def status(self, response):
+    return dict([line.split(' ', 1) for line in response.body.splitlines()])
+
+  def put(self, upload_id, offset, chunk):
+    query = urllib.urlencode({'offset': offset, 'md5': md5(chunk)})
+    return self.request('/chunked/%s?%s' % (upload_id, query), method='PUT',
+                        body=chunk, content_type='application/octet-stream')
+
+  def test_handlers(self):
+    import journal
+    from model import MediaObject
+    response = self.request('/chunked', post={
+        'filename': FILENAME, 'size': str(len(DATA)), 'md5': md5(DATA)})
+    self.assertEqual(200, response.status_int)
+    status = self.status(response)
+    upload_id = status['id']
+    self.assertEqual(('4', '0'), (status['chunk_size'], status['received']))
+
+    self.assertEqual('4', self.status(self.put(upload_id, 0, 'abcd'))
+                     ['received'])
+    response = self.put(upload_id, 8, 'ijkl')
+    self.assertEqual(409, response.status_int)
+    self.assertEqual('4', self.status(response)['received'])
+    self.assertEqual(400, self.put(upload_id, 4, 'x' * 5).status_int)
+    self.assertEqual(400, self.put(upload_id, 'x', 'efgh').status_int)
+    self.assertEqual('4', self.status(self.request('/chunked/' + upload_id))
+                     ['received'])
+
+    finish = '/chunked/%s/finish' % upload_id
+    self.assertEqual(409, self.request(finish, post={}).status_int)
+    self.put(upload_id, 4, 'efgh')
+    self.put(upload_id, 8, 'ij')
+    response = self.request(finish, post={})
+    self.assertEqual(('ok\n', 200), (response.body, response.status_int))
+    self.assertEqual('ok\n', self.request(finish, post={}).body)
+    self.run_tasks(journal.QUEUE_NAME)
+    media, = MediaObject.all().fetch(10)
+    self.assertEqual(FILENAME, media.filename)
+
+  def test_handler_errors(self):
+    self.assertEqual(400, self.request('/chunked', post={
+        'filename': FILENAME, 'size': 'big'}).status_int)
+    self.assertEqual(404, self.request('/chunked/12345').status_int)
+    upload_key = self.start()
+    self.log_out()
+    url = '/chunked/%d' % upload_key.id()
+    self.assertEqual(403, self.request(url).status_int)
+    self.user.upload_password = 'secret'
+    self.user.put()
+    import usercache
+    usercache.invalidate(self.user.key())
+    self.assertEqual(200, self.request(url + '?' + urllib.urlencode(
+        {'user_email': testutil.USER_EMAIL, 'password': 'secret'}))
+                     .status_int)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,138 @@
+#
+# Tests of scanningcabinet's AppEngine server-side code.
+#
+# Copyright 2009 Brad Fitzpatrick <brad@danga.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests of contactsheet.py."""
+
+import unittest
+
+import testutil
+
+
+class ContactSheetTest(testutil.TestCase):
+
+  def setUp(self):
+    testutil.TestCase.setUp(self)
+    import contactsheet
+    self.contactsheet = contactsheet
+    self.saved_render = contactsheet.render
+    self.user = self.user_info()
+
+  def tearDown(self):
+    self.contactsheet.render = self.saved_render
+    testutil.TestCase.tearDown(self)
+
+  def fake_render(self, data):
+    """Makes render() return data, recording the sheets it's asked for."""
+    self.rendered = []
+    def render(media_objects):
+      self.rendered.append(media_objects)
+      return data
+    self.contactsheet.render = render
+
+  def sheet_url(self, media):
+    return '/contactsheet?ids=%s' % ','.join(
+        [str(m.key().id()) for m in media])
+
+  def test_layout(self):
+    columns, cell = self.contactsheet.COLUMNS, self.contactsheet.CELL_SIZE
+    cells = self.contactsheet.layout(columns + 1)
+    self.assertEqual((0, 0), cells[0])
+    self.assertEqual(((columns - 1) * cell, 0), cells[columns - 1])
+    self.assertEqual((0, cell), cells[columns])
+    self.assertEqual((3 * cell, cell), self.contactsheet.sheet_size(3))
+    self.assertEqual((columns * cell, 2 * cell),
+                     self.contactsheet.sheet_size(columns + 1))
+
+  def test_cached_until_invalidated(self):
+    media = [self.make_media(self.user) for unused in range(2)]
+    user_key = self.user.key()
+    self.fake_render('first')
+    self.assertEqual('first', self.contactsheet.get_sheet(user_key, media))
+    self.fake_render('second')
+    self.assertEqual('first', self.contactsheet.get_sheet(user_key, media))
+    self.assertEqual('second',
+                     self.contactsheet.get_sheet(user_key, media[:1]))
+
+    generation = self.contactsheet.generation(user_key)
+    self.contactsheet.invalidate(user_key)
+    self.assertEqual(generation + 1, self.contactsheet.generation(user_key))
+    self.assertEqual('second', self.contactsheet.get_sheet(user_key, media))
+
+  def test_big_sheets_not_cached(self):
+    media = [self.make_media(self.user)]
+    big = 'x' * (self.contactsheet.MAX_CACHED_BYTES + 1)
+    self.fake_render(big)
+    self.contactsheet.get_sheet(self.user.key(), media)
+    self.contactsheet.get_sheet(self.user.key(), media)
+    self.assertEqual(2, len(self.rendered))
+
+  def test_making_a_document_invalidates(self):
+    import main
+    media = self.make_media(self.user)
+    generation = self.contactsheet.generation(self.user.key())
+    main.make_docs(self.user, [[media]])
+    self.assertTrue(self.contactsheet.generation(self.user.key()) >
+                    generation)
+
+  def test_render(self):
+    self.require_images()
+    from google.appengine.api import images
+    import processing
+    media = [self.make_media(self.user, testutil.make_jpeg(400, 300, seed=i),
+                             processing_state='pending')
+             for i in range(3)]
+    for m in media:
+      processing.process_task([m.key()], 0)
+    pdf = self.make_media(self.user, '%PDF-1.4\n', 'bill.pdf',
+                          content_type='application/pdf')
+    data = self.contactsheet.render(media + [None, pdf])
+    sheet = images.Image(image_data=data)
+    self.assertEqual(self.contactsheet.sheet_size(5),
+                     (sheet.width, sheet.height))
+    self.assertEqual(None, self.contactsheet.render([None, pdf]))
+
+  def test_home_page_links_sheet(self):
+    import urllib
+    media = [self.make_media(self.user) for unused in range(2)]
+    ids = ','.join([str(m.key().id()) for m in media])
+    body = self.request('/').body
+    self.assertTrue('/contactsheet?' in body)
+    self.assertTrue(urllib.urlencode({'ids': ids}) in body)
+
+  def test_handler(self):
+    media = [self.make_media(self.user) for unused in range(2)]
+    self.fake_render('jpeg data')
+    response = self.request(self.sheet_url(media))
+    self.assertEqual(200, response.status_int)
+    self.assertEqual('image/jpeg', response.headers['Content-Type'])
+    self.assertEqual('jpeg data', response.body)
+
+  def test_handler_errors(self):
+    self.fake_render(None)
+    media = self.make_media(self.user)
+    self.assertEqual(404, self.request(self.sheet_url([media])).status_int)
+    self.assertEqual(400, self.request('/contactsheet?ids=1,x').status_int)
+    too_many = ','.join(['1'] * (self.contactsheet.MAX_SCANS + 1))
+    self.assertEqual(400,
+                     self.request('/contactsheet?ids=' + too_many).status_int)
+    self.log_out()
+    self.assertEqual(403, self.request(self.sheet_url([media])).status_int)
+
+
+if __name__ == '__main__':
+  unittest.main()
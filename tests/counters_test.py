@@ -0,0 +1,143 @@
+#
+# Tests of scanningcabinet's AppEngine server-side code.
+#
+# Copyright 2009 Brad Fitzpatrick <brad@danga.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests of counters.py."""
+
+import unittest
+
+import testutil
+
+
+class CountersTest(testutil.TestCase):
+
+  def setUp(self):
+    testutil.TestCase.setUp(self)
+    import counters
+    self.counters = counters
+    self.user = self.user_info()
+    self.user_key = self.user.key()
+
+  def totals(self):
+    return self.counters.totals(self.user_key)
+
+  def shards(self):
+    from model import UserStatsShard
+    return UserStatsShard.all().fetch(100)
+
+  def test_update_and_totals(self):
+    for unused in range(50):
+      self.counters.update(self.user_key, media=1, bytes=10)
+    self.counters.update(self.user_key, docs=2, untagged=1)
+    self.counters.update(self.user_key, untagged=-1)
+    self.assertEqual({'media': 50, 'bytes': 500, 'docs': 2, 'untagged': 0},
+                     self.totals())
+    # Spread over shards, none more than NUM_SHARDS.
+    self.assertTrue(1 < len(self.shards()) <= self.counters.NUM_SHARDS)
+
+  def test_zero_deltas_write_nothing(self):
+    self.counters.update(self.user_key, media=0, docs=0)
+    self.assertEqual([], self.shards())
+
+  def test_unknown_counter(self):
+    self.assertRaises(ValueError, self.counters.update, self.user_key,
+                      pages=1)
+
+  def test_totals_cached_until_update(self):
+    self.counters.update(self.user_key, media=1)
+    self.assertEqual(1, self.totals()['media'])
+    from google.appengine.ext import db
+    db.delete(self.shards())  # Behind the cache's back.
+    self.assertEqual(1, self.totals()['media'])
+    self.counters.update(self.user_key, docs=1)
+    self.assertEqual((0, 1), (self.totals()['media'], self.totals()['docs']))
+
+  def test_users_counted_apart(self):
+    from google.appengine.ext import db
+    other_key = db.Key.from_path('UserInfo', 'user:other@example.com')
+    self.counters.update(self.user_key, media=1)
+    self.counters.update(other_key, media=5)
+    self.assertEqual(1, self.totals()['media'])
+    self.assertEqual(5, self.counters.totals(other_key)['media'])
+
+  def test_update_later(self):
+    from google.appengine.ext import db
+    def change(fail):
+      self.counters.update_later(self.user_key, media=2, docs=0)
+      if fail:
+        raise db.Rollback()
+    db.run_in_transaction(change, True)
+    self.assertEqual([], self.tasks(self.counters.QUEUE_NAME))
+    db.run_in_transaction(change, False)
+    self.assertEqual(1, self.run_tasks(self.counters.QUEUE_NAME))
+    self.assertEqual(2, self.totals()['media'])
+    self.assertRaises(ValueError, db.run_in_transaction,
+                      self.counters.update_later, self.user_key, pages=1)
+
+  def test_media_deltas(self):
+    media = [self.make_media(self.user, size=100),
+             self.make_media(self.user, size=None)]
+    self.assertEqual({'media': 2, 'bytes': 100},
+                     self.counters.media_deltas(media))
+    self.assertEqual({'media': -2, 'bytes': -100},
+                     self.counters.media_deltas(media, -1))
+
+  def test_library_changes_are_counted(self):
+    import main
+    blob_infos = [self.make_blob(testutil.make_jpeg(seed=i))
+                  for i in range(3)]
+    media = self.store(blob_infos)
+    self.run_tasks(self.counters.QUEUE_NAME)
+    size = sum([b.size for b in blob_infos])
+    self.assertEqual({'media': 3, 'bytes': size, 'docs': 0, 'untagged': 0},
+                     self.totals())
+
+    first, second = main.make_docs(self.user, [media[:1], media[1:2]])
+    self.assertEqual((2, 2), (self.totals()['docs'],
+                              self.totals()['untagged']))
+    response = self.request('/changedoc', post={
+        'docid': str(first.key().id()), 'tags': 'tax', 'title': 'Bill'})
+    self.assertEqual(302, response.status_int)
+    self.assertEqual(1, self.totals()['untagged'])
+
+    main.delete_doc_and_images(self.user, second)
+    main.break_docs(self.user, [first])
+    expected = {'media': 2, 'bytes': blob_infos[0].size + blob_infos[2].size,
+                'docs': 0, 'untagged': 0}
+    self.assertEqual(expected, self.totals())
+    self.assertEqual(expected, self.counters.recount(self.user))
+
+  def test_recount(self):
+    import main
+    media = [self.make_media(self.user, size=10) for unused in range(3)]
+    main.make_docs(self.user, [media[:1]])  # Counted as untagged.
+    self.counters.update(self.user_key, media=7, bytes=1, untagged=-5)
+    counts = self.counters.recount(self.user)
+    self.assertEqual({'media': 3, 'bytes': 30, 'docs': 1, 'untagged': 1},
+                     counts)
+    self.assertEqual(counts, self.totals())
+
+  def test_stats_page(self):
+    self.counters.update(self.user_key, media=2, bytes=2048)
+    response = self.request('/stats')
+    self.assertEqual(200, response.status_int)
+    self.assertEqual(302, self.request('/stats', post={}).status_int)
+    self.assertEqual(0, self.totals()['media'])
+
+
+if __name__ == '__main__':
+  unittest.main()
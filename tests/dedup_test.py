@@ -0,0 +1,186 @@
+#
+# Tests of scanningcabinet's AppEngine server-side code.
+#
+# Copyright 2009 Brad Fitzpatrick <brad@danga.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests of dedup.py and deduplicated uploads."""
+
+import unittest
+
+import testutil
+
+
+class DedupTest(testutil.TestCase):
+
+  def setUp(self):
+    testutil.TestCase.setUp(self)
+    import dedup
+    import main
+    self.dedup = dedup
+    self.main = main
+    self.user = self.user_info()
+    self.data = testutil.make_jpeg(seed=99)
+
+  def media(self):
+    from model import MediaObject
+    return MediaObject.all().fetch(100)
+
+  def test_duplicate_upload_kept_once(self):
+    first, = self.store([self.make_blob(self.data)])
+    copy = self.make_blob(self.data)
+    again, = self.store([copy])
+    self.assertEqual(first.key(), again.key())
+    self.assertEqual(1, len(self.media()))
+    self.assertFalse(self.blob_exists(copy.key()))
+    self.assertTrue(self.blob_exists(first.blob.key()))
+
+  def test_repeats_within_one_upload(self):
+    blob_infos = [self.make_blob(self.data) for unused in range(3)]
+    media = self.store(blob_infos)
+    self.assertEqual(1, len(set([m.key() for m in media])))
+    self.assertEqual(1, len(self.media()))
+    self.assertEqual(1, len([b for b in blob_infos
+                             if self.blob_exists(b.key())]))
+
+  def test_same_blob_twice_keeps_it(self):
+    blob_info = self.make_blob(self.data)
+    media = self.store([blob_info, blob_info])
+    self.assertEqual(1, len(self.media()))
+    self.assertTrue(self.blob_exists(blob_info.key()))
+    self.store([blob_info])
+    self.assertTrue(self.blob_exists(media[0].blob.key()))
+
+  def test_same_blob_journaled_twice_keeps_it(self):
+    # As when a /chunked/<id>/finish is retried after it journaled.
+    import journal
+    blob_info = self.make_blob(self.data)
+    for unused in range(2):
+      journal.append(testutil.USER_EMAIL, [blob_info])
+      journal.commit(testutil.USER_EMAIL, self.main.store_uploads)
+    self.assertEqual(1, len(self.media()))
+    self.assertTrue(self.blob_exists(blob_info.key()))
+
+  def test_duplicate_document_upload_shares_blob(self):
+    original, = self.store([self.make_blob(self.data)])
+    copy = self.make_blob(self.data)
+    page, = self.store([copy], {'title': 'Bill', 'tags': '',
+                                'description': ''})
+    self.assertNotEqual(original.key(), page.key())
+    self.assertEqual(original.blob.key(), page.blob.key())
+    self.assertFalse(self.blob_exists(copy.key()))
+
+  def test_originals_claim_and_forget(self):
+    from google.appengine.ext import db
+    media = self.make_media(self.user, self.data)
+    user_key = self.user.key()
+    self.assertEqual({}, self.dedup.originals(user_key, [media.md5_hash]))
+    db.put(self.dedup.claim(user_key, [media]))
+    found = self.dedup.originals(user_key, [media.md5_hash, None])
+    self.assertEqual([media.md5_hash], found.keys())
+    self.assertEqual(media.key(), found[media.md5_hash].key())
+
+    copy = self.make_media(self.user, self.data)
+    self.assertEqual([], list(self.dedup.claim(user_key, [copy])))
+    self.dedup.forget([copy])  # Not the original; nothing to drop.
+    self.assertEqual(1, len(self.dedup.originals(user_key,
+                                                 [media.md5_hash])))
+    self.dedup.forget([media])
+    self.assertEqual({}, self.dedup.originals(user_key, [media.md5_hash]))
+
+  def test_delete_unshared_blobs(self):
+    media = self.make_media(self.user)
+    loose = self.make_blob('unused')
+    self.assertEqual([loose.key()], self.dedup.delete_unshared_blobs(
+        self.user.key(), [media.blob.key(), loose.key()]))
+    self.assertTrue(self.blob_exists(media.blob.key()))
+    self.assertFalse(self.blob_exists(loose.key()))
+
+  def backfill(self, dry_run=False):
+    from model import DedupRun
+    run = self.dedup.start(dry_run)
+    self.run_tasks(self.dedup.QUEUE_NAME)
+    run = DedupRun.get(run.key())
+    self.assertTrue(run.done)
+    return run
+
+  def copies(self, in_document):
+    """Makes two MediaObjects of the same content, not yet indexed."""
+    copies = [self.make_media(self.user, self.data, md5_hash=None)
+              for unused in range(2)]
+    for copy, in_doc in zip(copies, in_document):
+      if in_doc:
+        self.main.make_docs(self.user, [[copy]])
+    return copies
+
+  def test_backfill_loose_duplicates(self):
+    copies = self.copies([False, False])
+    run = self.backfill()
+    self.assertEqual((2, 1, 1, 1, 1),
+                     (run.media_scanned, run.media_hashed, run.duplicates,
+                      run.media_deleted, run.blobs_reclaimed))
+    survivor, = self.media()
+    self.assertEqual(1, len([c for c in copies
+                             if self.blob_exists(c.blob.key())]))
+    self.assertEqual(survivor.key(), self.dedup.originals(
+        self.user.key(), [survivor.md5_hash])[survivor.md5_hash].key())
+
+  def test_backfill_keeps_the_page(self):
+    loose, page = self.copies([False, True])
+    self.backfill()
+    survivor, = self.media()
+    self.assertEqual(page.key(), survivor.key())
+    self.assertEqual(page.key(), self.dedup.originals(
+        self.user.key(), [survivor.md5_hash])[survivor.md5_hash].key())
+
+  def test_backfill_shares_blobs_of_pages(self):
+    copies = self.copies([True, True])
+    run = self.backfill()
+    self.assertEqual((1, 0, 1), (run.duplicates, run.media_deleted,
+                                 run.blobs_reclaimed))
+    media = self.media()
+    self.assertEqual(2, len(media))
+    self.assertEqual(1, len(set([m.blob.key() for m in media])))
+    self.assertEqual(1, len([c for c in copies
+                             if self.blob_exists(c.blob.key())]))
+
+  def test_dry_run_only_counts(self):
+    copies = self.copies([False, False])
+    run = self.backfill(dry_run=True)
+    self.assertEqual((1, 1, 0), (run.media_hashed, run.duplicates,
+                                 run.media_deleted))
+    self.assertEqual(len(self.data), run.bytes_reclaimed)
+    self.assertEqual(2, len(self.media()))
+    self.assertEqual(2, len([c for c in copies
+                             if self.blob_exists(c.blob.key())]))
+
+  def test_backfill_twice(self):
+    self.copies([True, True])
+    self.backfill()
+    run = self.backfill()
+    self.assertEqual((0, 0), (run.media_hashed, run.duplicates))
+
+  def test_admin_page(self):
+    self.copies([False, False])
+    response = self.request('/admin/dedup', post={'action': 'start'})
+    self.assertEqual(302, response.status_int)
+    self.run_tasks(self.dedup.QUEUE_NAME)
+    body = self.request('/admin/dedup').body
+    self.assertTrue('done: True' in body)
+    self.assertTrue('media_deleted: 1' in body)
+
+
+if __name__ == '__main__':
+  unittest.main()
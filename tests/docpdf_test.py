@@ -0,0 +1,165 @@
+#
+# Tests of scanningcabinet's AppEngine server-side code.
+#
+# Copyright 2009 Brad Fitzpatrick <brad@danga.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests of docpdf.py."""
+
+import re
+import unittest
+
+import testutil
+
+
+class RecordingFile(object):
+  """A file remembering each write."""
+
+  def __init__(self):
+    self.writes = []
+
+  def write(self, data):
+    self.writes.append(data)
+
+  def getvalue(self):
+    return ''.join(self.writes)
+
+
+class DocPdfTest(testutil.TestCase):
+
+  def setUp(self):
+    testutil.TestCase.setUp(self)
+    import docpdf
+    import main
+    self.docpdf = docpdf
+    self.main = main
+    self.saved_chunk_bytes = docpdf.CHUNK_BYTES
+    self.user = self.user_info()
+
+  def tearDown(self):
+    self.docpdf.CHUNK_BYTES = self.saved_chunk_bytes
+    testutil.TestCase.tearDown(self)
+
+  def make_doc(self, pages):
+    scans = [self.make_media(self.user, testutil.make_jpeg(300, 150, seed=i))
+             for i in range(pages)]
+    doc, = self.main.make_docs(self.user, [scans])
+    return doc
+
+  def check_pdf(self, data, pages):
+    """Checks the xref table points at each object."""
+    self.assertTrue(data.startswith('%PDF-1.4\n'))
+    self.assertTrue(data.endswith('%%EOF\n'))
+    xref = int(re.search(r'startxref\n(\d+)\n', data).group(1))
+    self.assertTrue(data[xref:].startswith('xref\n'))
+    offsets = re.findall(r'(\d{10}) 00000 n ', data[xref:])
+    self.assertEqual(2 + 3 * pages, len(offsets))
+    for num, offset in enumerate(offsets):
+      self.assertTrue(data[int(offset):].startswith('%d 0 obj\n' % (num + 1)))
+    self.assertEqual(pages, data.count('/Type /Page '))
+
+  def test_writes_are_bounded(self):
+    self.docpdf.CHUNK_BYTES = 10
+    out = RecordingFile()
+    pdf = self.docpdf._PdfWriter(out)
+    for piece in ('abc', 'defghi', 'jk', 'x' * 10, 'lmnop', 'q' * 25, 'r'):
+      pdf.write(piece)
+    pdf.flush()
+    self.assertEqual('abcdefghijk' + 'x' * 10 + 'lmnop' + 'q' * 25 + 'r',
+                     out.getvalue())
+    self.assertEqual(len(out.getvalue()), pdf.offset)
+    self.assertEqual(['abcdefghi', 'jk', 'x' * 10, 'lmnop', 'q' * 25, 'r'],
+                     out.writes)
+
+  def test_jpeg_info(self):
+    import StringIO
+    data = testutil.make_jpeg(300, 150)
+    self.assertEqual((300, 150, 3),
+                     self.docpdf.jpeg_info(StringIO.StringIO(data)))
+    self.assertEqual(None, self.docpdf.jpeg_info(StringIO.StringIO('%PDF')))
+    self.assertEqual(None,
+                     self.docpdf.jpeg_info(StringIO.StringIO(data[:4])))
+
+  def test_write_pdf(self):
+    from model import MediaObject
+    self.docpdf.CHUNK_BYTES = 100  # Many chunks per page.
+    doc = self.make_doc(3)
+    pages = MediaObject.get(doc.pages)
+    pdf = self.make_media(self.user, '%PDF-1.4\n', 'bill.pdf',
+                          content_type='application/pdf')
+    out = RecordingFile()
+    size = self.docpdf.write_pdf(out, pages + [None, pdf])
+    data = out.getvalue()
+    self.assertEqual(len(data), size)
+    self.check_pdf(data, 3)
+    for page in pages:
+      self.assertTrue(self.blob_data(page) in data)
+
+  def blob_data(self, media):
+    from google.appengine.ext import blobstore
+    return blobstore.BlobReader(media.blob.key()).read()
+
+  def test_build_and_cache(self):
+    from google.appengine.ext import blobstore
+    doc = self.make_doc(2)
+    self.assertEqual(None, self.docpdf.cached_pdf(doc))
+    pdf = self.docpdf.build(doc)
+    self.assertEqual(pdf.key(), self.docpdf.cached_pdf(doc).key())
+    data = blobstore.BlobReader(pdf.blob.key()).read()
+    self.assertEqual(pdf.size, len(data))
+    self.check_pdf(data, 2)
+
+    # A new list of pages needs a new PDF, which replaces the old.
+    old_blob = pdf.blob.key()
+    doc.pages = doc.pages[:1]
+    doc.put()
+    self.assertEqual(None, self.docpdf.cached_pdf(doc))
+    self.docpdf.build(doc)
+    self.assertFalse(self.blob_exists(old_blob))
+
+  def test_forget(self):
+    doc = self.make_doc(1)
+    pdf = self.docpdf.build(doc)
+    self.docpdf.forget([doc.key()])
+    self.assertEqual(None, self.docpdf.cached_pdf(doc))
+    self.assertFalse(self.blob_exists(pdf.blob.key()))
+
+  def test_small_document_served_inline(self):
+    doc = self.make_doc(2)
+    response = self.request('/doc/%d.pdf' % doc.key().id())
+    self.assertEqual(200, response.status_int)
+    pdf = self.docpdf.cached_pdf(doc)
+    self.assertEqual(str(pdf.blob.key()),
+                     response.headers['X-AppEngine-BlobKey'])
+
+  def test_big_document_built_in_task(self):
+    doc = self.make_doc(self.docpdf.INLINE_MAX_PAGES + 1)
+    url = '/doc/%d.pdf' % doc.key().id()
+    self.assertEqual(202, self.request(url).status_int)
+    self.assertEqual(202, self.request(url).status_int)
+    self.assertEqual(1, len(self.tasks(self.docpdf.QUEUE_NAME)))
+    self.run_tasks(self.docpdf.QUEUE_NAME)
+    self.assertNotEqual(None, self.docpdf.cached_pdf(doc))
+    self.assertEqual(200, self.request(url).status_int)
+
+  def test_breaking_a_document_forgets_its_pdf(self):
+    doc = self.make_doc(1)
+    pdf = self.docpdf.build(doc)
+    self.main.break_docs(self.user, [doc])
+    self.assertFalse(self.blob_exists(pdf.blob.key()))
+
+
+if __name__ == '__main__':
+  unittest.main()
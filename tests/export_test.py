@@ -0,0 +1,156 @@
+#
+# Tests of scanningcabinet's AppEngine server-side code.
+#
+# Copyright 2009 Brad Fitzpatrick <brad@danga.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests of export.py."""
+
+import unittest
+
+import testutil
+
+
+class ExportTest(testutil.TestCase):
+
+  def setUp(self):
+    testutil.TestCase.setUp(self)
+    import export
+    import main
+    self.export = export
+    self.main = main
+    self.user = self.user_info()
+
+  def make_archive(self, docs, loose):
+    """Makes docs one-page documents and loose un-annotated scans.
+
+    Returns:
+      (document ids, media ids), each sorted.
+    """
+    pages = [self.make_media(self.user) for unused in range(docs)]
+    made = self.main.make_docs(self.user, [[page] for page in pages])
+    media = pages + [self.make_media(self.user) for unused in range(loose)]
+    return (sorted([doc.key().id() for doc in made]),
+            sorted([m.key().id() for m in media]))
+
+  def page(self, token, page_size):
+    """Returns (records, next token) of one page."""
+    import StringIO
+    out = StringIO.StringIO()
+    next_token = self.export.write_page(self.user, token, out, page_size)
+    lines = out.getvalue().splitlines()
+    return [self.export.json.loads(line) for line in lines], next_token
+
+  def export_all(self, page_size):
+    """Returns every record, and how many pages it took."""
+    records, token, pages = [], '', 0
+    while True:
+      page, token = self.page(token, page_size)
+      pages += 1
+      self.assertTrue(len(page) <= page_size + 1)
+      records.extend(page[:-1])
+      if token is None:
+        self.assertEqual({'kind': 'end'}, page[-1])
+        return records, pages
+      self.assertEqual({'kind': 'next', 'cursor': token}, page[-1])
+
+  def ids(self, records, kind):
+    return sorted([r['id'] for r in records if r['kind'] == kind])
+
+  def test_one_page(self):
+    doc_ids, media_ids = self.make_archive(2, 1)
+    records, token = self.page('', 10)
+    self.assertEqual(None, token)
+    self.assertEqual(['document'] * 2 + ['media'] * 3 + ['end'],
+                     [r['kind'] for r in records])
+    self.assertEqual(doc_ids, self.ids(records, 'document'))
+    self.assertEqual(media_ids, self.ids(records, 'media'))
+
+  def test_records(self):
+    page = self.make_media(self.user)
+    doc, = self.main.make_docs(self.user, [[page]])
+    records, unused_token = self.page('', 10)
+    doc_record, media_record = records[:2]
+    self.assertEqual([page.key().id()], doc_record['pages'])
+    self.assertEqual(doc.key().id(), media_record['document'])
+    self.assertEqual(page.md5_hash, media_record['md5'])
+    self.assertEqual('/export/blob/%d' % page.key().id(),
+                     media_record['blob_url'])
+
+  def test_paged(self):
+    doc_ids, media_ids = self.make_archive(5, 2)
+    for page_size in (1, 2, 3, 5, 7, 12, 13):
+      records, pages = self.export_all(page_size)
+      self.assertEqual(doc_ids, self.ids(records, 'document'))
+      self.assertEqual(media_ids, self.ids(records, 'media'))
+      self.assertEqual(12, len(records))
+      self.assertTrue(pages <= 12 // page_size + 2, page_size)
+
+  def test_resume_from_any_page(self):
+    self.make_archive(3, 3)
+    unused_first, token = self.page('', 4)
+    second, unused_token = self.page(token, 4)
+    again, unused_token = self.page(token, 4)
+    self.assertEqual(second, again)
+
+  def test_only_own_archive(self):
+    from google.appengine.api import users
+    from model import UserInfo
+    self.make_archive(1, 1)
+    other = UserInfo(key_name='user:other@example.com',
+                     user=users.User('other@example.com'))
+    other.put()
+    self.make_media(other)
+    self.user = other
+    records, unused_pages = self.export_all(10)
+    self.assertEqual(['media'], [r['kind'] for r in records])
+
+  def test_bad_token(self):
+    for token in ('x:', 'd:not a cursor'):
+      self.assertRaises(ValueError, self.page, token, 10)
+
+  def test_export_handler(self):
+    self.make_archive(1, 1)
+    response = self.request('/export')
+    self.assertEqual(200, response.status_int)
+    self.assertEqual('application/x-ndjson', response.headers['Content-Type'])
+    self.assertFalse('X-Export-Next' in response.headers)
+    self.assertEqual(4, len(response.body.splitlines()))
+    self.assertEqual(400, self.request('/export?cursor=x:').status_int)
+
+  def test_export_handler_with_password(self):
+    import usercache
+    self.make_archive(1, 0)
+    self.user.upload_password = 'secret'
+    self.user.put()
+    usercache.invalidate(self.user.key())
+    self.log_out()
+    self.assertEqual(403, self.request('/export').status_int)
+    response = self.request('/export?user_email=%s&password=secret'
+                            % testutil.USER_EMAIL)
+    self.assertEqual(200, response.status_int)
+    self.assertEqual(3, len(response.body.splitlines()))
+
+  def test_blob_handler(self):
+    media = self.make_media(self.user)
+    response = self.request('/export/blob/%d' % media.key().id())
+    self.assertEqual(200, response.status_int)
+    self.assertEqual(str(media.blob.key()),
+                     response.headers['X-AppEngine-BlobKey'])
+    self.assertEqual(404, self.request('/export/blob/12345').status_int)
+
+
+if __name__ == '__main__':
+  unittest.main()
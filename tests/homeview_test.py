@@ -0,0 +1,84 @@
+#
+# Tests of scanningcabinet's AppEngine server-side code.
+#
+# Copyright 2009 Brad Fitzpatrick <brad@danga.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests of the cached home view in main.py."""
+
+import unittest
+
+import testutil
+
+
+class HomeViewTest(testutil.TestCase):
+
+  def setUp(self):
+    testutil.TestCase.setUp(self)
+    import main
+    self.main = main
+    self.user = self.user_info()
+
+  def media_ids(self, view):
+    return [item.key().id() for item in view['media'].items]
+
+  def test_sections(self):
+    view = self.main.get_home_view(self.user, 10)
+    for name in self.main.HOME_SECTIONS:
+      self.assertEqual([], view[name].items)
+    self.assertEqual([], view['tag_cloud'])
+
+  def test_cached_until_invalidated(self):
+    first = self.make_media(self.user)
+    view = self.main.get_home_view(self.user, 10)
+    self.assertEqual([first.key().id()], self.media_ids(view))
+
+    second = self.make_media(self.user)  # Without invalidating.
+    view = self.main.get_home_view(self.user, 10)
+    self.assertEqual([first.key().id()], self.media_ids(view))
+
+    self.main.invalidate_home_view(self.user.key())
+    view = self.main.get_home_view(self.user, 10)
+    self.assertEqual([first.key().id(), second.key().id()],
+                     self.media_ids(view))
+
+  def test_cached_per_page_size(self):
+    for unused in range(3):
+      self.make_media(self.user)
+    for page_size, expected in ((2, 2), (5, 3)):
+      view = self.main.get_home_view(self.user, page_size)
+      self.assertEqual(expected, len(view['media'].items))
+
+  def test_making_a_document_invalidates(self):
+    scan = self.make_media(self.user)
+    self.main.get_home_view(self.user, 10)
+    response = self.request('/makedoc', post={'media_id': str(scan.key().id())})
+    self.assertEqual(302, response.status_int)
+    view = self.main.get_home_view(self.user, 10)
+    self.assertEqual([], view['media'].items)
+    self.assertEqual(1, len(view['docs'].items))
+
+  def test_home_page(self):
+    self.make_media(self.user)
+    self.assertEqual(200, self.request('/').status_int)
+    self.assertEqual(200, self.request('/?limit=5').status_int)
+
+  def test_logged_out_home_page(self):
+    self.log_out()
+    self.assertEqual(200, self.request('/').status_int)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,165 @@
+#
+# Tests of scanningcabinet's AppEngine server-side code.
+#
+# Copyright 2009 Brad Fitzpatrick <brad@danga.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests of imagecache.py."""
+
+import datetime
+import unittest
+
+import testutil
+
+
+class ImageCacheTest(testutil.TestCase):
+
+  def setUp(self):
+    testutil.TestCase.setUp(self)
+    import imagecache
+    self.imagecache = imagecache
+    self.saved = (imagecache.CACHE_BUDGET_BYTES, imagecache.DELETE_BATCH_SIZE)
+    self.user = self.user_info()
+    self.media = self.make_media(self.user)
+    self.renders = 0
+
+  def tearDown(self):
+    (self.imagecache.CACHE_BUDGET_BYTES,
+     self.imagecache.DELETE_BATCH_SIZE) = self.saved
+    testutil.TestCase.tearDown(self)
+
+  def render(self, data='rendered'):
+    def render():
+      self.renders += 1
+      return data
+    return render
+
+  def usage(self):
+    from model import ImageCacheUsage
+    return ImageCacheUsage.get_by_key_name('global')
+
+  def test_snap_size(self):
+    self.assertEqual(150, self.imagecache.snap_size(1))
+    self.assertEqual(300, self.imagecache.snap_size(151))
+    self.assertEqual(300, self.imagecache.snap_size(300))
+    self.assertEqual(1600, self.imagecache.snap_size(5000))
+
+  def test_output_format(self):
+    self.assertEqual('jpeg', self.imagecache.output_format(self.media))
+    self.media.content_type = 'image/tiff'
+    self.assertEqual('png', self.imagecache.output_format(self.media))
+
+  def test_miss_then_hit(self):
+    get = self.imagecache.get_variant
+    self.assertEqual(('rendered', 'image/jpeg'),
+                     get(self.media, 'r300', 'jpeg', self.render()))
+    self.assertEqual(('rendered', 'image/jpeg'),
+                     get(self.media, 'r300', 'jpeg', self.render()))
+    self.assertEqual(1, self.renders)
+    stats = self.imagecache.stats()
+    self.assertEqual(1, stats['hits'])
+    self.assertEqual(1, stats['misses'])
+
+  def test_too_big_not_kept(self):
+    from model import DerivedImage
+    big = 'x' * (self.imagecache.MAX_VARIANT_BYTES + 1)
+    self.imagecache.get_variant(self.media, 'r1600', 'png', self.render(big))
+    self.assertEqual(0, DerivedImage.all().count())
+
+  def test_misses_leave_usage_to_flush(self):
+    for variant in ('r150', 'r300', 'r600'):
+      self.imagecache.get_variant(self.media, variant, 'jpeg',
+                                  self.render('12345'))
+    self.assertEqual(None, self.usage())
+    stats = self.imagecache.stats()
+    self.assertEqual(15, stats['pending_added_bytes'])
+    self.assertEqual(3, stats['pending_added_variants'])
+
+    self.assertEqual(15, self.imagecache.flush_usage())
+    self.assertEqual(15, self.usage().total_bytes)
+    self.assertEqual(3, self.usage().variants)
+    # Applied once only.
+    self.assertEqual(15, self.imagecache.flush_usage())
+
+    self.imagecache.delete_variants([self.media.key()])
+    self.assertEqual(15, self.usage().total_bytes)
+    self.assertEqual(0, self.imagecache.flush_usage())
+    self.assertEqual(0, self.usage().variants)
+
+  def test_variants_not_in_users_entity_group(self):
+    from model import DerivedImage
+    self.imagecache.get_variant(self.media, 'r300', 'jpeg', self.render())
+    cached, = DerivedImage.all().fetch(10)
+    self.assertEqual(None, cached.parent_key())
+    self.assertEqual('%s/r300.jpeg' % self.media.key(), cached.key().name())
+
+  def test_delete_variants_only_of_given_media(self):
+    from model import DerivedImage
+    from model import DerivedImageInfo
+    self.imagecache.DELETE_BATCH_SIZE = 2
+    other = self.make_media(self.user)
+    for variant in ('r150', 'r300', 'r600'):
+      self.imagecache.get_variant(self.media, variant, 'jpeg', self.render())
+    self.imagecache.get_variant(other, 'r150', 'jpeg', self.render())
+    self.imagecache.delete_variants([self.media.key()])
+    name = self.imagecache.variant_key_name(other.key(), 'r150', 'jpeg')
+    self.assertEqual([name], [cached.key().name()
+                              for cached in DerivedImage.all()])
+    self.assertEqual([name], [info.key().name()
+                              for info in DerivedImageInfo.all()])
+    self.assertEqual(3, self.imagecache.stats()['pending_freed_variants'])
+
+  def test_flush_evicts_least_recently_used(self):
+    from model import DerivedImage
+    from model import DerivedImageInfo
+    self.imagecache.CACHE_BUDGET_BYTES = 15
+    self.imagecache.DELETE_BATCH_SIZE = 1
+    for variant in ('r150', 'r300', 'r600'):
+      self.imagecache.get_variant(self.media, variant, 'jpeg',
+                                  self.render('x' * 10))
+    ages = {'r150': 3, 'r300': 1, 'r600': 2}
+    for info in DerivedImageInfo.all():
+      variant = info.key().name().split('/')[-1].split('.')[0]
+      info.last_access = datetime.datetime.now() - datetime.timedelta(
+          days=ages[variant])
+      info.put()
+
+    self.imagecache.flush_usage()
+    name = self.imagecache.variant_key_name(self.media.key(), 'r300', 'jpeg')
+    self.assertEqual([name], [cached.key().name()
+                              for cached in DerivedImage.all()])
+    self.assertEqual([name], [info.key().name()
+                              for info in DerivedImageInfo.all()])
+    self.assertEqual(10, self.usage().total_bytes)
+    self.assertEqual(2, self.imagecache.stats()['evicted'])
+
+  def test_flush_handler(self):
+    self.imagecache.get_variant(self.media, 'r150', 'jpeg', self.render())
+    self.assertEqual(200, self.request('/tasks/imagecache_flush').status_int)
+    self.assertEqual(len('rendered'), self.usage().total_bytes)
+
+  def test_resize_request(self):
+    self.require_images()
+    url = '/resource/%d/scan.jpg?resize=300' % self.media.key().id()
+    first = self.request(url)
+    self.assertEqual(200, first.status_int)
+    self.assertEqual('image/jpeg', first.headers['Content-Type'])
+    second = self.request(url)
+    self.assertEqual(first.body, second.body)
+    self.assertEqual(1, self.imagecache.stats()['hits'])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,171 @@
+#
+# Tests of scanningcabinet's AppEngine server-side code.
+#
+# Copyright 2009 Brad Fitzpatrick <brad@danga.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests of instrument.py and /admin/instrument."""
+
+import logging
+import time
+import unittest
+
+import testutil
+
+
+class Hello(object):
+  """Stands in for a handler class in a routing table."""
+
+
+def hello_app(environ, start_response):
+  start_response('200 OK', [('Content-Type', 'text/plain')])
+  return ['hello']
+
+
+class RecordingHandler(logging.Handler):
+
+  def __init__(self):
+    logging.Handler.__init__(self)
+    self.messages = []
+
+  def emit(self, record):
+    self.messages.append(record.getMessage())
+
+
+class InstrumentTest(testutil.TestCase):
+
+  def setUp(self):
+    testutil.TestCase.setUp(self)
+    import instrument
+    self.instrument = instrument
+    self.saved = (instrument.SLOW_REQUEST_MS, instrument.memcache.offset_multi)
+    # Each testbed has a new apiproxy, without the hooks.
+    instrument.install_hooks.done = False
+    instrument.install_hooks()
+    self.log = RecordingHandler()
+    self.saved_level = logging.getLogger().level
+    logging.getLogger().addHandler(self.log)
+    logging.getLogger().setLevel(logging.INFO)
+    self.user_info()
+
+  def tearDown(self):
+    logging.getLogger().removeHandler(self.log)
+    logging.getLogger().setLevel(self.saved_level)
+    (self.instrument.SLOW_REQUEST_MS,
+     self.instrument.memcache.offset_multi) = self.saved
+    testutil.TestCase.tearDown(self)
+
+  def call(self, middleware, path='/'):
+    statuses = []
+    body = middleware({'PATH_INFO': path, 'REQUEST_METHOD': 'GET'},
+                      lambda status, headers, exc_info=None:
+                      statuses.append(status))
+    return statuses[0], ''.join(body)
+
+  def handler_stats(self, name):
+    stats, = self.instrument.stats([name])
+    return stats
+
+  def test_handler_name(self):
+    import main
+    middleware = self.instrument.Middleware(hello_app, main.ROUTES)
+    self.assertEqual('ShowDocHandler', middleware.handler_name('/doc/12'))
+    self.assertEqual('DocPdfHandler', middleware.handler_name('/doc/12.pdf'))
+    self.assertEqual('MainHandler', middleware.handler_name('/'))
+    self.assertEqual('unknown', middleware.handler_name('/doc/12/x'))
+
+  def test_buckets_and_percentiles(self):
+    bounds = self.instrument.BUCKETS_MS
+    self.assertEqual(0, self.instrument._bucket(0))
+    self.assertEqual(0, self.instrument._bucket(bounds[0]))
+    self.assertEqual(1, self.instrument._bucket(bounds[0] + 1))
+    self.assertEqual(len(bounds), self.instrument._bucket(bounds[-1] + 1))
+    buckets = [0] * (len(bounds) + 1)
+    buckets[0], buckets[2], buckets[-1] = 5, 4, 1
+    percentile = self.instrument._percentile
+    self.assertEqual('<=%d' % bounds[0], percentile(buckets, 10, 0.5))
+    self.assertEqual('<=%d' % bounds[2], percentile(buckets, 10, 0.9))
+    self.assertEqual('>%d' % bounds[-1], percentile(buckets, 10, 0.99))
+
+  def test_timed_counts_nested_calls_once(self):
+    calls = []
+    @self.instrument.timed('render')
+    def render(depth):
+      calls.append(depth)
+      time.sleep(0.02)
+      if depth:
+        render(depth - 1)
+      return depth
+    self.assertEqual(0, render(0))  # Outside a request, just runs.
+
+    stats = self.instrument._RequestStats('Hello')
+    self.instrument._local.stats = stats
+    try:
+      self.assertEqual(1, render(1))
+    finally:
+      self.instrument._local.stats = None
+    self.assertEqual([0, 1, 0], calls)
+    self.assertEqual(['render'], list(stats.phase_ms))
+    self.assertTrue(40 <= stats.phase_ms['render'] < 1000)
+
+  def test_requests_aggregated(self):
+    for unused in range(3):
+      self.assertEqual(200, self.request('/').status_int)
+    stats = self.handler_stats('MainHandler')
+    self.assertEqual(3, stats['count'])
+    self.assertEqual(3, sum(stats['buckets']))
+    self.assertTrue(stats['calls']['memcache'] > 0)
+    self.assertEqual(sorted(self.instrument.PHASES), sorted(stats['phases']))
+    self.assertEqual([], self.instrument.stats(['StatsHandler']))
+
+  def test_slow_requests_logged(self):
+    self.instrument.SLOW_REQUEST_MS = -1
+    self.request('/')
+    slow = [m for m in self.log.messages if m.startswith('Slow request')]
+    self.assertEqual(1, len(slow))
+    self.assertTrue(slow[0].startswith('Slow request: GET / (MainHandler)'))
+    self.assertTrue('\n  datastore_v3: ' in slow[0])
+    self.assertTrue('\n  query ' in slow[0])
+
+  def test_cold_start(self):
+    middleware = self.instrument.Middleware(
+        hello_app, [('/', Hello)], load_start=time.time() - 2)
+    self.assertEqual(('200 OK', 'hello'), self.call(middleware))
+    self.call(middleware)
+    startup = self.instrument.startup_stats()
+    self.assertEqual(1, startup['count'])
+    self.assertTrue(startup['load_ms'] >= 2000)
+    self.assertEqual(2, self.handler_stats('Hello')['count'])
+    self.assertEqual(1, len([m for m in self.log.messages
+                             if m.startswith('Cold start')]))
+
+  def test_memcache_failure_doesnt_fail_requests(self):
+    def offset_multi(*unused_args, **unused_kwargs):
+      raise ValueError('memcache down')
+    self.instrument.memcache.offset_multi = offset_multi
+    middleware = self.instrument.Middleware(hello_app, [('/', Hello)])
+    self.assertEqual(('200 OK', 'hello'), self.call(middleware))
+
+  def test_admin_page(self):
+    self.request('/')
+    response = self.request('/admin/instrument')
+    self.assertEqual(200, response.status_int)
+    self.assertTrue('\nMainHandler: 1 requests' in response.body)
+    self.testbed.setup_env(user_is_admin='0', overwrite=True)
+    self.assertEqual(302, self.request('/admin/instrument').status_int)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,136 @@
+#
+# Tests of scanningcabinet's AppEngine server-side code.
+#
+# Copyright 2009 Brad Fitzpatrick <brad@danga.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests of journal.py."""
+
+import unittest
+
+import testutil
+
+
+class JournalTest(testutil.TestCase):
+
+  def setUp(self):
+    testutil.TestCase.setUp(self)
+    import journal
+    import main
+    self.journal = journal
+    self.main = main
+    self.saved = (journal.FOLD_MAX_FILES, journal.MAX_ENTRIES_PER_TASK)
+    self.user = self.user_info()
+    self.seed = 0
+
+  def tearDown(self):
+    self.journal.FOLD_MAX_FILES, self.journal.MAX_ENTRIES_PER_TASK = self.saved
+    testutil.TestCase.tearDown(self)
+
+  def scans(self, count):
+    blob_infos = []
+    for unused in range(count):
+      self.seed += 1
+      blob_infos.append(self.make_blob(testutil.make_jpeg(seed=self.seed)))
+    return blob_infos
+
+  def counts(self):
+    from model import IngestEntry
+    from model import MediaObject
+    return IngestEntry.all().count(), MediaObject.all().count()
+
+  def test_append_and_commit(self):
+    self.journal.append(testutil.USER_EMAIL, self.scans(2))
+    self.journal.append(testutil.USER_EMAIL, self.scans(1))
+    self.assertEqual((2, 0), self.counts())
+    self.assertTrue(self.tasks(self.journal.QUEUE_NAME))
+    self.run_tasks(self.journal.QUEUE_NAME)
+    self.assertEqual((0, 3), self.counts())
+    stats = self.journal.stats()
+    self.assertEqual((2, 2, 0, 0), (stats['appended'], stats['committed'],
+                                    stats['errors'], stats['pending']))
+
+  def test_document_entry(self):
+    from model import Document
+    entry = self.journal.append(testutil.USER_EMAIL, self.scans(1),
+                                {'title': 'Bill', 'description': '',
+                                 'tags': 'tax, home'})
+    self.journal.commit(testutil.USER_EMAIL, self.main.store_uploads)
+    doc = Document.get_by_id(entry.doc_id, parent=self.user)
+    self.assertEqual(('Bill', ['tax', 'home']), (doc.title, doc.tags))
+    self.assertEqual([entry.media_ids[0]], [k.id() for k in doc.pages])
+
+  def test_folds(self):
+    from google.appengine.ext import blobstore
+    from model import IngestEntry
+    self.journal.FOLD_MAX_FILES = 3
+    def entry(files, doc_id=None):
+      return IngestEntry(user_email=testutil.USER_EMAIL,
+                         blobs=[blobstore.BlobKey('b')] * files,
+                         media_ids=range(files), doc_id=doc_id)
+    entries = [entry(2), entry(1), entry(1, doc_id=7), entry(2), entry(2),
+               entry(1)]
+    folds = self.journal._folds(entries)
+    self.assertEqual([[0, 1], [2], [3], [4, 5]],
+                     [[entries.index(e) for e in fold] for fold in folds])
+
+  def test_replay_stores_and_counts_once(self):
+    # A committer died after storing some of an entry's files, before
+    # deleting the entry.
+    import counters
+    blob_infos = self.scans(3)
+    entry = self.journal.append(testutil.USER_EMAIL, blob_infos)
+    self.main.store_uploads(testutil.USER_EMAIL, blob_infos[:2], [],
+                            media_ids=entry.media_ids[:2])
+    self.run_tasks(self.journal.QUEUE_NAME)
+    self.assertEqual((0, 3), self.counts())
+    self.run_tasks(counters.QUEUE_NAME)
+    self.assertEqual(3, counters.totals(self.user.key())['media'])
+    self.assertEqual(0, self.journal.commit(testutil.USER_EMAIL,
+                                            self.main.store_uploads))
+
+  def test_many_entries_take_several_tasks(self):
+    self.journal.MAX_ENTRIES_PER_TASK = 2
+    for unused in range(5):
+      self.journal.append(testutil.USER_EMAIL, self.scans(1))
+    committed = []
+    while not committed or committed[-1]:
+      committed.append(self.journal.commit(testutil.USER_EMAIL,
+                                           self.main.store_uploads))
+    self.assertEqual([2, 2, 1, 0], committed)
+    self.assertEqual((0, 5), self.counts())
+
+  def test_sweep(self):
+    self.assertEqual(0, self.journal.sweep())
+    self.journal.append(testutil.USER_EMAIL, self.scans(1))
+    self.journal.append('other@example.com', self.scans(1))
+    self.assertEqual(2, self.journal.sweep())
+
+  def test_store_errors_shown(self):
+    blob_info, = self.scans(1)
+    self.journal.append('nobody@example.com', [blob_info])
+    self.run_tasks(self.journal.QUEUE_NAME)
+    self.assertEqual((0, 0), self.counts())
+    self.assertFalse(self.blob_exists(blob_info.key()))
+    self.assertEqual(1, self.journal.stats()['errors'])
+    self.assertTrue('nobody@example.com' in self.journal.last_error())
+
+    body = self.request('/admin/journal').body
+    self.assertTrue('errors: 1\n' in body)
+    self.assertTrue('last_error: ' in body)
+
+
+if __name__ == '__main__':
+  unittest.main()
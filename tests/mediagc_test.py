@@ -0,0 +1,166 @@
+#
+# Tests of scanningcabinet's AppEngine server-side code.
+#
+# Copyright 2009 Brad Fitzpatrick <brad@danga.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests of mediagc.py."""
+
+import datetime
+import unittest
+
+import testutil
+
+
+class MediaGcTest(testutil.TestCase):
+
+  def setUp(self):
+    testutil.TestCase.setUp(self)
+    import main
+    import mediagc
+    self.main = main
+    self.mediagc = mediagc
+    self.saved_batch_sizes = (mediagc.MEDIA_BATCH_SIZE,
+                              mediagc.BLOB_BATCH_SIZE)
+    self.user = self.user_info()
+
+  def tearDown(self):
+    (self.mediagc.MEDIA_BATCH_SIZE,
+     self.mediagc.BLOB_BATCH_SIZE) = self.saved_batch_sizes
+    testutil.TestCase.tearDown(self)
+
+  def age_blobs(self):
+    """Backdates every blob past the grace period."""
+    from google.appengine.api import datastore
+    from google.appengine.ext import blobstore
+    old = (datetime.datetime.now() - self.mediagc.BLOB_GRACE_PERIOD -
+           datetime.timedelta(hours=1))
+    entities = list(datastore.Query(blobstore.BLOB_INFO_KIND).Run())
+    for entity in entities:
+      entity['creation'] = old
+    datastore.Put(entities)
+
+  def run_gc(self, dry_run=False):
+    from model import GcRun
+    run = self.mediagc.start(dry_run)
+    self.run_tasks(self.mediagc.QUEUE_NAME)
+    run = GcRun.get(run.key())
+    self.assertEqual('done', run.phase)
+    return run
+
+  def exists(self, entity):
+    from google.appengine.ext import db
+    return db.get(entity.key()) is not None
+
+  def make_garbage(self):
+    """Returns (kept, orphaned) MediaObjects."""
+    loose = self.make_media(self.user)
+    page = self.make_media(self.user)
+    doc, = self.main.make_docs(self.user, [[page]])
+    no_doc = self.make_media(self.user, lacks_document=False)
+    not_a_page = self.make_media(self.user, lacks_document=False,
+                                 document=doc)
+    return [loose, page], [no_doc, not_a_page]
+
+  def test_collects_orphaned_media(self):
+    kept, orphans = self.make_garbage()
+    run = self.run_gc()
+    self.assertEqual(3, run.media_scanned)
+    self.assertEqual(2, run.media_orphaned)
+    self.assertEqual(sum([m.size for m in orphans]), run.bytes_reclaimed)
+    self.assertEqual([True, True], [self.exists(m) for m in kept])
+    self.assertEqual([False, False], [self.exists(m) for m in orphans])
+
+  def test_dry_run_only_counts(self):
+    kept, orphans = self.make_garbage()
+    self.age_blobs()
+    run = self.run_gc(dry_run=True)
+    self.assertEqual(2, run.media_orphaned)
+    self.assertEqual(0, run.blobs_orphaned)
+    self.assertEqual([True] * 4, [self.exists(m) for m in kept + orphans])
+
+  def test_collects_unreferenced_blobs(self):
+    media = self.make_media(self.user)
+    old = self.make_blob('old orphan')
+    self.age_blobs()
+    new = self.make_blob('new orphan')
+    run = self.run_gc()
+    self.assertEqual(3, run.blobs_scanned)
+    self.assertEqual(1, run.blobs_orphaned)
+    self.assertTrue(self.blob_exists(media.blob.key()))
+    self.assertFalse(self.blob_exists(old.key()))
+    self.assertTrue(self.blob_exists(new.key()))
+
+  def test_blob_referenced(self):
+    from google.appengine.ext import blobstore
+    from model import IngestEntry
+    media = self.make_media(self.user)
+    journaled = self.make_blob('journaled')
+    IngestEntry(user_email=testutil.USER_EMAIL,
+                blobs=[journaled.key()]).put()
+    self.assertTrue(self.mediagc.blob_referenced(media.blob.key()))
+    self.assertTrue(self.mediagc.blob_referenced(journaled.key()))
+    self.assertFalse(self.mediagc.blob_referenced(
+        blobstore.BlobKey('test-blob-none')))
+
+  def test_runs_in_batches(self):
+    self.mediagc.MEDIA_BATCH_SIZE = 2
+    self.mediagc.BLOB_BATCH_SIZE = 2
+    for unused in range(5):
+      self.make_media(self.user, lacks_document=False)
+    self.age_blobs()
+    run = self.run_gc()
+    self.assertEqual(5, run.media_orphaned)
+    self.assertEqual(5, run.blobs_orphaned)
+    # Three batches of each, the last short.
+    self.assertEqual(6, run.step)
+
+  def test_resume(self):
+    self.mediagc.MEDIA_BATCH_SIZE = 2
+    for unused in range(3):
+      self.make_media(self.user, lacks_document=False)
+    run = self.mediagc.start(dry_run=False)
+    self.mediagc.run_step(run.key().id())
+    # The next task is lost.
+    self.taskqueue.FlushQueue(self.mediagc.QUEUE_NAME)
+    run = self.mediagc.latest_run()
+    self.assertEqual(2, run.media_scanned)
+
+    self.mediagc.resume(run)
+    self.run_tasks(self.mediagc.QUEUE_NAME)
+    run = self.mediagc.latest_run()
+    self.assertEqual('done', run.phase)
+    self.assertEqual(3, run.media_scanned)
+    self.assertEqual(3, run.media_orphaned)
+
+  def test_admin_page(self):
+    self.make_media(self.user, lacks_document=False)
+    response = self.request('/admin/gc', post={'action': 'start',
+                                               'dry_run': '1'})
+    self.assertEqual(302, response.status_int)
+    self.run_tasks(self.mediagc.QUEUE_NAME)
+    body = self.request('/admin/gc').body
+    self.assertTrue('phase: done' in body)
+    self.assertTrue('media_orphaned: 1' in body)
+
+  def test_admin_only(self):
+    self.testbed.setup_env(user_is_admin='0', overwrite=True)
+    response = self.request('/admin/gc', post={'action': 'start'})
+    self.assertEqual(302, response.status_int)
+    self.assertEqual(None, self.mediagc.latest_run())
+
+
+if __name__ == '__main__':
+  unittest.main()
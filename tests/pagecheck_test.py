@@ -0,0 +1,228 @@
+#
+# Tests of scanningcabinet's AppEngine server-side code.
+#
+# Copyright 2009 Brad Fitzpatrick <brad@danga.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests of pagecheck.py."""
+
+import random
+import struct
+import unittest
+import zlib
+
+import testutil
+
+
+def _predict(filter_type, left, up, up_left):
+  if filter_type == 1:
+    return left
+  if filter_type == 2:
+    return up
+  if filter_type == 3:
+    return (left + up) // 2
+  if filter_type == 4:
+    estimate = left + up - up_left
+    a, b, c = abs(estimate - left), abs(estimate - up), \
+        abs(estimate - up_left)
+    if a <= b and a <= c:
+      return left
+    if b <= c:
+      return up
+    return up_left
+  return 0
+
+
+def make_png(rows, color_type=0, filter_type=0, palette=None):
+  """Encodes rows of 8-bit samples as a PNG, each row filtered alike."""
+  channels = {0: 1, 2: 3, 3: 1}[color_type]
+  stride = len(rows[0])
+  raw = []
+  previous = [0] * stride
+  for row in rows:
+    line = [chr(filter_type)]
+    for i, value in enumerate(row):
+      left = i >= channels and row[i - channels] or 0
+      up_left = i >= channels and previous[i - channels] or 0
+      predicted = _predict(filter_type, left, previous[i], up_left)
+      line.append(chr((value - predicted) & 0xff))
+    raw.append(''.join(line))
+    previous = row
+  chunks = [('IHDR', struct.pack('>IIBBBBB', stride // channels, len(rows),
+                                 8, color_type, 0, 0, 0))]
+  if palette is not None:
+    chunks.append(('PLTE', ''.join([chr(v) for v in palette])))
+  chunks.append(('IDAT', zlib.compress(''.join(raw))))
+  chunks.append(('IEND', ''))
+  parts = ['\x89PNG\r\n\x1a\n']
+  for kind, data in chunks:
+    parts.append(struct.pack('>I', len(data)) + kind + data +
+                 struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+  return ''.join(parts)
+
+
+def gradient(width, height, bright_left=True):
+  """Returns gray rows fading from white to black across the page."""
+  row = [255 - x * 255 // (width - 1) for x in range(width)]
+  if not bright_left:
+    row.reverse()
+  return [list(row) for unused in range(height)]
+
+
+class PageCheckTest(testutil.TestCase):
+
+  def setUp(self):
+    testutil.TestCase.setUp(self)
+    import pagecheck
+    self.pagecheck = pagecheck
+    self.saved = (pagecheck.RECENT_PAGES, pagecheck.DELETE_BATCH_SIZE)
+    self.user = self.user_info()
+
+  def tearDown(self):
+    self.pagecheck.RECENT_PAGES, self.pagecheck.DELETE_BATCH_SIZE = self.saved
+    testutil.TestCase.tearDown(self)
+
+  def test_decode_png_filters(self):
+    rand = random.Random(1)
+    gray = [[rand.randrange(256) for x in range(12)] for y in range(10)]
+    for filter_type in range(5):
+      self.assertEqual((12, 10, gray), self.pagecheck.decode_png(
+          make_png(gray, filter_type=filter_type)), filter_type)
+
+  def test_decode_png_color(self):
+    rgb = [[255, 0, 0, 0, 255, 0, 0, 0, 255, 10, 10, 10]]
+    expected = [[76, 149, 29, 10]]
+    self.assertEqual((4, 1, expected), self.pagecheck.decode_png(
+        make_png(rgb, color_type=2, filter_type=4)))
+    palette = [255, 0, 0, 0, 255, 0, 0, 0, 255, 10, 10, 10]
+    self.assertEqual((4, 1, expected), self.pagecheck.decode_png(
+        make_png([[0, 1, 2, 3]], color_type=3, palette=palette)))
+
+  def test_decode_png_errors(self):
+    good = make_png([[1, 2, 3]])
+    for bad in ('GIF89a', good[:8], good[:40],
+                make_png([[0]], color_type=3),  # No palette.
+                good.replace('\x08\x00\x00\x00\x00', '\x10\x00\x00\x00\x00',
+                             1)):  # 16 bits deep.
+      self.assertRaises(ValueError, self.pagecheck.decode_png, bad)
+
+  def test_difference_hash(self):
+    width, height = 18, 16
+    self.assertEqual('f' * 16, self.pagecheck.difference_hash(
+        width, height, gradient(width, height)))
+    self.assertEqual('0' * 16, self.pagecheck.difference_hash(
+        width, height, gradient(width, height, bright_left=False)))
+    flat = [[128] * width for unused in range(height)]
+    self.assertEqual('0' * 16,
+                     self.pagecheck.difference_hash(width, height, flat))
+    self.assertRaises(ValueError, self.pagecheck.difference_hash, 8, 8,
+                      [[0] * 8] * 8)
+
+  def test_distance(self):
+    self.assertEqual(0, self.pagecheck.distance('0' * 16, '0' * 16))
+    self.assertEqual(64, self.pagecheck.distance('0' * 16, 'f' * 16))
+    self.assertEqual(3, self.pagecheck.distance('0000000000000007',
+                                                '0000000000000000'))
+
+  def test_ink_coverage(self):
+    counts = [0] * 256
+    counts[240] = 850
+    counts[200] = 50  # Darker than paper, but not by INK_CONTRAST.
+    counts[0] = 100
+    self.assertAlmostEqual(0.1, self.pagecheck.ink_coverage([counts] * 3))
+    self.assertEqual(0.0, self.pagecheck.ink_coverage([[0] * 256] * 3))
+    white = [0] * 255 + [1000]
+    self.assertEqual(0.0, self.pagecheck.ink_coverage([white] * 3))
+
+  def record(self, media_id, phash, ink=0.5):
+    from google.appengine.ext import db
+    result = self.pagecheck.Result(ink, phash)
+    return db.run_in_transaction(self.pagecheck.record, self.user.key(),
+                                 media_id, result)
+
+  def test_record(self):
+    self.assertEqual(None, self.record(1, '0' * 16))
+    self.assertEqual(None, self.record(2, 'f' * 16))
+    self.assertEqual(1, self.record(3, '0000000000000003'))
+    self.assertEqual(2, self.record(4, 'fffffffffffffff0'))
+    # Already recorded, as by a retried task.
+    self.assertEqual(None, self.record(3, '0000000000000003'))
+    # Blank pages all look alike, so aren't compared or kept.
+    self.assertEqual(None, self.record(5, '0' * 16, ink=0.0))
+    from model import PageHashes
+    recent, = PageHashes.all().fetch(10)
+    self.assertEqual([1, 2, 3, 4], recent.media_ids)
+
+  def test_record_keeps_recent_pages(self):
+    self.pagecheck.RECENT_PAGES = 2
+    self.record(1, '0' * 16)
+    self.record(2, 'f' * 16)
+    self.record(3, 'f' * 16)
+    self.assertEqual(None, self.record(4, '0' * 16))  # 1 is forgotten.
+
+  def test_check(self):
+    self.require_images()
+    white = [[255] * 64 for unused in range(64)]
+    blank = self.pagecheck.check(make_png(white))
+    self.assertTrue(blank.blank)
+    page = self.pagecheck.check(make_png(gradient(64, 64)))
+    self.assertFalse(page.blank)
+    self.assertEqual('f' * 16, page.phash)
+    self.assertEqual(None, self.pagecheck.check('not an image'))
+
+  def test_processing_flags_pages(self):
+    self.require_images()
+    import processing
+    from model import MediaObject
+    def scan(rows):
+      media = self.make_media(self.user, make_png(rows), 'scan.png',
+                              content_type='image/png',
+                              processing_state='pending')
+      processing.process_task([media.key()], 0)
+      return MediaObject.get(media.key())
+    first = scan(gradient(64, 64))
+    again = scan(gradient(64, 64))
+    other = scan(gradient(64, 64, bright_left=False))
+    blank = scan([[255] * 64 for unused in range(64)])
+    self.assertEqual(first.key().id(), again.duplicate_of_id)
+    self.assertEqual((None, None), (first.duplicate_of_id,
+                                    other.duplicate_of_id))
+    self.assertEqual((False, True), (first.blank, blank.blank))
+    self.assertEqual(None, blank.duplicate_of_id)
+
+  def test_delete_blank(self):
+    import counters
+    from model import MediaObject
+    self.pagecheck.DELETE_BATCH_SIZE = 2
+    blank = [self.make_media(self.user, blank=True) for unused in range(3)]
+    # Shares the first blank page's blob.
+    kept = self.make_media(self.user, blob=blank[0].blob.key())
+    in_doc = self.make_media(self.user, blank=True, lacks_document=False)
+    counters.recount(self.user)
+
+    response = self.request('/delete_blank', post={})
+    self.assertEqual(302, response.status_int)
+    self.assertEqual(1, len(self.tasks(self.pagecheck.QUEUE_NAME)))
+    self.run_tasks(self.pagecheck.QUEUE_NAME)
+    self.assertEqual(sorted([kept.key(), in_doc.key()]),
+                     sorted(MediaObject.all(keys_only=True).fetch(10)))
+    self.assertEqual(2, counters.totals(self.user.key())['media'])
+    self.assertTrue(self.blob_exists(kept.blob.key()))
+    for media in blank[1:]:
+      self.assertFalse(self.blob_exists(media.blob.key()))
+
+
+if __name__ == '__main__':
+  unittest.main()
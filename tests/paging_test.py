@@ -0,0 +1,123 @@
+#
+# Tests of scanningcabinet's AppEngine server-side code.
+#
+# Copyright 2009 Brad Fitzpatrick <brad@danga.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests of paging.py and the paged home page sections."""
+
+import datetime
+import unittest
+
+import testutil
+
+
+class PagingTest(testutil.TestCase):
+
+  def setUp(self):
+    testutil.TestCase.setUp(self)
+    self.user = self.user_info()
+    self.page = self.make_media(self.user, lacks_document=False)
+
+  def make_doc(self, **fields):
+    from model import Document
+    doc = Document(parent=self.user, owner=self.user,
+                   pages=[self.page.key()], **fields)
+    doc.put()
+    return doc
+
+  def fetch(self, section, page_size, token=''):
+    import main
+    return main.fetch_home_view(self.user, page_size, {section: token})[section]
+
+  def ids(self, page):
+    return [item.key().id() for item in page.items]
+
+  def test_clamp_page_size(self):
+    import paging
+    self.assertEqual(10, paging.clamp_page_size('', 10))
+    self.assertEqual(10, paging.clamp_page_size('x', 10))
+    self.assertEqual(1, paging.clamp_page_size('-5', 10))
+    self.assertEqual(paging.MAX_PAGE_SIZE, paging.clamp_page_size('99999', 10))
+    self.assertEqual(25, paging.clamp_page_size('25', 10))
+
+  def test_forward_and_back(self):
+    docs = [self.make_doc() for unused in range(7)]
+    all_ids = sorted([doc.key().id() for doc in docs])
+
+    first = self.fetch('docs', 3)
+    self.assertEqual(all_ids[:3], self.ids(first))
+    self.assertEqual(None, first.prev_token)
+    second = self.fetch('docs', 3, first.next_token)
+    self.assertEqual(all_ids[3:6], self.ids(second))
+    third = self.fetch('docs', 3, second.next_token)
+    self.assertEqual(all_ids[6:], self.ids(third))
+    self.assertEqual(None, third.next_token)
+
+    back = self.fetch('docs', 3, third.prev_token)
+    self.assertEqual(all_ids[3:6], self.ids(back))
+    back = self.fetch('docs', 3, back.prev_token)
+    self.assertEqual(all_ids[:3], self.ids(back))
+
+  def test_bad_tokens_get_first_page(self):
+    docs = [self.make_doc() for unused in range(3)]
+    first_ids = sorted([doc.key().id() for doc in docs])[:2]
+    good = self.fetch('docs', 2).next_token
+    # From another section's query.
+    self.make_media(self.user)
+    self.make_media(self.user)
+    other = self.fetch('media', 1).next_token
+    for token in ('x', 'f', 'b', 'fnot-a-cursor', 'z' + good[1:], other):
+      page = self.fetch('docs', 2, token)
+      self.assertEqual(first_ids, self.ids(page), token)
+      self.assertEqual(None, page.prev_token)
+    response = self.request('/?docs_cursor=fgarbage&media_cursor=b')
+    self.assertEqual(200, response.status_int)
+
+  def test_due_section_pages(self):
+    # The due section used to be a "!= None" MultiQuery, whose lack of
+    # cursors made every home page with a due document fail.
+    import main
+    size = main.UPCOMING_DUE_PAGE_SIZE
+    start = datetime.datetime(2010, 1, 1)
+    due = [self.make_doc(due_date=start + datetime.timedelta(days=i))
+           for i in range(size + 2)]
+    self.make_doc()  # Not due; not in the section.
+    due_ids = [doc.key().id() for doc in due]
+
+    first = self.fetch('due', 10)
+    self.assertEqual(due_ids[:size], self.ids(first))
+    self.assertNotEqual(None, first.next_token)
+    second = self.fetch('due', 10, first.next_token)
+    self.assertEqual(due_ids[size:], self.ids(second))
+    self.assertEqual(None, second.next_token)
+    back = self.fetch('due', 10, second.prev_token)
+    self.assertEqual(due_ids[:size], self.ids(back))
+
+  def test_home_page_with_due_documents(self):
+    self.make_doc(due_date=datetime.datetime(2010, 4, 15), title='Taxes')
+    self.make_doc(title='Not due')
+    response = self.request('/')
+    self.assertEqual(200, response.status_int)
+    self.assertTrue('Taxes' in response.body)
+
+  def test_media_section_is_unannotated_scans(self):
+    loose = [self.make_media(self.user) for unused in range(3)]
+    page = self.fetch('media', 10)
+    self.assertEqual([m.key().id() for m in loose], self.ids(page))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,101 @@
+#
+# Tests of scanningcabinet's AppEngine server-side code.
+#
+# Copyright 2009 Brad Fitzpatrick <brad@danga.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests of processing.py."""
+
+import unittest
+
+import testutil
+
+
+class ProcessingTest(testutil.TestCase):
+
+  def setUp(self):
+    testutil.TestCase.setUp(self)
+    import processing
+    self.processing = processing
+    self.user = self.user_info()
+
+  def reload(self, media):
+    from google.appengine.ext import db
+    return db.get(media.key())
+
+  def test_upload_queues_processing(self):
+    blob_info = self.make_blob(testutil.make_jpeg(),
+                               'image-1-unx1262304000.jpg')
+    media, = self.store([blob_info])
+    self.assertEqual('pending', media.processing_state)
+    tasks = self.tasks(self.processing.QUEUE_NAME)
+    self.assertEqual(1, len(tasks))
+    self.assertEqual([str(media.key())], tasks[0]['params']['key'])
+
+  def test_process_image(self):
+    self.require_images()
+    from model import DerivedImage
+    media = self.make_media(self.user, testutil.make_jpeg(200, 100),
+                            processing_state='pending')
+    self.assertTrue(self.processing.process_task([media.key()], 0))
+    media = self.reload(media)
+    self.assertEqual('done', media.processing_state)
+    self.assertEqual((200, 100), (media.width, media.height))
+    self.assertNotEqual(None, media.processed)
+    self.assertNotEqual(None, media.ink_coverage)
+    self.assertEqual(2, DerivedImage.all().count())
+
+  def test_process_non_image(self):
+    media = self.make_media(self.user, '%PDF-1.4\n', 'bill.pdf',
+                            content_type='application/octet-stream',
+                            processing_state='pending')
+    self.assertTrue(self.processing.process_task([media.key()], 0))
+    media = self.reload(media)
+    self.assertEqual('done', media.processing_state)
+    self.assertEqual('application/pdf', media.content_type)
+    self.assertEqual(None, media.blank)
+
+  def test_done_media_skipped(self):
+    media = self.make_media(self.user, '%PDF-1.4\n', 'bill.pdf',
+                            content_type='application/octet-stream',
+                            processing_state='done')
+    self.assertTrue(self.processing.process_task([media.key()], 0))
+    self.assertEqual('application/octet-stream',
+                     self.reload(media).content_type)
+
+  def test_gives_up_after_max_attempts(self):
+    media = self.make_media(self.user, processing_state='pending')
+    self.assertTrue(self.processing.process_task(
+        [media.key()], self.processing.MAX_ATTEMPTS))
+    self.assertEqual('failed', self.reload(media).processing_state)
+
+  def test_deleted_media_skipped(self):
+    media = self.make_media(self.user, processing_state='pending')
+    key = media.key()
+    media.delete()
+    self.assertTrue(self.processing.process_task([key], 0))
+
+  def test_task_handler(self):
+    media = self.make_media(self.user, '%PDF-1.4\n', 'bill.pdf',
+                            content_type='application/pdf',
+                            processing_state='pending')
+    response = self.request(self.processing.TASK_URL,
+                            post={'key': str(media.key())})
+    self.assertEqual(200, response.status_int)
+    self.assertEqual('done', self.reload(media).processing_state)
+
+
+if __name__ == '__main__':
+  unittest.main()
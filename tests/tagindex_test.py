@@ -0,0 +1,167 @@
+#
+# Tests of scanningcabinet's AppEngine server-side code.
+#
+# Copyright 2009 Brad Fitzpatrick <brad@danga.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests of tagindex.py."""
+
+import unittest
+
+import testutil
+
+
+class TagIndexTest(testutil.TestCase):
+
+  def setUp(self):
+    testutil.TestCase.setUp(self)
+    import tagindex
+    self.tagindex = tagindex
+    self.saved = (tagindex.REBUILD_BATCH_SIZE, tagindex.RECONCILE_BATCH_SIZE)
+    self.user = self.user_info()
+    self.page = self.make_media(self.user, lacks_document=False)
+
+  def tearDown(self):
+    (self.tagindex.REBUILD_BATCH_SIZE,
+     self.tagindex.RECONCILE_BATCH_SIZE) = self.saved
+    testutil.TestCase.tearDown(self)
+
+  def make_doc(self, tags):
+    """Writes a Document with tags, indexing it as the handlers do."""
+    from google.appengine.ext import db
+    from model import Document
+    doc = Document(parent=self.user, owner=self.user, pages=[self.page.key()],
+                   tags=tags, no_tags=not tags)
+    def tx():
+      doc.put()
+      self.tagindex.update_document_tags(self.user.key(), doc.key().id(),
+                                         [], tags)
+    db.run_in_transaction(tx)
+    return doc.key().id()
+
+  def search(self, text):
+    return self.tagindex.search(self.user.key(), text)
+
+  def cloud(self):
+    return dict((entry['tag'], entry['count'])
+                for entry in self.tagindex.tag_cloud(self.user.key()))
+
+  def test_sorted_list_operations(self):
+    self.assertEqual([1, 2, 3, 5], self.tagindex.union([1, 3], [2, 3, 5]))
+    self.assertEqual([3], self.tagindex.intersect([1, 3], [2, 3, 5]))
+    self.assertEqual([1], self.tagindex.difference([1, 3], [2, 3, 5]))
+    self.assertEqual([], self.tagindex.union([], []))
+
+  def test_parse_query(self):
+    self.assertEqual((['car', 'tax'], ['audi'], ['2008']),
+                     self.tagindex.parse_query('car, +audi, -2008 , tax'))
+
+  def test_search(self):
+    car = self.make_doc(['car', 'insurance'])
+    audi = self.make_doc(['car', 'audi', '2008'])
+    house = self.make_doc(['house', 'insurance'])
+    self.assertEqual(sorted([car, audi]), self.search('car'))
+    self.assertEqual(sorted([car, audi, house]), self.search('car, house'))
+    self.assertEqual([car], self.search('car, +insurance'))
+    self.assertEqual([car], self.search('car, -2008'))
+    self.assertEqual([], self.search('-car'))
+    self.assertEqual([], self.search('nothing'))
+
+  def test_retagging_moves_postings(self):
+    from google.appengine.ext import db
+    doc_id = self.make_doc(['car', 'tax'])
+    db.run_in_transaction(self.tagindex.update_document_tags, self.user.key(),
+                          doc_id, ['car', 'tax'], ['tax', 'bank'])
+    self.assertEqual([], self.search('car'))
+    self.assertEqual([doc_id], self.search('bank'))
+    self.assertEqual({'tax': 1, 'bank': 1}, self.cloud())
+
+  def test_empty_postings_are_deleted(self):
+    from google.appengine.ext import db
+    from model import TagPosting
+    doc_id = self.make_doc(['car'])
+    db.run_in_transaction(self.tagindex.update_document_tags, self.user.key(),
+                          doc_id, ['car'], [])
+    self.assertEqual(0, TagPosting.all().count())
+    self.assertEqual([], self.tagindex.tag_cloud(self.user.key()))
+
+  def test_tag_cloud_sizes(self):
+    for unused in range(4):
+      self.make_doc(['tax'])
+    self.make_doc(['car'])
+    cloud = self.tagindex.tag_cloud(self.user.key())
+    self.assertEqual(['car', 'tax'], [entry['tag'] for entry in cloud])
+    self.assertEqual(self.tagindex.CLOUD_SIZES[-1], cloud[1]['size'])
+    self.assertEqual(self.tagindex.CLOUD_SIZES[1], cloud[0]['size'])
+
+  def test_rebuild_matches_updates(self):
+    from model import Document
+    self.make_doc(['car', 'tax'])
+    self.make_doc(['tax'])
+    # A tag the index doesn't know about yet.
+    doc = Document(parent=self.user, owner=self.user, pages=[self.page.key()],
+                   tags=['bank'], no_tags=False)
+    doc.put()
+    # And a posting for a tag no document has any more.
+    from model import TagPosting
+    TagPosting(parent=self.user, key_name='tag:old',
+               doc_ids=[doc.key().id()]).put()
+    before = self.cloud()
+    self.tagindex.rebuild(self.user)
+    self.run_tasks(self.tagindex.QUEUE_NAME)
+    before['bank'] = 1
+    self.assertEqual(before, self.cloud())
+    self.assertEqual([doc.key().id()], self.search('bank'))
+    self.assertEqual([], self.search('old'))
+    self.assertEqual(['tag:bank', 'tag:car', 'tag:tax'],
+                     sorted([p.key().name() for p in TagPosting.all()]))
+
+  def test_rebuild_keeps_postings_and_edits(self):
+    from google.appengine.ext import db
+    from model import Document
+    self.tagindex.REBUILD_BATCH_SIZE = 1
+    self.tagindex.RECONCILE_BATCH_SIZE = 1
+    car = self.make_doc(['car'])
+    tax = self.make_doc(['tax'])
+    self.tagindex.rebuild_step(self.user.key(), '1', 'docs', '', 0)
+    self.tagindex.rebuild_step(self.user.key(), '1', 'docs', '', 0)  # Retry.
+    # Search still works while the rebuild runs.
+    self.assertEqual([car], self.search('car'))
+    # Edits after their documents were staged.
+    def retag():
+      doc = Document.get_by_id(car, parent=self.user)
+      doc.tags = ['bank']
+      doc.put()
+      self.tagindex.update_document_tags(self.user.key(), car, ['car'],
+                                         ['bank'])
+    db.run_in_transaction(retag)
+    late = self.make_doc(['car'])
+    self.run_tasks(self.tagindex.QUEUE_NAME)
+    self.assertEqual([late], self.search('car'))
+    self.assertEqual([car], self.search('bank'))
+    self.assertEqual([tax], self.search('tax'))
+    self.assertEqual({'car': 1, 'bank': 1, 'tax': 1}, self.cloud())
+
+  def test_changedoc_updates_index(self):
+    doc_id = self.make_doc(['car'])
+    response = self.request('/changedoc', post={
+        'docid': str(doc_id), 'tags': 'tax, bank', 'title': 'Bill'})
+    self.assertEqual(302, response.status_int)
+    self.assertEqual([], self.search('car'))
+    self.assertEqual([doc_id], self.search('tax, +bank'))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,227 @@
+#
+# Tests of scanningcabinet's AppEngine server-side code.
+#
+# Copyright 2009 Brad Fitzpatrick <brad@danga.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Shared setup for the tests of appengine/.
+
+Like tools/bench.py, the tests run the app in-process against the SDK's
+service stubs (google.appengine.ext.testbed), so they need Python 2 and
+the App Engine SDK:
+
+  APPENGINE_SDK=~/google_appengine python2.7 -m unittest discover \\
+      -s tests -p '*_test.py'
+
+Without them, importing any test module raises unittest.SkipTest.
+"""
+
+import base64
+import cgi
+import datetime
+import hashlib
+import io
+import os
+import sys
+import unittest
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+APPENGINE_DIR = os.path.join(ROOT_DIR, 'appengine')
+TOOLS_DIR = os.path.join(ROOT_DIR, 'tools')
+
+SDK_PATH = os.path.expanduser(os.environ.get('APPENGINE_SDK',
+                                             '~/google_appengine'))
+
+USER_EMAIL = 'test@example.com'
+
+
+def _setup_sdk():
+  if sys.version_info[0] != 2:
+    raise unittest.SkipTest('the App Engine SDK needs Python 2')
+  if not os.path.exists(os.path.join(SDK_PATH, 'dev_appserver.py')):
+    raise unittest.SkipTest('no App Engine SDK in %s; set APPENGINE_SDK'
+                            % SDK_PATH)
+  if TOOLS_DIR not in sys.path:
+    sys.path.insert(0, TOOLS_DIR)
+    import bench
+    bench.setup_sdk(SDK_PATH)
+
+_setup_sdk()
+
+import bench
+
+
+def make_jpeg(width=64, height=64, seed=0):
+  """Returns JPEG data of a noisy page; see bench.make_jpeg."""
+  return bench.make_jpeg(width, height, seed)
+
+
+class TestCase(unittest.TestCase):
+  """Runs each test in a fresh testbed, logged in as USER_EMAIL, an admin.
+
+  The datastore stub is fully consistent, so queries see every write
+  made before them.
+  """
+
+  def setUp(self):
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    # Not 'Development/...', so main.py runs as in production.
+    self.testbed.setup_env(app_id='scanningcabinet',
+                           server_software='Google App Engine/test',
+                           user_email=USER_EMAIL,
+                           user_id='1',
+                           user_is_admin='1',
+                           overwrite=True)
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+        probability=1)
+    self.testbed.init_datastore_v3_stub(consistency_policy=policy)
+    self.testbed.init_memcache_stub()
+    self.testbed.init_blobstore_stub()
+    self.testbed.init_files_stub()
+    self.testbed.init_taskqueue_stub(root_path=APPENGINE_DIR)
+    self.testbed.init_user_stub()
+    self.images = True
+    try:
+      self.testbed.init_images_stub()
+    except Exception:  # The stub needs PIL.
+      self.images = False
+    self.taskqueue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+    self.next_blob = 0
+
+    import usercache
+    usercache._local.clear()  # From the previous test's testbed.
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def require_images(self):
+    if not self.images:
+      self.skipTest('the images stub needs PIL')
+
+  def log_out(self):
+    self.testbed.setup_env(user_email='', user_id='', user_is_admin='0',
+                           overwrite=True)
+
+  def user_info(self):
+    """Returns the logged-in user's UserInfo, creating it."""
+    import main
+    return main.get_user_info()
+
+  def make_blob(self, data, filename='scan.jpg', content_type='image/jpeg'):
+    """Stores a blob with a full BlobInfo, as an upload would.
+
+    Returns:
+      Its BlobInfo.
+    """
+    from google.appengine.api import datastore
+    from google.appengine.ext import blobstore
+    self.next_blob += 1
+    blob_key = blobstore.BlobKey('test-blob-%d' % self.next_blob)
+    self.testbed.get_stub('blobstore').storage.StoreBlob(blob_key,
+                                                         io.BytesIO(data))
+    entity = datastore.Entity(blobstore.BLOB_INFO_KIND, name=str(blob_key),
+                              namespace='')
+    entity['content_type'] = content_type
+    entity['creation'] = datetime.datetime.now()
+    entity['filename'] = filename
+    entity['size'] = len(data)
+    entity['md5_hash'] = hashlib.md5(data).hexdigest()
+    datastore.Put(entity)
+    return blobstore.BlobInfo.get(blob_key)
+
+  def blob_exists(self, blob_key):
+    from google.appengine.ext import blobstore
+    return blobstore.BlobInfo.get(blob_key) is not None
+
+  def make_media(self, user_info, data=None, filename='scan.jpg', **fields):
+    """Writes an un-annotated MediaObject of a new blob of data."""
+    from model import MediaObject
+    if data is None:
+      data = make_jpeg(seed=self.next_blob)
+    blob_info = self.make_blob(data, filename)
+    values = dict(owner=user_info, blob=blob_info.key(),
+                  md5_hash=blob_info.md5_hash,
+                  creation=datetime.datetime.now(),
+                  content_type='image/jpeg', filename=filename,
+                  size=len(data), lacks_document=True,
+                  processing_state='done')
+    values.update(fields)
+    media = MediaObject(parent=user_info, **values)
+    media.put()
+    return media
+
+  def store(self, blob_infos, doc_fields=None):
+    """Stores uploads as the journal would.  Returns the MediaObjects."""
+    import main
+    error_messages = []
+    results = main.store_uploads(USER_EMAIL, blob_infos, error_messages,
+                                 doc_fields)
+    self.assertEqual([], error_messages)
+    return results
+
+  def request(self, path, post=None, method=None, body=None,
+              content_type=None, headers=None):
+    """Runs one request through main.application.  Returns the response."""
+    import main
+    import webob
+    if post is not None:
+      req = webob.Request.blank(path, POST=post)
+    else:
+      req = webob.Request.blank(path)
+    if method:
+      req.method = method
+    if body is not None:
+      req.body = body
+      if content_type:
+        req.content_type = content_type
+    for name, value in (headers or {}).items():
+      req.headers[name] = value
+    return req.get_response(main.application)
+
+  def tasks(self, queue_name):
+    """Returns the queue's tasks, each with its params decoded."""
+    tasks = self.taskqueue.GetTasks(queue_name)
+    for task in tasks:
+      body = base64.b64decode(task.get('body') or '')
+      task['params'] = cgi.parse_qs(body)
+    return tasks
+
+  def run_tasks(self, queue_name, limit=100):
+    """Runs the queue's tasks, and any they add, until it's empty.
+
+    Returns:
+      How many tasks ran.
+    """
+    ran = 0
+    while True:
+      tasks = self.taskqueue.GetTasks(queue_name)
+      if not tasks:
+        return ran
+      for task in tasks:
+        self.taskqueue.DeleteTask(queue_name, task['name'])
+        body = base64.b64decode(task.get('body') or '')
+        response = self.request(
+            task['url'], method=task.get('method', 'POST'), body=body,
+            content_type='application/x-www-form-urlencoded',
+            headers={'X-AppEngine-QueueName': queue_name,
+                     'X-AppEngine-TaskName': task['name']})
+        self.assertTrue(response.status_int < 400,
+                        '%s failed: %s' % (task['url'], response.status))
+        ran += 1
+        if ran >= limit:
+          self.fail('%s still has tasks after %d' % (queue_name, limit))
@@ -0,0 +1,171 @@
+#
+# Tests of scanningcabinet's AppEngine server-side code.
+#
+# Copyright 2009 Brad Fitzpatrick <brad@danga.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests of textsearch.py."""
+
+import unittest
+
+import testutil
+
+
+class TextSearchTest(testutil.TestCase):
+
+  def setUp(self):
+    testutil.TestCase.setUp(self)
+    import textsearch
+    self.textsearch = textsearch
+    self.saved_batch_size = textsearch.REBUILD_BATCH_SIZE
+    self.user = self.user_info()
+    self.page = self.make_media(self.user, lacks_document=False)
+
+  def tearDown(self):
+    self.textsearch.REBUILD_BATCH_SIZE = self.saved_batch_size
+    testutil.TestCase.tearDown(self)
+
+  def new_doc(self, **fields):
+    from model import Document
+    return Document(parent=self.user, owner=self.user,
+                    pages=[self.page.key()], **fields)
+
+  def make_doc(self, index=True, **fields):
+    """Writes a Document, indexing it as the handlers do."""
+    from google.appengine.ext import db
+    doc = self.new_doc(**fields)
+    def tx():
+      doc.put()
+      if index:
+        self.textsearch.update_document(self.user.key(), doc.key().id(), {},
+                                        self.textsearch.document_terms(doc))
+    db.run_in_transaction(tx)
+    return doc
+
+  def search(self, text):
+    return self.textsearch.search(self.user.key(), text)
+
+  def doc_count(self):
+    from model import SearchIndexInfo
+    info = SearchIndexInfo.get_by_key_name('ftinfo', parent=self.user)
+    return info and info.doc_count or 0
+
+  def df(self, word):
+    from model import SearchLexicon
+    lexicon = SearchLexicon.get_by_key_name('lex:' + word[0],
+                                            parent=self.user)
+    if lexicon is None or word not in lexicon.terms:
+      return 0
+    return lexicon.dfs[lexicon.terms.index(word)]
+
+  def test_tokenize(self):
+    self.assertEqual(['state', 'farm', 'w2'],
+                     self.textsearch.tokenize('State Farm, W2!'))
+    self.assertEqual([], self.textsearch.tokenize(None))
+
+  def test_parse_query(self):
+    self.assertEqual([('word', 'farm'), ('prefix', 'insur'),
+                      ('phrase', ['state', 'farm']),
+                      ('phrase', ['e', 'mail'])],
+                     self.textsearch.parse_query(
+                         'farm insur* "state farm" e-mail'))
+
+  def test_document_terms(self):
+    doc = self.new_doc(title='State Farm', tags=['car'],
+                       description='farm bill')
+    terms = self.textsearch.document_terms(doc)
+    self.assertEqual({'state': 4, 'farm': 5, 'state farm': 4, 'car': 3,
+                      'bill': 1, 'farm bill': 1}, terms)
+
+  def test_document_terms_are_capped(self):
+    limit = self.textsearch.MAX_TERMS_PER_DOC
+    words = ['word%d' % i for i in range(limit * 2)]
+    doc = self.new_doc(title='Insurance policy', description=' '.join(words))
+    terms = self.textsearch.document_terms(doc)
+    self.assertEqual(limit, len(terms))
+    # Words before pairs, and the title's before the description's.
+    self.assertEqual([], [t for t in terms if ' ' in t])
+    self.assertTrue('insurance' in terms and 'policy' in terms)
+    self.assertEqual(terms, self.textsearch.document_terms(doc))
+
+  def test_search(self):
+    farm = self.make_doc(title='State Farm insurance')
+    bill = self.make_doc(title='Phone bill', description='state of the farm')
+    self.make_doc(title='Unrelated')
+    farm_id, bill_id = farm.key().id(), bill.key().id()
+
+    # Title matches rank above description matches.
+    self.assertEqual([farm_id, bill_id], self.search('farm'))
+    self.assertEqual([farm_id], self.search('"state farm"'))
+    self.assertEqual([farm_id], self.search('insur*'))
+    self.assertEqual([bill_id], self.search('farm phone'))
+    self.assertEqual([], self.search('nothing'))
+    self.assertEqual(3, self.doc_count())
+    self.assertEqual(2, self.df('farm'))
+
+  def test_update_and_delete(self):
+    from google.appengine.ext import db
+    doc = self.make_doc(title='Car insurance')
+    old_terms = self.textsearch.document_terms(doc)
+    doc.title = 'House insurance'
+    db.run_in_transaction(self.textsearch.update_document, self.user.key(),
+                          doc.key().id(), old_terms,
+                          self.textsearch.document_terms(doc))
+    self.assertEqual([], self.search('car'))
+    self.assertEqual([doc.key().id()], self.search('house'))
+    self.assertEqual(0, self.df('car'))
+
+    db.run_in_transaction(self.textsearch.update_document, self.user.key(),
+                          doc.key().id(), self.textsearch.document_terms(doc),
+                          {})
+    self.assertEqual([], self.search('insurance'))
+    self.assertEqual(0, self.doc_count())
+
+  def test_rebuild_in_tasks(self):
+    from model import SearchPosting
+    self.textsearch.REBUILD_BATCH_SIZE = 2
+    docs = [self.make_doc(title='Tax return %d' % i) for i in range(3)]
+    # Missing from the index, and a stale entry for nothing.
+    missing = self.make_doc(index=False, title='Tax audit')
+    SearchPosting(parent=self.user, key_name='ft:stale:0', doc_ids=[long(1)],
+                  weights=[long(1)]).put()
+
+    self.textsearch.rebuild(self.user)
+    self.assertEqual(3, len(self.search('tax')))
+    self.assertTrue(self.run_tasks(self.textsearch.QUEUE_NAME) >= 3)
+
+    ids = sorted([doc.key().id() for doc in docs + [missing]])
+    self.assertEqual(ids, sorted(self.search('tax')))
+    self.assertEqual([missing.key().id()], self.search('audit'))
+    self.assertEqual([], self.search('stale'))
+    self.assertEqual(4, self.doc_count())
+    self.assertEqual(4, self.df('tax'))
+
+  def test_rebuild_step_retried(self):
+    self.make_doc(index=False, title='Tax return')
+    self.textsearch.rebuild_step(self.user.key(), '1', 'docs', '', 0)
+    self.textsearch.rebuild_step(self.user.key(), '1', 'docs', '', 0)
+    self.assertEqual(1, self.doc_count())
+    self.assertEqual(1, self.df('tax'))
+
+  def test_reindex_handler(self):
+    self.make_doc(index=False, title='Tax return')
+    self.assertEqual(302, self.request('/reindex', post={}).status_int)
+    self.run_tasks(self.textsearch.QUEUE_NAME)
+    self.assertEqual(1, len(self.search('tax')))
+
+
+if __name__ == '__main__':
+  unittest.main()
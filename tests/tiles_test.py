@@ -0,0 +1,117 @@
+#
+# Tests of scanningcabinet's AppEngine server-side code.
+#
+# Copyright 2009 Brad Fitzpatrick <brad@danga.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests of tiles.py."""
+
+import unittest
+
+import testutil
+
+
+class TilesTest(testutil.TestCase):
+
+  def setUp(self):
+    testutil.TestCase.setUp(self)
+    import tiles
+    self.tiles = tiles
+    self.user = self.user_info()
+
+  def scan(self, width=600, height=300):
+    return self.make_media(self.user, testutil.make_jpeg(width, height),
+                           width=width, height=height)
+
+  def assertTileSize(self, expected, tile):
+    # Crop boxes go to the images service as single-precision fractions,
+    # so an edge can come out a pixel off.
+    from google.appengine.api import images
+    image = images.Image(image_data=tile[0])
+    for want, got in zip(expected, (image.width, image.height)):
+      self.assertTrue(abs(want - got) <= 1, (expected, image.width,
+                                             image.height))
+
+  def test_pyramid(self):
+    size = self.tiles.TILE_SIZE
+    self.assertEqual((600, 300, 2), self.tiles.pyramid(self.scan()))
+    self.assertEqual((size, 10, 0), self.tiles.pyramid(self.scan(size, 10)))
+    self.assertEqual((size + 1, 10, 1),
+                     self.tiles.pyramid(self.scan(size + 1, 10)))
+    unprocessed = self.make_media(self.user)
+    self.assertEqual(None, self.tiles.pyramid(unprocessed))
+    pdf = self.make_media(self.user, '%PDF-1.4\n', 'bill.pdf',
+                          content_type='application/pdf', width=10,
+                          height=10)
+    self.assertEqual(None, self.tiles.pyramid(pdf))
+
+  def test_level_size(self):
+    self.assertEqual((600, 300), self.tiles.level_size(600, 300, 2, 2))
+    self.assertEqual((300, 150), self.tiles.level_size(600, 300, 2, 1))
+    self.assertEqual((150, 75), self.tiles.level_size(600, 300, 2, 0))
+    # Rounded up, so the edge pixels show.
+    self.assertEqual((301, 151), self.tiles.level_size(601, 301, 2, 1))
+
+  def test_no_such_tile(self):
+    media = self.scan()
+    for zoom, col, row in ((3, 0, 0), (-1, 0, 0), (2, 3, 0), (2, 0, 2),
+                           (1, 2, 0), (0, 1, 0), (2, -1, 0)):
+      self.assertEqual(None, self.tiles.get_tile(media, zoom, col, row),
+                       (zoom, col, row))
+
+  def test_tiles(self):
+    self.require_images()
+    media = self.scan()
+    size = self.tiles.TILE_SIZE
+    self.assertTileSize((150, 75), self.tiles.get_tile(media, 0, 0, 0))
+    self.assertTileSize((size, size), self.tiles.get_tile(media, 2, 1, 0))
+    # The right and bottom edges.
+    self.assertTileSize((600 - 2 * size, 300 - size),
+                        self.tiles.get_tile(media, 2, 2, 1))
+    self.assertTileSize((300 - size, 150),
+                        self.tiles.get_tile(media, 1, 1, 0))
+
+  def test_tiles_cached(self):
+    self.require_images()
+    from model import DerivedImage
+    media = self.scan()
+    first = self.tiles.get_tile(media, 2, 0, 0)
+    self.assertEqual('image/jpeg', first[1])
+    import imagecache
+    self.assertNotEqual(None, DerivedImage.get_by_key_name(
+        imagecache.variant_key_name(media.key(), 't2-0-0', 'jpeg')))
+    self.assertEqual(first, self.tiles.get_tile(media, 2, 0, 0))
+
+  def test_handler(self):
+    self.require_images()
+    media = self.scan()
+    response = self.request('/tile/%d/0/0/0' % media.key().id())
+    self.assertEqual(200, response.status_int)
+    self.assertEqual('image/jpeg', response.headers['Content-Type'])
+
+  def test_handler_errors(self):
+    media = self.scan()
+    self.assertEqual(404,
+                     self.request('/tile/%d/9/0/0' % media.key().id())
+                     .status_int)
+    self.assertEqual(404, self.request('/tile/12345/0/0/0').status_int)
+    self.log_out()
+    self.assertEqual(403,
+                     self.request('/tile/%d/0/0/0' % media.key().id())
+                     .status_int)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,146 @@
+#
+# Tests of scanningcabinet's AppEngine server-side code.
+#
+# Copyright 2009 Brad Fitzpatrick <brad@danga.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests of timeline.py and /timeline."""
+
+import datetime
+import unittest
+
+import testutil
+
+
+class TimelineTest(testutil.TestCase):
+
+  def setUp(self):
+    testutil.TestCase.setUp(self)
+    import main
+    import timeline
+    self.main = main
+    self.timeline = timeline
+    self.user = self.user_info()
+
+  def buckets(self):
+    """Returns the histogram as {"YYYY-MM": count}."""
+    counts = {}
+    for year in self.timeline.histogram(self.user.key()):
+      for month in year['months']:
+        counts['%04d-%02d' % (year['year'], month['month'])] = month['count']
+    return counts
+
+  def make_doc(self, date, title='Bill'):
+    """Makes a one-page document, dated by /changedoc."""
+    media = self.make_media(self.user)
+    doc, = self.main.make_docs(self.user, [[media]])
+    self.change_date(doc, date, title)
+    return doc
+
+  def change_date(self, doc, date, title='Bill'):
+    response = self.request('/changedoc', post={
+        'docid': str(doc.key().id()), 'title': title, 'tags': 'x',
+        'date': date and date.strftime('%Y-%m-%d') or ''})
+    self.assertEqual(302, response.status_int)
+
+  def test_update_document_dates(self):
+    from google.appengine.ext import db
+    day = datetime.datetime
+    def update(changes):
+      db.run_in_transaction(self.timeline.update_document_dates,
+                            self.user.key(), changes)
+    update([(None, day(2009, 3, 1)), (None, day(2009, 3, 30)),
+            (None, day(2010, 1, 5)), (None, None)])
+    self.assertEqual({'2009-03': 2, '2010-01': 1}, self.buckets())
+    update([(day(2009, 3, 1), day(2009, 3, 2))])  # Same month.
+    self.assertEqual({'2009-03': 2, '2010-01': 1}, self.buckets())
+    update([(day(2010, 1, 5), day(2009, 12, 31)), (day(2009, 3, 1), None)])
+    self.assertEqual({'2009-03': 1, '2009-12': 1}, self.buckets())
+
+  def test_histogram(self):
+    for date in ((2009, 3, 1), (2009, 3, 2), (2009, 11, 1), (2010, 2, 1)):
+      self.make_doc(datetime.datetime(*date))
+    years = self.timeline.histogram(self.user.key())
+    self.assertEqual([(2010, 1), (2009, 3)],
+                     [(y['year'], y['count']) for y in years])
+    self.assertEqual([('Mar', 2, self.timeline.BAR_WIDTH),
+                      ('Nov', 1, self.timeline.BAR_WIDTH // 2)],
+                     [(m['name'], m['count'], m['width'])
+                      for m in years[1]['months']])
+    from google.appengine.ext import db
+    other_key = db.Key.from_path('UserInfo', 'user:other@example.com')
+    self.assertEqual([], self.timeline.histogram(other_key))
+
+  def test_bucket_range(self):
+    day = datetime.datetime
+    self.assertEqual((day(2009, 1, 1), day(2010, 1, 1)),
+                     self.timeline.bucket_range(2009))
+    self.assertEqual((day(2009, 3, 1), day(2009, 4, 1)),
+                     self.timeline.bucket_range(2009, 3))
+    self.assertEqual((day(2009, 12, 1), day(2010, 1, 1)),
+                     self.timeline.bucket_range(2009, 12))
+
+  def test_document_changes_move_buckets(self):
+    doc = self.make_doc(datetime.datetime(2009, 3, 1))
+    other = self.make_doc(datetime.datetime(2009, 3, 5))
+    self.change_date(doc, datetime.datetime(2009, 4, 1))
+    self.assertEqual({'2009-03': 1, '2009-04': 1}, self.buckets())
+    self.change_date(doc, None)
+    self.assertEqual({'2009-03': 1}, self.buckets())
+    self.main.break_docs(self.user, [other])
+    self.assertEqual({}, self.buckets())
+
+  def test_rebuild(self):
+    from google.appengine.ext import db
+    from model import DateHistogram
+    self.make_doc(datetime.datetime(2009, 3, 1))
+    self.make_doc(datetime.datetime(2010, 6, 1))
+    expected = self.buckets()
+    db.delete(DateHistogram.all().fetch(10))
+    self.assertEqual({}, self.buckets())
+    self.timeline.rebuild(self.user)
+    self.assertEqual(1, self.run_tasks(self.timeline.QUEUE_NAME))
+    self.assertEqual(expected, self.buckets())
+
+  def test_page(self):
+    for day in range(1, 6):
+      self.make_doc(datetime.datetime(2009, 3, day), 'Receipt %d' % day)
+    self.make_doc(datetime.datetime(2009, 4, 1), 'Invoice')
+
+    body = self.request('/timeline').body
+    self.assertTrue('/timeline?year=2009&amp;month=3' in body)
+    self.assertFalse('Receipt 1' in body)
+
+    body = self.request('/timeline?year=2009').body
+    self.assertTrue('Receipt 1' in body and 'Invoice' in body)
+
+    first = self.request('/timeline?year=2009&month=3&limit=3').body
+    self.assertEqual(['Receipt 1', 'Receipt 2', 'Receipt 3'],
+                     [t for t in ['Receipt %d' % d for d in range(1, 6)]
+                      if t in first])
+    self.assertFalse('Invoice' in first)
+    self.assertTrue('Next &gt;&gt;' in first)
+
+  def test_bad_parameters_show_histogram(self):
+    self.make_doc(datetime.datetime(2009, 3, 1), 'Receipt')
+    for query in ('year=x', 'year=2009&month=13', 'year=99999'):
+      response = self.request('/timeline?' + query)
+      self.assertEqual(200, response.status_int)
+      self.assertTrue('/timeline?year=2009' in response.body)
+      self.assertFalse('Receipt' in response.body)
+
+
+if __name__ == '__main__':
+  unittest.main()
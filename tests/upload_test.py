@@ -0,0 +1,198 @@
+#
+# Tests of scanningcabinet's AppEngine server-side code.
+#
+# Copyright 2009 Brad Fitzpatrick <brad@danga.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests of multi-file uploads and upload URLs (main.py)."""
+
+import unittest
+
+import testutil
+
+
+class UploadTest(testutil.TestCase):
+
+  def setUp(self):
+    testutil.TestCase.setUp(self)
+    import main
+    self.main = main
+    self.saved_group_size = main.UPLOAD_GROUP_SIZE
+    self.user = self.user_info()
+
+  def tearDown(self):
+    self.main.UPLOAD_GROUP_SIZE = self.saved_group_size
+    testutil.TestCase.tearDown(self)
+
+  def scans(self, count, start=1262304000):
+    """Returns BlobInfos of scancab-named scans, made in reverse order."""
+    blob_infos = []
+    for i in reversed(range(count)):
+      blob_infos.append(self.make_blob(testutil.make_jpeg(seed=start + i),
+                                       'image-%04d-unx%d.jpg' % (i, start + i)))
+    return blob_infos
+
+  def store_media(self, blob_infos, post=None):
+    """Runs main.store_media for a /post request with params post.
+
+    Returns:
+      The error messages.
+    """
+    from google.appengine.ext import webapp
+    class Handler(object):
+      request = webapp.Request.blank('/post', POST=post or {})
+    error_messages = []
+    self.main.store_media(Handler(), blob_infos, error_messages)
+    return error_messages
+
+  def test_scan_time(self):
+    import datetime
+    blob_info, = self.scans(1)
+    self.assertEqual(datetime.datetime(2010, 1, 1, 0, 0, 0, 0),
+                     self.main.scan_time(blob_info))
+    single = self.make_blob('x', 'image-0003.jpg-unx1262304001.jpg')
+    self.assertEqual(datetime.datetime(2010, 1, 1, 0, 0, 1, 3),
+                     self.main.scan_time(single))
+    other = self.make_blob('y', 'receipt.jpg')
+    self.assertEqual(other.creation, self.main.scan_time(other))
+
+  def test_stored_in_scan_order(self):
+    blob_infos = self.scans(4)
+    media = self.store(blob_infos)
+    self.assertEqual(['image-%04d' % i for i in range(4)],
+                     [m.filename[:10] for m in media])
+    creations = [m.creation for m in media]
+    self.assertEqual(sorted(creations), creations)
+    self.assertEqual(len(set(creations)), len(creations))
+
+  def test_ties_get_increasing_creation_times(self):
+    blob_infos = [self.make_blob('page %d' % i, 'receipt.jpg')
+                  for i in range(3)]
+    media = self.store(blob_infos)
+    creations = [m.creation for m in media]
+    self.assertEqual(3, len(set(creations)))
+    self.assertEqual(sorted(creations), creations)
+
+  def test_stored_in_groups(self):
+    import counters
+    import processing
+    from model import MediaObject
+    self.main.UPLOAD_GROUP_SIZE = 2
+    self.store(self.scans(5))
+    self.assertEqual(5, MediaObject.all().count())
+    # One processing task per group.
+    self.assertEqual(3, len(self.tasks(processing.QUEUE_NAME)))
+    # Counted by a task per group, queued in the group's transaction.
+    self.assertEqual(0, counters.totals(self.user.key())['media'])
+    self.assertEqual(3, self.run_tasks(counters.QUEUE_NAME))
+    self.assertEqual(5, counters.totals(self.user.key())['media'])
+
+  def test_out_of_order_uploads_keep_scan_order(self):
+    # scancab --loop uploads batches concurrently, so a later batch can
+    # arrive, or be journaled, first.
+    import journal
+    from model import MediaObject
+    later = self.scans(2, start=1262304000)
+    earlier = self.scans(2, start=1262300000)
+    self.store(later)
+    self.store(earlier)
+    journal.append(testutil.USER_EMAIL, self.scans(2, start=1262400000))
+    journal.append(testutil.USER_EMAIL, self.scans(2, start=1262390000))
+    self.run_tasks(journal.QUEUE_NAME)
+
+    media = MediaObject.all().order('creation').fetch(100)
+    times = [self.main.scan_time(m) for m in media]
+    self.assertEqual(8, len(media))
+    self.assertEqual(sorted(times), times)
+
+  def test_pages_converted_out_of_order_keep_scan_order(self):
+    # scancab --adf converts a batch's pages in a pool, so pages scanned
+    # in the same second can reach the queue, and the server, in any
+    # order.  Their page numbers still order them.
+    import journal
+    from model import MediaObject
+    unixtime = 1262304000
+    for i in (2, 0, 1, 5, 3, 4):
+      blob_info = self.make_blob(testutil.make_jpeg(seed=i),
+                                 'image-%04d-unx%d.jpg' % (i, unixtime))
+      journal.append(testutil.USER_EMAIL, [blob_info])
+    self.run_tasks(journal.QUEUE_NAME)
+
+    media = MediaObject.all().order('creation').fetch(100)
+    self.assertEqual(['image-%04d' % i for i in range(6)],
+                     [m.filename[:10] for m in media])
+
+  def test_single_page_document(self):
+    from model import Document
+    media, = self.store(self.scans(1), {'title': 'Bill', 'tags': 'car, tax',
+                                        'description': ''})
+    doc = Document.all().get()
+    self.assertEqual([media.key()], doc.pages)
+    self.assertEqual(['car', 'tax'], doc.tags)
+    self.assertFalse(media.lacks_document)
+
+  def test_store_media_journals_every_file(self):
+    from model import IngestEntry
+    blob_infos = self.scans(3)
+    self.assertEqual([], self.store_media(blob_infos))
+    entry = IngestEntry.all().get()
+    self.assertEqual(testutil.USER_EMAIL, entry.user_email)
+    self.assertEqual([b.key() for b in blob_infos], entry.blobs)
+    self.assertEqual(3, len(entry.media_ids))
+
+  def test_store_media_errors(self):
+    from model import IngestEntry
+    self.assertEqual(['Form is missing upload file field'],
+                     self.store_media([]))
+    self.assertEqual(['Only a single file can be a stand-alone doc.'],
+                     self.store_media(self.scans(2), {'is_doc': '1'}))
+    self.log_out()
+    self.assertEqual(["No user or correct 'password' argument."],
+                     self.store_media(self.scans(1), {
+                         'user_email': testutil.USER_EMAIL,
+                         'password': 'wrong'}))
+    self.assertEqual(0, IngestEntry.all().count())
+
+  def test_post_without_files(self):
+    response = self.request('/post', post={'user_email': 'nobody'})
+    self.assertEqual(302, response.status_int)
+    self.assertTrue('error_message=' in response.headers['Location'])
+
+  def upload_urls(self, query):
+    response = self.request('/uploadurl?user_email=%s&password=secret%s'
+                            % (testutil.USER_EMAIL, query))
+    if response.status_int != 200:
+      return response.status_int
+    return response.body.splitlines()
+
+  def test_upload_urls(self):
+    import usercache
+    self.user.upload_password = 'secret'
+    self.user.put()
+    usercache.invalidate(self.user.key())
+    self.assertEqual(1, len(self.upload_urls('')))
+    urls = self.upload_urls('&count=5')
+    self.assertEqual(5, len(urls))
+    self.assertEqual(5, len(set(urls)))
+    self.assertEqual(self.main.MAX_UPLOAD_URLS,
+                     len(self.upload_urls('&count=100000')))
+    self.assertEqual(1, len(self.upload_urls('&count=junk')))
+
+  def test_upload_urls_need_password(self):
+    self.assertEqual(403, self.upload_urls(''))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,109 @@
+#
+# Tests of scanningcabinet's AppEngine server-side code.
+#
+# Copyright 2009 Brad Fitzpatrick <brad@danga.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests of usercache.py."""
+
+import unittest
+
+import testutil
+
+KEY_NAME = 'user:%s' % testutil.USER_EMAIL
+
+
+class UserCacheTest(testutil.TestCase):
+
+  def setUp(self):
+    testutil.TestCase.setUp(self)
+    import usercache
+    self.usercache = usercache
+    self.saved = (usercache.LOCAL_CACHE_SECONDS, usercache.MAX_LOCAL_ENTRIES)
+
+  def tearDown(self):
+    (self.usercache.LOCAL_CACHE_SECONDS,
+     self.usercache.MAX_LOCAL_ENTRIES) = self.saved
+    testutil.TestCase.tearDown(self)
+
+  def delete_from_datastore(self):
+    """Deletes the UserInfo behind the caches' backs."""
+    from google.appengine.ext import db
+    db.delete(db.Key.from_path('UserInfo', KEY_NAME))
+
+  def test_get(self):
+    from model import UserInfo
+    self.assertEqual(None, self.usercache.get(KEY_NAME))
+    user_info = self.usercache.get(KEY_NAME, create=True)
+    self.assertEqual(KEY_NAME, user_info.key().name())
+    self.assertNotEqual(None, UserInfo.get_by_key_name(KEY_NAME))
+
+  def test_served_from_local_cache(self):
+    from google.appengine.api import memcache
+    self.usercache.get(KEY_NAME, create=True)
+    self.delete_from_datastore()
+    memcache.flush_all()
+    self.assertEqual(KEY_NAME, self.usercache.get(KEY_NAME).key().name())
+
+  def test_served_from_memcache(self):
+    self.usercache.get(KEY_NAME, create=True)
+    self.delete_from_datastore()
+    self.usercache._local.clear()  # As on another instance.
+    self.assertEqual(KEY_NAME, self.usercache.get(KEY_NAME).key().name())
+
+  def test_local_entries_expire(self):
+    from google.appengine.api import memcache
+    self.usercache.LOCAL_CACHE_SECONDS = -1
+    self.usercache.get(KEY_NAME, create=True)
+    self.delete_from_datastore()
+    memcache.flush_all()
+    self.assertEqual(None, self.usercache.get(KEY_NAME))
+
+  def test_local_cache_bounded(self):
+    self.usercache.MAX_LOCAL_ENTRIES = 2
+    for i in range(3):
+      self.usercache.get('user:%d@example.com' % i, create=True)
+    self.assertEqual(['user:2@example.com'], self.usercache._local.keys())
+
+  def test_invalidate(self):
+    user_info = self.usercache.get(KEY_NAME, create=True)
+    user_info.upload_password = 'secret'
+    user_info.put()
+    self.assertEqual(None, self.usercache.get(KEY_NAME).upload_password)
+    self.usercache.invalidate(user_info.key())
+    self.assertEqual('secret', self.usercache.get(KEY_NAME).upload_password)
+
+  def test_callers_get_their_own_copy(self):
+    first = self.usercache.get(KEY_NAME, create=True)
+    first.non_owner = True
+    first.real_email = 'brother@example.com'
+    second = self.usercache.get(KEY_NAME)
+    self.assertFalse(second.non_owner)
+    self.assertEqual('', second.real_email)
+
+  def test_acting_as_another_user(self):
+    import main
+    owner = self.user_info()
+    self.testbed.setup_env(user_email='brother@example.com', user_id='2',
+                           overwrite=True)
+    helper = main.get_user_info()
+    self.assertEqual(owner.key(), helper.key())
+    self.assertTrue(helper.non_owner)
+    self.assertEqual('brother@example.com', helper.real_email)
+    self.assertFalse(self.usercache.get(KEY_NAME).non_owner)
+
+
+if __name__ == '__main__':
+  unittest.main()
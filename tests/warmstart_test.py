@@ -0,0 +1,82 @@
+#
+# Tests of scanningcabinet's AppEngine server-side code.
+#
+# Copyright 2009 Brad Fitzpatrick <brad@danga.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests that main.py's application and templates are built once."""
+
+import os
+import unittest
+
+import testutil
+
+
+class WarmStartTest(testutil.TestCase):
+
+  def setUp(self):
+    testutil.TestCase.setUp(self)
+    import main
+    from google.appengine.ext.webapp import template
+    self.main = main
+    self.template = template
+    self.saved = (main.DEBUG, main.run_wsgi_app)
+    self.user_info()
+    self.main_html = os.path.abspath(os.path.join(main.TEMPLATE_DIR,
+                                                  'main.html'))
+
+  def tearDown(self):
+    self.main.DEBUG, self.main.run_wsgi_app = self.saved
+    testutil.TestCase.tearDown(self)
+
+  def test_not_debug_in_production(self):
+    self.assertFalse(self.main.DEBUG)
+
+  def test_application_built_once(self):
+    import instrument
+    ran = []
+    self.main.run_wsgi_app = ran.append
+    self.main.main()
+    self.main.main()
+    self.assertEqual(2, len(ran))
+    self.assertTrue(ran[0] is self.main.application)
+    self.assertTrue(ran[1] is self.main.application)
+    self.assertTrue(isinstance(self.main.application, instrument.Middleware))
+
+  def test_templates_compiled_once(self):
+    self.template.template_cache.clear()
+    self.assertEqual(200, self.request('/').status_int)
+    compiled = self.template.template_cache[self.main_html]
+    self.assertEqual(200, self.request('/?x=1').status_int)
+    self.assertTrue(self.template.template_cache[self.main_html] is compiled)
+
+  def test_templates_reread_in_debug(self):
+    self.main.DEBUG = True
+    self.template.template_cache.clear()
+    self.assertEqual(200, self.request('/').status_int)
+    self.assertFalse(self.main_html in self.template.template_cache)
+
+  def test_templates_found_from_any_directory(self):
+    self.template.template_cache.clear()
+    saved_cwd = os.getcwd()
+    os.chdir(os.path.dirname(saved_cwd))
+    try:
+      self.assertEqual(200, self.request('/').status_int)
+    finally:
+      os.chdir(saved_cwd)
+
+
+if __name__ == '__main__':
+  unittest.main()
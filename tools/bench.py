@@ -0,0 +1,570 @@
+#!/usr/bin/env python
+#
+# Offline benchmarks of scanningcabinet's AppEngine handlers.
+#
+# Copyright 2009 Brad Fitzpatrick <brad@danga.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Offline benchmarks of appengine/main.py's handlers.
+
+Runs main.application, the app's WSGI application, in this process,
+against the SDK's in-memory service stubs (google.appengine.ext.testbed)
+for the datastore, blobstore, images, memcache, task queue and users.
+No deploy and no dev_appserver needed, just the SDK.
+
+For each corpus size it generates a synthetic library for one user:
+MediaObjects (most of them pages of Documents, the rest un-annotated),
+Documents with random tags and dates, and a few shared JPEG blobs.  It
+then times a series of requests per scenario and reports p50/p99/max
+latency, datastore and other API calls per request (counted with an
+apiproxy pre-call hook), and peak RSS.  The first corpus also reports
+the cold start: how long importing main.py took (import_ms), and its
+first request (first_request), which compiles the home page templates.
+
+Usage:
+  tools/bench.py --sdk ~/google_appengine
+  tools/bench.py --sdk ~/google_appengine --media 1000,100000,1000000 \\
+      --docs 100000 --requests 200 --output bench.json
+
+--output writes one JSON object per corpus size (JSON lines), so runs
+can be appended to one file and compared for regressions.
+
+The stubs are far slower than production for big corpora (every query
+is a scan of an in-memory dict), so compare numbers between runs of
+this tool, not with production.  Without PIL the images stub can't
+resize, and the resize and processing scenarios are skipped.
+"""
+
+import StringIO
+import base64
+import datetime
+import gc
+import hashlib
+import math
+import optparse
+import os
+import random
+import resource
+import sys
+import time
+import urllib
+
+try:
+  import json
+except ImportError:
+  import simplejson as json
+
+APPENGINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, 'appengine')
+
+USER_EMAIL = 'bench@example.com'
+
+TAGS = ('tax', 'insurance', 'car', 'medical', 'bank', 'utilities', 'house',
+        'receipt', 'warranty', 'school', 'travel', 'phone')
+
+# Distinct blobs in the corpus; MediaObjects share them.
+CORPUS_BLOBS = 20
+
+# Files per /post, as scancab sends them.
+UPLOAD_BATCH_SIZE = 10
+
+PUT_BATCH_SIZE = 500
+
+
+def setup_sdk(sdk_path):
+  """Puts the SDK and its bundled libraries, and appengine/, on sys.path."""
+  sdk_path = os.path.abspath(os.path.expanduser(sdk_path))
+  sys.path.insert(0, sdk_path)
+  import dev_appserver
+  dev_appserver.fix_sys_path()
+  sys.path.insert(0, os.path.abspath(APPENGINE_DIR))
+
+
+class RpcCounter(object):
+  """Counts API calls by "service.Method", via an apiproxy hook."""
+
+  def __init__(self):
+    self.counts = {}
+
+  def install(self):
+    from google.appengine.api import apiproxy_stub_map
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+        'bench', self.hook)
+
+  def hook(self, service, call, request, response, *unused_args):
+    name = '%s.%s' % (service, call)
+    self.counts[name] = self.counts.get(name, 0) + 1
+
+  def take(self):
+    """Returns the counts since the last take()."""
+    counts = self.counts
+    self.counts = {}
+    return counts
+
+
+def max_rss_kb():
+  # Kilobytes on Linux, bytes on Mac OS X.
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  if sys.platform == 'darwin':
+    rss //= 1024
+  return rss
+
+
+def percentile(sorted_values, fraction):
+  """Nearest-rank percentile of an already sorted list."""
+  if not sorted_values:
+    return 0.0
+  rank = int(math.ceil(fraction * len(sorted_values))) - 1
+  return sorted_values[max(0, min(len(sorted_values) - 1, rank))]
+
+
+def upload_creation():
+  """Returns now as the blobstore writes upload creation times."""
+  now = datetime.datetime.now()
+  return now.strftime('%Y-%m-%d %H:%M:%S') + '.%06d' % now.microsecond
+
+
+def make_jpeg(width, height, seed):
+  """Returns JPEG data of a noisy page, or a bare JPEG header without PIL."""
+  try:
+    from PIL import Image
+  except ImportError:
+    try:
+      import Image
+    except ImportError:
+      Image = None
+  if Image is None:
+    return ('\xff\xd8\xff\xc0\x00\x11\x08' +
+            chr(height >> 8) + chr(height & 255) +
+            chr(width >> 8) + chr(width & 255) +
+            '\x03\x01\x22\x00\x02\x11\x01\x03\x11\x01\xff\xd9' +
+            'seed%d' % seed)
+  rand = random.Random(seed)
+  image = Image.new('L', (width, height), 255)
+  for unused in range(200):
+    x, y = rand.randrange(width), rand.randrange(height)
+    image.paste(0, (x, y, min(width, x + 40), min(height, y + 4)))
+  out = StringIO.StringIO()
+  image.save(out, 'JPEG', quality=75)
+  return out.getvalue()
+
+
+class Bench(object):
+  """One corpus in a fresh testbed, and the scenarios run against it."""
+
+  def __init__(self, options):
+    self.options = options
+    self.rand = random.Random(options.seed)
+    self.next_blob = 0
+
+  def activate(self):
+    from google.appengine.ext import testbed
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    # Not 'Development/...', so main.py runs as in production.
+    self.testbed.setup_env(app_id='scanningcabinet',
+                           server_software='Google App Engine/bench',
+                           user_email=USER_EMAIL,
+                           user_id='1',
+                           user_is_admin='1',
+                           overwrite=True)
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    self.testbed.init_blobstore_stub()
+    self.testbed.init_taskqueue_stub(root_path=APPENGINE_DIR)
+    self.testbed.init_user_stub()
+    self.images = True
+    try:
+      self.testbed.init_images_stub()
+    except Exception, e:  # The stub needs PIL.
+      print >>sys.stderr, "No images stub (%s); skipping resizes" % e
+      self.images = False
+
+    # Only the first corpus pays for importing main.
+    self.import_ms = None
+    start = time.time()
+    first_import = 'main' not in sys.modules
+    import main
+    if first_import:
+      self.import_ms = round((time.time() - start) * 1000, 2)
+    import usercache
+    self.main = main
+    self.app = main.application
+    usercache._local.clear()  # From the previous corpus's testbed.
+    self.rpcs = RpcCounter()
+    self.rpcs.install()
+
+  def deactivate(self):
+    self.testbed.deactivate()
+
+  def make_blob(self, data, filename, content_type='image/jpeg'):
+    """Stores a blob with a full BlobInfo, as an upload would."""
+    from google.appengine.api import datastore
+    from google.appengine.ext import blobstore
+    self.next_blob += 1
+    blob_key = blobstore.BlobKey('bench-blob-%d' % self.next_blob)
+    self.testbed.get_stub('blobstore').storage.StoreBlob(
+        blob_key, StringIO.StringIO(data))
+    entity = datastore.Entity(blobstore.BLOB_INFO_KIND, name=str(blob_key),
+                              namespace='')
+    entity['content_type'] = content_type
+    entity['creation'] = datetime.datetime.now()
+    entity['filename'] = filename
+    entity['size'] = len(data)
+    entity['md5_hash'] = hashlib.md5(data).hexdigest()
+    datastore.Put(entity)
+    return blob_key, entity['md5_hash']
+
+  def build_corpus(self, num_media, num_docs):
+    """Writes the user's library.  Returns a dict describing it."""
+    from google.appengine.ext import db
+    from model import Document
+
+    start = time.time()
+    user_info = self.main.get_user_info()
+    user_key = user_info.key()
+
+    blobs = []
+    for i in range(CORPUS_BLOBS):
+      data = make_jpeg(850, 1100, i)
+      blob_key, md5_hash = self.make_blob(data, 'page-%d.jpg' % i)
+      blobs.append((blob_key, len(data)))
+
+    # Pages of documents first; the rest stay un-annotated.
+    pages_per_doc = []
+    pages_left = num_media
+    for i in range(num_docs):
+      if pages_left <= 0:
+        break
+      count = min(pages_left, self.rand.choice((1, 1, 1, 2, 2, 3, 5)))
+      pages_per_doc.append(count)
+      pages_left -= count
+    num_docs = len(pages_per_doc)
+
+    first_media, unused = db.allocate_ids(
+        db.Key.from_path('MediaObject', 1, parent=user_key), max(1, num_media))
+    first_doc, unused = db.allocate_ids(
+        db.Key.from_path('Document', 1, parent=user_key), max(1, num_docs))
+    base_time = datetime.datetime(2009, 1, 1)
+
+    def media_key(i):
+      return db.Key.from_path('MediaObject', first_media + i, parent=user_key)
+
+    batch = []
+    def add(entity):
+      batch.append(entity)
+      if len(batch) >= PUT_BATCH_SIZE:
+        db.put(batch)
+        del batch[:]
+
+    media_index = 0
+    self.doc_ids = []
+    for d, count in enumerate(pages_per_doc):
+      doc_key = db.Key.from_path('Document', first_doc + d, parent=user_key)
+      pages = [media_key(media_index + p) for p in range(count)]
+      tags = self.rand.sample(TAGS, self.rand.randrange(0, 4))
+      doc_date = base_time - datetime.timedelta(days=self.rand.randrange(3650))
+      add(Document(key=doc_key, owner=user_key, pages=pages,
+                   title='Document %d' % d, tags=tags, no_tags=not tags,
+                   doc_date=doc_date, no_date=False))
+      for page_key in pages:
+        add(self.corpus_media(page_key, user_key, blobs, media_index,
+                              base_time, doc_key))
+        media_index += 1
+      self.doc_ids.append(doc_key.id())
+    self.loose_ids = []
+    while media_index < num_media:
+      key = media_key(media_index)
+      add(self.corpus_media(key, user_key, blobs, media_index, base_time,
+                            None))
+      self.loose_ids.append(key.id())
+      media_index += 1
+    if batch:
+      db.put(batch)
+
+    import counters
+    import tagindex
+    import timeline
+    tagindex.rebuild(user_info)
+    timeline.rebuild(user_info)
+    self.run_tasks(tagindex.QUEUE_NAME)
+    counters.recount(user_info)
+    self.rpcs.take()
+    return {'media': num_media, 'docs': num_docs,
+            'unannotated': len(self.loose_ids),
+            'build_seconds': round(time.time() - start, 2)}
+
+  def corpus_media(self, key, user_key, blobs, i, base_time, doc_key):
+    from model import MediaObject
+    blob_key, size = blobs[i % len(blobs)]
+    return MediaObject(key=key, owner=user_key, blob=blob_key,
+                       creation=base_time + datetime.timedelta(seconds=i),
+                       content_type='image/jpeg',
+                       filename='image-%d-unx%d.jpg' % (i, 1230768000 + i),
+                       size=size, width=850, height=1100,
+                       document=doc_key, lacks_document=doc_key is None,
+                       processing_state='done')
+
+  def request(self, path, post=None, body=None, content_type=None):
+    """Runs one request through the application.  Returns the response."""
+    import webob
+    if body is not None:
+      req = webob.Request.blank(path)
+      req.method = 'POST'
+      req.content_type = content_type
+      req.body = body
+    elif post is not None:
+      req = webob.Request.blank(path, POST=post)
+    else:
+      req = webob.Request.blank(path)
+    return req.get_response(self.app)
+
+  def run_tasks(self, queue_name):
+    """Runs the queue's tasks, and any they add, until it's empty."""
+    stub = self.testbed.get_stub('taskqueue')
+    while True:
+      tasks = stub.GetTasks(queue_name)
+      if not tasks:
+        return
+      for task in tasks:
+        stub.DeleteTask(queue_name, task['name'])
+        self.request(task['url'],
+                     body=base64.b64decode(task.get('body') or ''),
+                     content_type='application/x-www-form-urlencoded')
+
+  def flush_caches(self):
+    import usercache
+    from google.appengine.api import memcache
+    memcache.flush_all()
+    usercache._local.clear()
+
+  def run(self, name, make_request, count, before=None):
+    """Times count requests.  make_request(i) returns request() args.
+
+    Returns the scenario's results dict, or None if it had nothing to
+    do.
+    """
+    latencies = []
+    rpc_totals = {}
+    statuses = {}
+    rss_before = max_rss_kb()
+    gc.collect()
+    for i in range(count):
+      args = make_request(i)
+      if args is None:
+        break
+      if before:
+        before()
+      self.rpcs.take()
+      start = time.time()
+      response = self.request(*args[:1], **args[1])
+      latencies.append((time.time() - start) * 1000.0)
+      for rpc, n in self.rpcs.take().items():
+        rpc_totals[rpc] = rpc_totals.get(rpc, 0) + n
+      status = str(response.status_int)
+      statuses[status] = statuses.get(status, 0) + 1
+    if not latencies:
+      return None
+    latencies.sort()
+    n = len(latencies)
+    result = {
+        'requests': n,
+        'p50_ms': round(percentile(latencies, 0.50), 2),
+        'p99_ms': round(percentile(latencies, 0.99), 2),
+        'mean_ms': round(sum(latencies) / n, 2),
+        'max_ms': round(latencies[-1], 2),
+        'rpcs_per_request': dict((rpc, round(float(total) / n, 2))
+                                 for rpc, total in rpc_totals.items()),
+        'datastore_rpcs_per_request': round(float(sum(
+            [total for rpc, total in rpc_totals.items()
+             if rpc.startswith('datastore_v3.')])) / n, 2),
+        'status': statuses,
+        'max_rss_kb': max_rss_kb(),
+        'max_rss_growth_kb': max_rss_kb() - rss_before,
+        }
+    print_result(name, result)
+    return result
+
+  def upload_body(self, count):
+    """Returns (body, content type) of a /post of count new scans."""
+    boundary = 'benchboundary%d' % self.rand.randrange(1 << 30)
+    parts = []
+    for unused in range(count):
+      self.upload_seq = getattr(self, 'upload_seq', 0) + 1
+      filename = 'image-%d-unx%d.jpg' % (self.upload_seq,
+                                         1262304000 + self.upload_seq)
+      data = make_jpeg(64, 64, 100000 + self.upload_seq)
+      blob_key, md5_hash = self.make_blob(data, filename)
+      parts.append(
+          '--%s\r\n'
+          'Content-Disposition: form-data; name="file"; filename="%s"\r\n'
+          'Content-Type: message/external-body; blob-key="%s"; '
+          'access-type="X-AppEngine-BlobKey"\r\n\r\n'
+          'Content-Type: image/jpeg\r\n'
+          'Content-Length: %d\r\n'
+          'Content-MD5: %s\r\n'
+          'X-AppEngine-Upload-Creation: %s\r\n'
+          '\r\n\r\n' % (boundary, filename, blob_key, len(data),
+                        base64.urlsafe_b64encode(md5_hash),
+                        upload_creation()))
+    body = ''.join(parts) + '--%s--\r\n' % boundary
+    return body, 'multipart/form-data; boundary=%s' % boundary
+
+  def scenarios(self):
+    """Runs every scenario.  Returns {name: results}."""
+    count = self.options.requests
+    rand = self.rand
+    results = {}
+
+    def add(name, result):
+      if result is not None:
+        results[name] = result
+
+    # Only the first corpus's first request compiles the templates.
+    add('first_request', self.run('first_request', lambda i: ('/', {}), 1))
+    add('main_warm', self.run('main_warm', lambda i: ('/', {}), count))
+    add('main_cold', self.run('main_cold', lambda i: ('/', {}), count,
+                              before=self.flush_caches))
+    add('main_search', self.run(
+        'main_search',
+        lambda i: ('/?' + urllib.urlencode({'tags': rand.choice(TAGS)}), {}),
+        count))
+
+    if self.doc_ids:
+      add('show_doc', self.run(
+          'show_doc',
+          lambda i: ('/doc/%d' % rand.choice(self.doc_ids), {}), count))
+
+    media_ids = self.loose_ids or []
+    def resource(i):
+      if not media_ids:
+        return None
+      return ('/resource/%d/x.jpg' % rand.choice(media_ids), {})
+    add('resource', self.run('resource', resource, count))
+    if self.images:
+      def resize(i):
+        if not media_ids:
+          return None
+        return ('/resource/%d/x.jpg?resize=%d' % (
+            rand.choice(media_ids), rand.choice((150, 300, 1200))), {})
+      add('resource_resize', self.run('resource_resize', resize, count))
+
+    def upload(i):
+      body, content_type = self.upload_body(UPLOAD_BATCH_SIZE)
+      return ('/post', {'body': body, 'content_type': content_type})
+    add('upload_post', self.run('upload_post', upload, count))
+    add('ingest_task', self.run(
+        'ingest_task',
+        lambda i: ('/tasks/ingest', {'post': {'user': USER_EMAIL}}),
+        max(1, count // 10)))
+    if self.images:
+      # Renders and checks (pagecheck.py) the scans stored above.
+      from model import MediaObject
+      pending = [str(k) for k in MediaObject.all(keys_only=True).filter(
+          'processing_state', 'pending').fetch(count)]
+      def process(i):
+        if not pending:
+          return None
+        return ('/tasks/process_media', {'post': {'key': pending.pop()}})
+      add('process_media', self.run('process_media', process, count))
+
+    loose = list(self.loose_ids)
+    rand.shuffle(loose)
+    def makedoc(i):
+      if len(loose) < 2:
+        return None
+      ids = [str(loose.pop()) for unused in range(2)]
+      return ('/makedoc', {'post': [('media_id', x) for x in ids]})
+    add('makedoc', self.run('makedoc', makedoc, count))
+
+    add('gc_start', self.run(
+        'gc_start',
+        lambda i: ('/admin/gc', {'post': {'action': 'start', 'dry_run': '1'}}),
+        1))
+    import mediagc
+    if mediagc.latest_run() is None:
+      return results
+    run_id = mediagc.latest_run().key().id()
+    def gc_step(i):
+      if mediagc.latest_run().phase == 'done':
+        return None
+      return ('/tasks/gc', {'post': {'run': str(run_id)}})
+    add('gc_task', self.run('gc_task', gc_step, self.options.max_gc_steps))
+    return results
+
+
+def print_result(name, result):
+  print >>sys.stderr, (
+      "  %-16s n=%-5d p50=%8.2fms p99=%8.2fms datastore/req=%6.2f "
+      "rss=%dKB" % (name, result['requests'], result['p50_ms'],
+                    result['p99_ms'], result['datastore_rpcs_per_request'],
+                    result['max_rss_kb']))
+
+
+def main():
+  parser = optparse.OptionParser(usage='%prog --sdk PATH [options]')
+  parser.add_option('--sdk', default=os.environ.get('APPENGINE_SDK',
+                                                    '/usr/local/google_appengine'),
+                    help='App Engine SDK directory [%default]')
+  parser.add_option('--media', default='1000,10000',
+                    help='comma-separated corpus sizes, in MediaObjects '
+                    '(up to 1000000) [%default]')
+  parser.add_option('--docs', type='int', default=None,
+                    help='Documents per corpus (up to 100000) '
+                    '[media / 4, at most 100000]')
+  parser.add_option('--requests', type='int', default=100,
+                    help='requests per scenario [%default]')
+  parser.add_option('--max-gc-steps', type='int', default=1000,
+                    help='most GC task batches to run [%default]')
+  parser.add_option('--seed', type='int', default=1)
+  parser.add_option('--output', help='append JSON lines results here')
+  options, args = parser.parse_args()
+  if args:
+    parser.error('unexpected arguments: %s' % args)
+
+  setup_sdk(options.sdk)
+  import logging
+  logging.getLogger().setLevel(logging.WARNING)
+
+  for size in [int(x) for x in options.media.split(',') if x]:
+    docs = options.docs
+    if docs is None:
+      docs = min(size // 4, 100000)
+    print >>sys.stderr, "Corpus: %d media, %d documents" % (size, docs)
+    bench = Bench(options)
+    bench.activate()
+    try:
+      corpus = bench.build_corpus(size, docs)
+      print >>sys.stderr, "  built in %.1fs" % corpus['build_seconds']
+      record = {
+          'time': datetime.datetime.utcnow().isoformat(),
+          'python': sys.version.split()[0],
+          'corpus': corpus,
+          'import_ms': bench.import_ms,
+          'requests': options.requests,
+          'scenarios': bench.scenarios(),
+          }
+    finally:
+      bench.deactivate()
+    if options.output:
+      out = open(options.output, 'a')
+      out.write(json.dumps(record, sort_keys=True) + '\n')
+      out.close()
+    else:
+      print json.dumps(record, sort_keys=True, indent=2)
+
+
+if __name__ == '__main__':
+  main()